@@ -3,27 +3,98 @@ Taiwan Stock Backtesting System - Flask API
 Flask 後端 API 伺服器
 """
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import pandas as pd
-import yfinance as yf
-from datetime import datetime, timedelta
+import numpy as np
+from collections import OrderedDict
+import threading
+import json
 import os
 
-from backtest_engine import run_backtest, optimize_ma, get_market_status
+from backtest_engine import (
+    run_backtest, advance, extend_result, optimize_ma, optimize_grid, optimize_adaptive, walk_forward,
+    sensitivity_heatmap, monte_carlo, run_backtest_symbols, get_market_status, indicator_cache, downsample_result, dates_to_strings,
+    NO_EFFECT_PARAMS, MC_MAX_SAMPLE_PATHS, GRID_MAX_CONFIGS, grid_size, BacktestState
+)
+from profiling import (
+    span, timed, start_timing, stop_timing, server_timing_header, log_timing,
+    new_profiler, stop_profiler, profile_summary
+)
+from data_store import DEFAULT_SYMBOL, get_dataset, load_symbols, align_symbols, validate_symbol
+import metrics
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON 序列化計入 serialize 區段"""
+
+    def dumps(self, obj, **kwargs):
+        with span('serialize'):
+            return super().dumps(obj, **kwargs)
+
 
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 CORS(app)  # 允許跨域請求
 
+# 指標快取事件匯出為監控指標
+indicator_cache.listener = lambda event, count: metrics.record_cache_event('indicator', event, count)
+
 # 快取檔案路徑
-CACHE_FILE = 'stock_data_cache.csv'
+CACHE_FILE = 'stock_data_cache.npy'  # .npy 結構化陣列；舊的 stock_data_cache.csv 於第一次載入時轉換
 CACHE_EXPIRY_HOURS = 0.08  # 約 5 分鐘，確保資料新鮮度
 
+# ?profile=1 只在除錯模式或設定此環境變數為 1 時生效 (摘要含伺服器檔案路徑)
+PROFILING_ENV = 'ENABLE_PROFILING'
+
+# 欄式回傳格式：?format=columnar 或 Accept 標頭
+COLUMNAR_MIME = 'application/vnd.twstock.columnar+json'
+
+# 目前資料集的版本 (Dataset.version，內容改變時遞增)
+_data_version = None
+
+# 多商品回測單次請求的商品數上限
+MAX_SYMBOLS = 20
+
+# 均線優化的 maMax 上限 (均線矩陣為 視窗數 × K 棒數)
+MAX_MA_DAYS = 1000
+
+# walk-forward 的 testBars 下限 (同時為滾動步長，過小會產生大量 fold)
+MIN_TEST_BARS = 20
+
+# Monte Carlo 單次請求的模擬次數上限 (完整路徑數上限見 MC_MAX_SAMPLE_PATHS)
+MAX_MC_ROUNDS = 20000
+
+# 回測狀態快取：相同參數的請求只需推進新增的 K 棒
+BACKTEST_CACHE_SIZE = 32
+_backtest_cache = OrderedDict()
+_backtest_cache_lock = threading.Lock()
 
+
+def _refresh_data_version(version):
+    """
+    更新資料版本
+    
+    資料集重新載入 (本行程或其他 worker 下載新資料) 時版本會改變，
+    並清除指標快取中舊版本的項目。
+    """
+    global _data_version
+    
+    if version != _data_version:
+        indicator_cache.invalidate(keep_version=version)
+        _data_version = version
+    
+    return version
+
+
+@timed('load')
 def load_stock_data(start_date=None, end_date=None):
     """
     從 Yahoo Finance 載入股市資料，優先使用快取
     
+    快取檔解析後常駐記憶體 (data_store.Dataset)，檔案內容未改變時只做日期區間切片。
+    
     Parameters:
     -----------
     start_date : str, optional
@@ -35,66 +106,169 @@ def load_stock_data(start_date=None, end_date=None):
     --------
     DataFrame: 包含 date 和 close 欄位
     """
-    use_cache = False
-    
-    # 檢查快取是否存在且有效
-    if os.path.exists(CACHE_FILE):
-        cache_mtime = datetime.fromtimestamp(os.path.getmtime(CACHE_FILE))
-        if datetime.now() - cache_mtime < timedelta(hours=CACHE_EXPIRY_HOURS):
-            use_cache = True
-    
-    if use_cache:
-        try:
-            df = pd.read_csv(CACHE_FILE, parse_dates=['date'])
-            print(f"[INFO] 從快取載入資料，共 {len(df)} 筆")
-        except Exception as e:
-            print(f"[WARN] 讀取快取失敗: {e}")
-            use_cache = False
-    
-    if not use_cache:
-        try:
-            print("[INFO] 從 Yahoo Finance 下載資料...")
-            df_yahoo = yf.download('^TWII', period='20y', progress=False)
-            
-            if df_yahoo.empty:
-                raise Exception("Yahoo Finance 回傳空資料")
-            
-            df_yahoo = df_yahoo.reset_index()
-            
-            # 處理 MultiIndex 欄位
-            if isinstance(df_yahoo.columns, pd.MultiIndex):
-                df_yahoo.columns = df_yahoo.columns.get_level_values(0)
-            
-            # 重命名欄位
-            df = df_yahoo[['Date', 'Close']].copy()
-            df.columns = ['date', 'close']
-            df['date'] = pd.to_datetime(df['date'])
-            df = df.sort_values('date').reset_index(drop=True)
-            
-            # 儲存快取
-            df.to_csv(CACHE_FILE, index=False)
-            print(f"[INFO] 資料已快取，共 {len(df)} 筆")
-            
-        except Exception as e:
-            print(f"[ERROR] Yahoo Finance 下載失敗: {e}")
-            
-            # 嘗試讀取舊快取
-            if os.path.exists(CACHE_FILE):
-                df = pd.read_csv(CACHE_FILE, parse_dates=['date'])
-                print(f"[INFO] 使用舊快取資料，共 {len(df)} 筆")
-            else:
-                return None
-    
-    # 根據日期範圍過濾
-    if start_date:
-        start_dt = pd.to_datetime(start_date)
-        df = df[df['date'] >= start_dt]
-    
-    if end_date:
-        end_dt = pd.to_datetime(end_date)
-        df = df[df['date'] <= end_dt]
-    
-    return df.reset_index(drop=True)
+    dataset = get_dataset(DEFAULT_SYMBOL, CACHE_FILE, CACHE_EXPIRY_HOURS)
+    
+    if dataset is None:
+        return None
+    
+    _refresh_data_version(dataset.version)
+    
+    # 根據日期範圍切片
+    return dataset.frame(start_date, end_date)
+
+
+def wants_columnar():
+    """
+    請求是否要求欄式回傳格式
+    
+    回應格式會依 Accept 標頭而不同，因此標記回應須加上 Vary: Accept，
+    避免 Service Worker 等快取將另一種格式的回應回傳給前端。
+    """
+    g.vary_accept = True
+    if request.args.get('format') == 'columnar':
+        return True
+    return COLUMNAR_MIME in request.headers.get('Accept', '')
+
+
+def _store_backtest(key, result, state):
+    """
+    將回測結果與狀態存入快取
+    
+    計算在鎖外進行，其間其他請求可能已存入較新的狀態；此時保留較新者。
+    """
+    with _backtest_cache_lock:
+        existing = _backtest_cache.get(key)
+        if existing is None or existing[1].last_date <= state.last_date:
+            _backtest_cache[key] = (result, state)
+        _backtest_cache.move_to_end(key)
+        while len(_backtest_cache) > BACKTEST_CACHE_SIZE:
+            _backtest_cache.popitem(last=False)
+            metrics.record_cache_event('backtest', 'eviction')
+
+
+def run_backtest_cached(df, params):
+    """
+    執行回測，並以快取的 BacktestState 只推進新增的 K 棒
+    
+    僅適用於未指定結束日期的回測。快取鍵包含資料集的 historyVersion：
+    既有 K 棒被修正 (而非只在尾端新增) 時版本改變，舊狀態不再被使用；
+    若快取最後一根 K 棒的收盤價已被修正，同樣重新計算。
+    鎖只保護快取的查詢與存入，回測本身在鎖外計算，不會阻塞其他請求。
+    
+    Parameters:
+    -----------
+    df : DataFrame
+        股價資料
+    params : dict
+        回測參數
+    
+    Returns:
+    --------
+    dict: 回測結果
+    """
+    key = json.dumps([params, df.attrs.get('historyVersion')], sort_keys=True, default=str)
+    
+    with _backtest_cache_lock:
+        cached = _backtest_cache.get(key)
+        if cached is not None:
+            _backtest_cache.move_to_end(key)
+    
+    if cached is not None:
+        result, state = cached
+        last_date = pd.Timestamp(state.last_date, unit='D')
+        last_row = df[df['date'] == last_date]
+        
+        if not last_row.empty and float(last_row['close'].iloc[-1]) == state.last_close:
+            new_bars = df[df['date'] > last_date]
+            if not new_bars.empty:
+                # 快取中的狀態可能同時被其他請求讀取，advance() 只推進副本
+                state = BacktestState.from_dict(state.to_dict())
+                result = extend_result(result, advance(state, new_bars))
+                _store_backtest(key, result, state)
+            metrics.record_cache_event('backtest', 'hit')
+            metrics.record_bars('incremental', len(new_bars))
+            return result
+    
+    metrics.record_cache_event('backtest', 'miss')
+    result, state = run_backtest(df, params, return_state=True)
+    metrics.record_bars('full', len(df))
+    
+    if result['success']:
+        _store_backtest(key, result, state)
+    
+    return result
+
+
+def profiling_allowed():
+    """是否允許以 ?profile=1 啟用 cProfile：僅限除錯模式或設定 ENABLE_PROFILING=1"""
+    return app.debug or os.environ.get(PROFILING_ENV) == '1'
+
+
+@app.before_request
+def start_request_timing():
+    """
+    開始記錄本次請求的區段耗時
+    
+    ?profile=1 且 profiling_allowed() 時同時啟用 cProfile；其他請求正在剖析時略過。
+    """
+    g.timing_token = start_timing()
+    if request.args.get('profile') == '1' and profiling_allowed():
+        g.profiler = new_profiler()
+    
+    g.metrics_route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.REQUESTS_IN_FLIGHT.labels(route=g.metrics_route).inc()
+
+
+@app.after_request
+def add_server_timing(response):
+    """
+    輸出 Server-Timing 標頭與結構化耗時日誌
+    
+    ?profile=1 時將 cProfile 摘要加入 JSON 回應的 profile 欄位；
+    依 Accept 標頭選擇格式的回應加上 Vary: Accept。
+    """
+    if g.pop('vary_accept', False):
+        response.vary.add('Accept')
+    
+    token = g.pop('timing_token', None)
+    if token is None:
+        return response
+    
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        stop_profiler(profiler)
+    
+    timings = stop_timing(token)
+    total = timings.elapsed()
+    response.headers['Server-Timing'] = server_timing_header(timings, total)
+    response.headers['Timing-Allow-Origin'] = '*'
+    
+    metrics.observe_request(request.method, g.metrics_route, response.status_code, total)
+    if request.path.startswith('/api'):
+        log_timing(request.method, request.path, response.status_code, timings, total)
+    
+    if profiler is not None and response.is_json:
+        body = response.get_json()
+        if isinstance(body, dict):
+            body['profile'] = profile_summary(profiler)
+            response.set_data(app.json.dumps(body))
+    
+    return response
+
+
+@app.teardown_request
+def clear_request_timing(exc):
+    """未經 after_request 結束的請求 (例外) 也要停止記錄；處理中請求數一律於此遞減"""
+    route = g.pop('metrics_route', None)
+    if route is not None:
+        metrics.REQUESTS_IN_FLIGHT.labels(route=route).dec()
+    
+    token = g.pop('timing_token', None)
+    if token is not None:
+        stop_timing(token)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        stop_profiler(profiler)
 
 
 @app.route('/')
@@ -113,7 +287,15 @@ def api_info():
             '/api/data': 'GET - 獲取股市資料',
             '/api/market': 'GET - 獲取最新市場狀態',
             '/api/backtest': 'POST - 執行回測',
-            '/api/optimize': 'POST - 自動優化均線'
+            '/api/backtest/symbols': 'POST - 多商品回測與等權重組合',
+            '/api/optimize': 'POST - 自動優化均線',
+            '/api/optimize/grid': 'POST - 平行網格搜尋參數',
+            '/api/optimize/adaptive': 'POST - 自適應參數搜尋 (successive halving)',
+            '/api/heatmap': 'POST - 雙參數敏感度熱圖',
+            '/api/optimize/walkforward': 'POST - Walk-forward 均線優化',
+            '/api/montecarlo': 'POST - Monte Carlo 資產路徑模擬',
+            '/api/cache': 'GET - 指標快取統計',
+            '/metrics': 'GET - Prometheus 監控指標'
         }
     })
 
@@ -152,6 +334,7 @@ def get_data():
     Query Parameters:
     - startDate: 開始日期 (YYYY-MM-DD)
     - endDate: 結束日期 (YYYY-MM-DD)
+    - format: 'columnar' 時改以平行陣列回傳，日期為相對 baseDate 的日數
     """
     start_date = request.args.get('startDate')
     end_date = request.args.get('endDate')
@@ -164,19 +347,30 @@ def get_data():
             'error': '無法載入資料'
         }), 500
     
-    # 轉換為 JSON 友好格式
-    data = []
-    for _, row in df.iterrows():
-        data.append({
-            'date': row['date'].strftime('%Y-%m-%d'),
-            'close': round(float(row['close']), 2)
+    # 轉換為 JSON 友好格式 (向量化處理日期與四捨五入)
+    days = df['date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+    closes = np.round(df['close'].to_numpy(dtype=np.float64), 2).tolist()
+    start_str, end_str = dates_to_strings(days[[0, -1]])
+    
+    if wants_columnar():
+        return jsonify({
+            'success': True,
+            'format': 'columnar',
+            'count': len(closes),
+            'startDate': start_str,
+            'endDate': end_str,
+            'baseDate': start_str,
+            'dates': (days - days[0]).tolist(),
+            'close': closes
         })
     
+    data = [{'date': d, 'close': c} for d, c in zip(dates_to_strings(days), closes)]
+    
     return jsonify({
         'success': True,
         'count': len(data),
-        'startDate': df.iloc[0]['date'].strftime('%Y-%m-%d'),
-        'endDate': df.iloc[-1]['date'].strftime('%Y-%m-%d'),
+        'startDate': start_str,
+        'endDate': end_str,
         'data': data
     })
 
@@ -191,6 +385,12 @@ def get_market():
     """
     ma_days = request.args.get('maDays', 13, type=int)
     
+    if not 1 <= ma_days <= MAX_MA_DAYS:
+        return jsonify({
+            'success': False,
+            'error': f'maDays 必須介於 1 與 {MAX_MA_DAYS} 之間'
+        }), 400
+    
     df = load_stock_data()
     
     if df is None or df.empty:
@@ -236,8 +436,15 @@ def backtest():
         "fixedLots": 1,
         "useFee": true,
         "buyFee": 35,
-        "sellFee": 35
+        "sellFee": 35,
+        "maxPoints": 1000
     }
+    
+    maxPoints (選填)：以 LTTB 將資金/回撤/指數曲線降採樣至約此點數，
+    此時三條曲線共用頂層的 historyDates，各曲線只回傳 values。
+    
+    ?format=columnar 或 Accept: application/vnd.twstock.columnar+json 時改用欄式格式：
+    交易明細為平行陣列、日期為相對 baseDate 的日數、方向與原因為代碼。
     """
     try:
         params = request.get_json()
@@ -260,11 +467,100 @@ def backtest():
                 'error': '無法載入資料'
             }), 500
         
-        # 執行回測
-        result = run_backtest(df, params)
+        # 執行回測 (未指定結束日期時，沿用快取狀態只計算新增的 K 棒)
+        if wants_columnar():
+            result = run_backtest(df, params, result_format='columnar')
+            metrics.record_bars('full', len(df))
+        elif end_date:
+            result = run_backtest(df, params)
+            metrics.record_bars('full', len(df))
+        else:
+            result = run_backtest_cached(df, params)
+        
+        max_points = params.get('maxPoints')
+        if max_points:
+            result = downsample_result(result, int(max_points))
+        
+        return jsonify(result)
+        
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/backtest/symbols', methods=['POST'])
+def backtest_symbols():
+    """
+    多商品回測
+    
+    所有商品對齊到共同交易日後，以相同策略參數並行回測，回傳各商品績效與等權重合併資金曲線。
+    商品可用字串，或以物件覆寫該商品的參數 (例如個股每點價值)。
+    
+    Request Body (JSON):
+    {
+        "symbols": ["^TWII", "^TWOII", {"symbol": "2330.TW", "pointValue": 1000}],
+        "startDate": "2015-01-01",
+        "endDate": "2026-01-03",
+        "maDays": 20,
+        "tradeMode": "long",
+        "initialCapital": 1000000,
+        "pointValue": 50,
+        "workers": 4
+    }
+    """
+    try:
+        params = request.get_json()
+        
+        if not params or not params.get('symbols'):
+            return jsonify({
+                'success': False,
+                'error': '缺少商品列表'
+            }), 400
+        
+        if len(params['symbols']) > MAX_SYMBOLS:
+            return jsonify({
+                'success': False,
+                'error': f'商品數不可超過 {MAX_SYMBOLS}'
+            }), 400
+        
+        base_params = {k: v for k, v in params.items() if k not in ('symbols', 'workers')}
+        symbols = []
+        params_list = []
+        for item in params['symbols']:
+            overrides = dict(item) if isinstance(item, dict) else {'symbol': item}
+            symbol = validate_symbol(overrides.pop('symbol', None))
+            if symbol in symbols:
+                continue
+            symbols.append(symbol)
+            params_list.append({**base_params, **overrides})
+        
+        # 載入並對齊資料
+        frames = load_symbols(symbols, params.get('startDate', '2015-01-01'), params.get('endDate'))
+        missing = [s for s, df in frames.items() if df is None or df.empty]
+        if missing:
+            return jsonify({
+                'success': False,
+                'error': f"無法載入資料: {', '.join(missing)}"
+            }), 500
+        
+        dates, closes = align_symbols(frames)
+        
+        # 執行多商品回測
+        result = run_backtest_symbols(dates, closes, symbols, params_list, params.get('workers'))
+        metrics.record_bars('full', len(dates) * len(symbols))
         
         return jsonify(result)
         
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+        
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -287,8 +583,11 @@ def optimize():
         "maMax": 60,
         "tradeMode": "long",
         "initialCapital": 1000000,
-        "pointValue": 50
+        "pointValue": 50,
+        "constraints": {"maxDrawdown": 30, "minCapital": 500000}
     }
+
+    constraints 為選填的提前終止條件，違反者標示 pruned 並不列入前三名
     """
     try:
         params = request.get_json()
@@ -299,6 +598,12 @@ def optimize():
                 'error': '缺少參數'
             }), 400
         
+        if int(params.get('maMax', 60)) > MAX_MA_DAYS:
+            return jsonify({
+                'success': False,
+                'error': f'maMax 不可超過 {MAX_MA_DAYS}'
+            }), 400
+        
         # 載入資料
         start_date = params.get('startDate', '2015-01-01')
         end_date = params.get('endDate')
@@ -313,6 +618,267 @@ def optimize():
         
         # 執行優化
         result = optimize_ma(df, params)
+        metrics.record_bars('optimize', len(df) * len(result.get('allResults', [])))
+        
+        return jsonify(result)
+        
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/optimize/grid', methods=['POST'])
+def optimize_grid_search():
+    """
+    平行網格搜尋參數
+    
+    Request Body (JSON):
+    {
+        "startDate": "2015-01-01",
+        "endDate": "2026-01-03",
+        "grid": {
+            "maDays": [5, 10, 20, 60],
+            "tradeMode": ["long", "both"],
+            "dynamicLeverage": [1, 2, 3]
+        },
+        "workers": 4,
+        "sortBy": "totalReturn",
+        "topN": 10,
+        "lotMode": "dynamic",
+        "useDynamicLeverage": true,
+        "initialCapital": 1000000,
+        "pointValue": 50,
+        "constraints": {"maxDrawdown": 30}
+    }
+
+    不影響結果的參數 (enableRebalance、rebalancePeriod) 不展開，列於 ignoredParams；
+    組合數上限為 GRID_MAX_CONFIGS，workers 不超過 CPU 核心數
+    """
+    try:
+        params = request.get_json()
+        
+        if not params or not params.get('grid'):
+            return jsonify({
+                'success': False,
+                'error': '缺少參數網格'
+            }), 400
+        
+        if grid_size(params['grid']) > GRID_MAX_CONFIGS:
+            return jsonify({
+                'success': False,
+                'error': f'參數組合數不可超過 {GRID_MAX_CONFIGS}'
+            }), 400
+        
+        # 載入資料
+        start_date = params.get('startDate', '2015-01-01')
+        end_date = params.get('endDate')
+        
+        df = load_stock_data(start_date, end_date)
+        
+        if df is None or df.empty:
+            return jsonify({
+                'success': False,
+                'error': '無法載入資料'
+            }), 500
+        
+        # 執行網格搜尋
+        result = optimize_grid(df, params)
+        metrics.record_bars('grid', len(df) * result.get('evaluated', 0))
+        
+        return jsonify(result)
+        
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/optimize/adaptive', methods=['POST'])
+def optimize_adaptive_search():
+    """
+    自適應參數搜尋 (successive halving)
+    
+    Request Body (JSON):
+    {
+        "startDate": "2015-01-01",
+        "endDate": "2026-01-03",
+        "space": {
+            "maDays": {"min": 2, "max": 500},
+            "tradeMode": ["long", "both"],
+            "dynamicLeverage": [1, 2, 3, 4, 5]
+        },
+        "budget": 1000,
+        "eta": 3,
+        "seed": 42,
+        "sortBy": "totalReturn",
+        "topN": 10,
+        "lotMode": "dynamic",
+        "useDynamicLeverage": true,
+        "initialCapital": 1000000,
+        "pointValue": 50
+    }
+
+    不影響結果的參數 (enableRebalance、rebalancePeriod) 不抽樣，列於 ignoredParams
+    """
+    try:
+        params = request.get_json()
+        
+        if not params or not params.get('space'):
+            return jsonify({
+                'success': False,
+                'error': '缺少參數空間'
+            }), 400
+        
+        # 載入資料
+        start_date = params.get('startDate', '2015-01-01')
+        end_date = params.get('endDate')
+        
+        df = load_stock_data(start_date, end_date)
+        
+        if df is None or df.empty:
+            return jsonify({
+                'success': False,
+                'error': '無法載入資料'
+            }), 500
+        
+        # 執行自適應搜尋
+        result = optimize_adaptive(df, params)
+        metrics.record_bars('adaptive', result.get('barsEvaluated', 0))
+        
+        return jsonify(result)
+        
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/heatmap', methods=['POST'])
+def heatmap():
+    """
+    雙參數敏感度熱圖
+    
+    兩個參數軸的所有組合以批次引擎一次計算，回傳 y 為列、x 為欄的
+    totalReturn / maxDrawdown / tradeCount 矩陣。
+    
+    Request Body (JSON):
+    {
+        "startDate": "2015-01-01",
+        "endDate": "2026-01-03",
+        "xAxis": {"param": "maDays", "min": 5, "max": 120, "step": 5},
+        "yAxis": {"param": "dynamicLeverage", "values": [1, 2, 3, 4, 5]},
+        "tradeMode": "long",
+        "lotMode": "dynamic",
+        "useDynamicLeverage": true,
+        "initialCapital": 1000000,
+        "pointValue": 50
+    }
+    """
+    try:
+        params = request.get_json()
+        
+        if not params or not params.get('xAxis') or not params.get('yAxis'):
+            return jsonify({
+                'success': False,
+                'error': '缺少參數軸'
+            }), 400
+        
+        for key in ('xAxis', 'yAxis'):
+            if params[key].get('param') in NO_EFFECT_PARAMS:
+                return jsonify({
+                    'success': False,
+                    'error': f"{params[key]['param']} 目前不影響回測結果，不可作為參數軸"
+                }), 400
+        
+        # 載入資料
+        start_date = params.get('startDate', '2015-01-01')
+        end_date = params.get('endDate')
+        
+        df = load_stock_data(start_date, end_date)
+        
+        if df is None or df.empty:
+            return jsonify({
+                'success': False,
+                'error': '無法載入資料'
+            }), 500
+        
+        # 一次計算所有格子
+        result = sensitivity_heatmap(df, params)
+        if result['success']:
+            metrics.record_bars('grid', len(df) * len(result['x']['values']) * len(result['y']['values']))
+        
+        return jsonify(result)
+        
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/optimize/walkforward', methods=['POST'])
+def optimize_walk_forward():
+    """
+    Walk-forward 均線優化
+    
+    Request Body (JSON):
+    {
+        "startDate": "2010-01-01",
+        "endDate": "2026-01-03",
+        "maMin": 5,
+        "maMax": 60,
+        "trainBars": 756,
+        "testBars": 252,
+        "sortBy": "totalReturn",
+        "workers": 4,
+        "tradeMode": "long",
+        "initialCapital": 1000000,
+        "pointValue": 50
+    }
+
+    testBars 不可小於 MIN_TEST_BARS，workers 不超過 CPU 核心數
+    """
+    try:
+        params = request.get_json() or {}
+        
+        if int(params.get('maMax', 60)) > MAX_MA_DAYS:
+            return jsonify({
+                'success': False,
+                'error': f'maMax 不可超過 {MAX_MA_DAYS}'
+            }), 400
+        
+        if int(params.get('testBars', 252)) < MIN_TEST_BARS:
+            return jsonify({
+                'success': False,
+                'error': f'testBars 不可小於 {MIN_TEST_BARS}'
+            }), 400
+        
+        # 載入資料
+        start_date = params.get('startDate', '2010-01-01')
+        end_date = params.get('endDate')
+        
+        df = load_stock_data(start_date, end_date)
+        
+        if df is None or df.empty:
+            return jsonify({
+                'success': False,
+                'error': '無法載入資料'
+            }), 500
+        
+        # 執行 walk-forward
+        result = walk_forward(df, params)
         
         return jsonify(result)
         
@@ -325,6 +891,111 @@ def optimize():
         }), 500
 
 
+@app.route('/api/montecarlo', methods=['POST'])
+def montecarlo():
+    """
+    Monte Carlo 資產路徑模擬
+    
+    先以回測參數執行回測，再由資金曲線的日報酬率重抽樣模擬。
+    
+    Request Body (JSON):
+    {
+        "startDate": "2015-01-01",
+        "endDate": "2026-01-03",
+        "maDays": 13,
+        "tradeMode": "long",
+        "initialCapital": 1000000,
+        "pointValue": 50,
+        "monteCarlo": {
+            "rounds": 500,
+            "seed": 42,
+            "blockSize": 1,
+            "percentiles": [5, 25, 50, 75, 95],
+            "maxPoints": 200,
+            "samplePaths": 50,
+            "removeLowPct": 5,
+            "removeHighPct": 5,
+            "bins": 10
+        }
+    }
+    """
+    try:
+        params = request.get_json()
+        
+        if not params:
+            return jsonify({
+                'success': False,
+                'error': '缺少參數'
+            }), 400
+        
+        # 模擬規模上限，在載入資料與回測之前檢查，避免單一請求佔用過久或回傳過大
+        mc_params = params.get('monteCarlo') or {}
+        if int(mc_params.get('rounds', 500)) > MAX_MC_ROUNDS:
+            return jsonify({
+                'success': False,
+                'error': f'模擬次數不可超過 {MAX_MC_ROUNDS}'
+            }), 400
+        if int(mc_params.get('samplePaths', 0)) > MC_MAX_SAMPLE_PATHS:
+            return jsonify({
+                'success': False,
+                'error': f'samplePaths 不可超過 {MC_MAX_SAMPLE_PATHS}'
+            }), 400
+        
+        # 載入資料
+        start_date = params.get('startDate', '2015-01-01')
+        end_date = params.get('endDate')
+        
+        df = load_stock_data(start_date, end_date)
+        
+        if df is None or df.empty:
+            return jsonify({
+                'success': False,
+                'error': '無法載入資料'
+            }), 500
+        
+        # 回測取得資金曲線 (模擬參數不影響回測，不納入回測快取鍵)
+        bt_params = {k: v for k, v in params.items() if k != 'monteCarlo'}
+        
+        if end_date:
+            result = run_backtest(df, bt_params)
+            metrics.record_bars('full', len(df))
+        else:
+            result = run_backtest_cached(df, bt_params)
+        
+        if not result.get('success'):
+            return jsonify(result)
+        
+        history = result['capitalHistory']
+        
+        return jsonify(monte_carlo(history['values'], mc_params, dates=history['dates']))
+        
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/cache', methods=['GET'])
+def cache_stats():
+    """指標快取命中/未命中統計"""
+    return jsonify({
+        'success': True,
+        'dataVersion': _data_version,
+        'indicators': indicator_cache.stats()
+    })
+
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 文字格式的監控指標 (gunicorn 多 worker 時彙總所有 worker)"""
+    content, content_type = metrics.render()
+    return Response(content, content_type=content_type)
+
+
 if __name__ == '__main__':
     print("=" * 50)
     print("Taiwan Stock Backtesting API Server")
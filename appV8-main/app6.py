@@ -4,6 +4,13 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
 import os
+import sys
+
+# 共用上層目錄的回撤分析模組
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from drawdown import underwater_curve, period_max_drawdown
+from backtest_engine import daily_returns, monte_carlo_chunks
+from binary_cache import migrate_cache, read_cache, refresh_start, update_cache
 
 # 確保中文字體顯示正常
 plt.rcParams['font.family'] = 'Microsoft JhengHei'
@@ -94,7 +101,9 @@ st.title("📈 台股加權指數回測系統")
 # 【🚨 檔案讀取修改區塊：優先從本地讀取 🚨】
 # 【🚨 檔案讀取修改區塊：新增資料來源選擇 🚨】
 DATA_FILE = '加權指數資料.xlsx'
-CACHE_FILE = '加權指數快取.xlsx'  # 快取檔案
+CACHE_FILE = '加權指數快取.npy'  # 快取檔案 (.npy 二進位，可 mmap 開啟)
+LEGACY_CACHE_FILE = '加權指數快取.xlsx'  # 舊版 Excel 快取，第一次執行時轉為 .npy
+migrate_cache(CACHE_FILE, [LEGACY_CACHE_FILE])
 data_source = None
 df = None
 
@@ -114,8 +123,12 @@ if data_source_option == "Yahoo Finance (預設即時更新)":
     yahoo_success = False
     
     try:
-        # 下載資料，使用較長區間確保足夠
-        df_yahoo = yf.download('^TWII', period='20y')
+        # 已有快取時只下載最後快取日之後的資料 (含少量重疊以取得修正後的收盤價)，否則下載完整區間
+        start = refresh_start(CACHE_FILE)
+        if start:
+            df_yahoo = yf.download('^TWII', start=start)
+        else:
+            df_yahoo = yf.download('^TWII', period='20y')
         
         if not df_yahoo.empty:
             df_yahoo = df_yahoo.reset_index()
@@ -130,12 +143,20 @@ if data_source_option == "Yahoo Finance (預設即時更新)":
                 data_source = "Yahoo Finance"
                 yahoo_success = True
                 
-                # 🔹 儲存快取
+                # 🔹 合併進快取，再從快取讀出完整區間
                 try:
-                    df.to_excel(CACHE_FILE, index=False)
-                    st.success(f"✅ 成功下載最新資料並已快取！（資料截至 {df['日期'].max().strftime('%Y-%m-%d')}）")
+                    _, added, _ = update_cache(CACHE_FILE, df['日期'], df['收盤價'])
+                    cache_dates, cache_close = read_cache(CACHE_FILE)
+                    df = pd.DataFrame({'日期': cache_dates, '收盤價': cache_close})
+                    st.success(f"✅ 成功下載最新資料並已快取！（新增 {added} 筆，資料截至 {df['日期'].max().strftime('%Y-%m-%d')}）")
                 except Exception as cache_err:
-                    st.success("成功下載最新資料！（快取儲存失敗）")
+                    if start:
+                        # 只下載了尾段，快取無法合併時無法取得完整區間
+                        st.warning(f"⚠️ 快取更新失敗 ({cache_err})，嘗試讀取本地快取...")
+                        yahoo_success = False
+                        df = None
+                    else:
+                        st.success("成功下載最新資料！（快取儲存失敗）")
             else:
                 st.error("下載資料格式不如預期，找不到 Date 或 Close 欄位。")
         else:
@@ -147,8 +168,8 @@ if data_source_option == "Yahoo Finance (預設即時更新)":
     if not yahoo_success:
         if os.path.exists(CACHE_FILE):
             try:
-                df = pd.read_excel(CACHE_FILE)
-                df.columns = ['日期', '收盤價']
+                cache_dates, cache_close = read_cache(CACHE_FILE)
+                df = pd.DataFrame({'日期': cache_dates, '收盤價': cache_close})
                 data_source = f"本地快取 ({CACHE_FILE})"
                 cache_date = df['日期'].max()
                 st.info(f"📂 已從本地快取讀取資料（快取日期：{cache_date.strftime('%Y-%m-%d')}）")
@@ -161,10 +182,13 @@ if data_source_option == "Yahoo Finance (預設即時更新)":
         
 else:
     # 2. 顯示上傳按鈕
-    uploaded_file = st.file_uploader("請上傳加權指數Excel檔案 (格式：日期, 收盤價)", type=["xlsx"])
+    uploaded_file = st.file_uploader("請上傳加權指數Excel或CSV檔案 (格式：日期, 收盤價)", type=["xlsx", "csv"])
     if uploaded_file:
         try:
-            df = pd.read_excel(uploaded_file)
+            if uploaded_file.name.lower().endswith('.csv'):
+                df = pd.read_csv(uploaded_file)
+            else:
+                df = pd.read_excel(uploaded_file)
             data_source = uploaded_file.name
         except Exception as e:
             st.error(f"讀取上傳檔案失敗: {e}")
@@ -983,20 +1007,9 @@ if data_source and df is not None and not df.empty:
     # 確保 df_capital 存在且有資料
     if 'df_capital' in locals() and not df_capital.empty:
         df_capital['年份'] = pd.to_datetime(df_capital['日期']).dt.year
-        yearly_mdd_list = []
-        for year, group in df_capital.groupby('年份'):
-            values = group['資金'].values
-            if len(values) < 2:
-                mdd = 0
-            else:
-                # 累積高點
-                cummax = np.maximum.accumulate(values)
-                # 回撤率
-                drawdowns = 1 - values / cummax
-                # 每年最大回撤率 (比率)
-                mdd = np.max(drawdowns) 
-            yearly_mdd_list.append({'年份': year, '最大回撤率 (%)': round(mdd * 100, 2)})
-        mdd_df = pd.DataFrame(yearly_mdd_list)
+        # 各年度內的最大回撤 (向量化計算，高點於每年年初重新累計)
+        years, yearly_mdd = period_max_drawdown(df_capital['資金'].values, df_capital['年份'].values)
+        mdd_df = pd.DataFrame({'年份': years, '最大回撤率 (%)': np.round(yearly_mdd, 2)})
         st.dataframe(mdd_df, use_container_width=True)
         st.caption("表格顯示的是**各年度內**，資金從年度最高點跌落到最低點的最大百分比損失。")
     else:
@@ -1123,11 +1136,9 @@ if data_source and df is not None and not df.empty:
         if capital_history:
             capital_arr_mdd = np.array(capital_history)
             
-            # 累積高點：找出從開始到每一天為止資金的最高點
-            peak_mdd = np.maximum.accumulate(capital_arr_mdd) 
-            
-            # 回撤率： (累積高點 - 當前資金) / 累積高點
-            drawdowns_mdd = 1 - capital_arr_mdd / peak_mdd
+            # 累積高點與回撤率： (累積高點 - 當前資金) / 累積高點
+            drawdowns_pct, peak_mdd = underwater_curve(capital_arr_mdd)
+            drawdowns_mdd = drawdowns_pct / 100
             
             # 最大回撤率 (比率)：整個回測期間最大的回撤百分比
             max_dd_ratio = np.max(drawdowns_mdd)
@@ -1226,37 +1237,31 @@ if data_source and df is not None and not df.empty:
         st.markdown("<div class='data-card'>", unsafe_allow_html=True)
         st.markdown("<h2 class='card-header'><span>🔀</span> Monte Carlo 模擬資產路徑</h2>", unsafe_allow_html=True)
         
-        np.random.seed(mc_seed)
         capital_arr = np.array(capital_history)
         
-        # 策略日報酬率：避免除以零
-        # 修正：確保分母不為零，且日報酬率的長度是 N-1
-        capital_arr_safe = capital_arr[:-1].copy()
-        capital_arr_safe[capital_arr_safe == 0] = 1 # 避免除以 0，但這情況極少發生
-        returns = np.diff(capital_arr) / capital_arr_safe
+        # 策略日報酬率 (長度 N-1，分母為 0 時以 1 代替)
+        returns = daily_returns(capital_arr)
         
         if len(returns) > 0:
-            sim_days = len(returns)
             sim_rounds = mc_sim_round
-            sim_results = []
+            final_assets = np.empty(sim_rounds)
+            sample_paths = []
             
-            # 使用進度條顯示模擬進度
+            # 由回測引擎分批產生路徑 (從 start_capital 開始累積)，只保留最終資產與繪圖用的前 50 條路徑
             mc_bar = st.progress(0)
-            for i in range(sim_rounds):
-                # 隨機重抽樣歷史報酬率
-                rand_returns = np.random.choice(returns, sim_days, replace=True)
-                # 計算累積資產路徑 (從 start_capital 開始累積)
-                path = start_capital * np.cumprod(1 + rand_returns)
-                sim_results.append(path)
-                mc_bar.progress((i + 1) / sim_rounds)
+            done = 0
+            for paths in monte_carlo_chunks(returns, sim_rounds, start_capital, seed=int(mc_seed)):
+                final_assets[done:done + len(paths)] = paths[:, -1]
+                if len(sample_paths) < 50:
+                    sample_paths.extend(paths[:50 - len(sample_paths)])
+                done += len(paths)
+                mc_bar.progress(done / sim_rounds)
             mc_bar.empty()
             
-            sim_results = np.array(sim_results)
-            
             # 畫出部分模擬路徑
             fig, ax = plt.subplots(figsize=(14, 6))
-            for i in range(min(50, sim_results.shape[0])):
-                ax.plot(sim_results[i], color='grey', alpha=0.2)
+            for path in sample_paths:
+                ax.plot(path, color='grey', alpha=0.2)
             
             # 實際資金曲線的長度是 N，模擬路徑是 N-1，因此需要調整 X 軸
             ax.plot(range(len(capital_arr)), capital_arr, color='blue', linewidth=2, label='實際資金曲線')
@@ -1268,7 +1273,6 @@ if data_source and df is not None and not df.empty:
             st.caption("圖中藍線為實際回測的資金成長曲線，灰色線為根據歷史日報酬率隨機抽樣模擬出的資產成長路徑，用於評估策略在不同情境下的穩健性。")
     
             # 百分位區間過濾 + 分箱
-            final_assets = sim_results[:, -1]
             lower = np.percentile(final_assets, remove_low_pct)
             upper = np.percentile(final_assets, 100 - remove_high_pct)
             mask = (final_assets >= lower) & (final_assets <= upper)
@@ -5,390 +5,3010 @@ Taiwan Stock Backtesting Engine
 
 import pandas as pd
 import numpy as np
+import bisect
+import itertools
+import math
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
+from drawdown import underwater_curve, analyze_drawdowns
+from profiling import span, timed
+
+
+# ====================================
+# 指標快取
+# ====================================
+
+INDICATOR_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 預設記憶體上限 64 MB
+
+
+class IndicatorCache:
+    """
+    以 (資料版本, 欄位, 視窗) 為鍵的指標快取
+
+    依最近使用順序 (LRU) 淘汰，總佔用位元組數不超過 max_bytes。
+    資料版本改變時 (load_stock_data 重新整理快取檔) 會清除舊版本的項目。
+    若設定 listener，每次 hit / miss / eviction / invalidation 會以事件名稱呼叫 (例如匯出監控指標)。
+    """
+
+    def __init__(self, max_bytes=INDICATOR_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.listener = None
+
+    def _notify(self, event, count=1):
+        """通知 listener (於鎖外呼叫)"""
+        if self.listener is not None and count:
+            self.listener(event, count)
+
+    def get_or_compute(self, key, compute):
+        """取得快取值；未命中時呼叫 compute() 計算並存入"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if value is not None:
+            self._notify('hit')
+            return value
+        self._notify('miss')
+
+        value = compute()
+        value.setflags(write=False)
+
+        evictions = 0
+        with self._lock:
+            if key not in self._entries and value.nbytes <= self.max_bytes:
+                self._entries[key] = value
+                self._bytes += value.nbytes
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= evicted.nbytes
+                    evictions += 1
+            self.evictions += evictions
+        self._notify('eviction', evictions)
+        return value
+
+    def invalidate(self, keep_version=None):
+        """清除快取；若指定 keep_version，僅保留該資料版本的項目"""
+        with self._lock:
+            for key in list(self._entries):
+                if keep_version is None or key[0][0] != keep_version:
+                    self._bytes -= self._entries.pop(key).nbytes
+            self.invalidations += 1
+        self._notify('invalidation')
+
+    def configure(self, max_bytes):
+        """調整記憶體上限，必要時立即淘汰"""
+        evictions = 0
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                evictions += 1
+            self.evictions += evictions
+        self._notify('eviction', evictions)
+
+    def stats(self):
+        """命中/未命中等統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / total * 100, 1) if total else 0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+indicator_cache = IndicatorCache()
+
+
+def dataset_key(df):
+    """
+    資料集識別鍵
+
+    優先使用 load_stock_data 設定的 df.attrs['dataVersion']，
+    並加上起訖日期與筆數以區分同一版本的不同日期區間；
+    沒有版本資訊時改用內容雜湊。
+    """
+    if len(df) == 0:
+        return ('empty', 0)
+
+    span = (str(df['date'].iloc[0]), str(df['date'].iloc[-1]), len(df))
+    version = df.attrs.get('dataVersion')
+    if version is None:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(df['date'].to_numpy().astype('datetime64[ns]').tobytes())
+        digest.update(df['close'].to_numpy(dtype=np.float64).tobytes())
+        version = 'hash:' + digest.hexdigest()
+    return (version, span)
+
+
+@timed('ma')
+def cached_rolling_mean(df, days, column='close'):
+    """
+    取得快取的移動平均陣列 (唯讀)
+
+    Returns:
+    --------
+    ndarray: 與 df 等長的移動平均值
+    """
+    key = (dataset_key(df), column, days)
+    return indicator_cache.get_or_compute(
+        key, lambda: df[column].rolling(window=days).mean().to_numpy(dtype=np.float64)
+    )
+
 
 def calculate_ma(df, days):
     """計算移動平均線"""
+    ma = cached_rolling_mean(df, days)
     df = df.copy()
-    df[f'MA{days}'] = df['close'].rolling(window=days).mean()
+    df[f'MA{days}'] = ma
     return df
 
 
+@timed('ma')
+def ma_matrix(close, windows):
+    """
+    以單一累積和陣列一次計算多個視窗的移動平均
+
+    Parameters:
+    -----------
+    close : ndarray
+        收盤價
+    windows : sequence of int
+        均線天數列表
+
+    Returns:
+    --------
+    ndarray: shape (len(windows), len(close))，均線尚未成形處為 NaN
+    """
+    close = np.asarray(close, dtype=np.float64)
+    windows = np.asarray(windows, dtype=np.int64)
+    n = len(close)
+    if n == 0:
+        return np.empty((len(windows), 0))
+
+    # 先扣除基準價再累加，降低長序列累積和的浮點誤差
+    base = close[0]
+    csum = np.concatenate(([0.0], np.cumsum(close - base)))
+
+    end = np.arange(1, n + 1)
+    start = end[None, :] - windows[:, None]
+    valid = start >= 0
+    sums = csum[end][None, :] - csum[np.where(valid, start, 0)]
+
+    result = sums / windows[:, None] + base
+    result[~valid] = np.nan
+    return result
+
+
+@timed('mdd')
 def calculate_mdd(capital_history):
     """計算最大回撤 (Maximum Drawdown)"""
-    if not capital_history or len(capital_history) < 2:
+    if capital_history is None or len(capital_history) < 2:
         return 0, []
     
-    values = np.array(capital_history)
-    cummax = np.maximum.accumulate(values)
-    drawdowns = (cummax - values) / cummax * 100
+    drawdowns, _ = underwater_curve(capital_history)
     mdd = np.max(drawdowns)
     
     return mdd, drawdowns.tolist()
 
 
-def run_backtest(df, params):
+def prepare_arrays(df, ma_days):
+    """
+    將股價資料轉為回測核心使用的連續陣列
+
+    Parameters:
+    -----------
+    df : DataFrame
+        包含 'date' 和 'close' 欄位的股價資料
+    ma_days : int
+        均線天數
+
+    Returns:
+    --------
+    tuple: (close, ma, dates)，close/ma 為 float64，dates 為 int64 (epoch 日數)，
+           已去除均線尚未成形的前段資料
+    """
+    ma = cached_rolling_mean(df, ma_days)
+    close = df['close'].to_numpy(dtype=np.float64)
+    dates = df['date'].to_numpy()
+
+    # 等同 dropna()：去除均線尚未成形或收盤價缺值的資料
+    valid = ~(np.isnan(ma) | np.isnan(close) | pd.isna(dates))
+
+    close = np.ascontiguousarray(close[valid])
+    ma = np.ascontiguousarray(ma[valid])
+    dates = np.ascontiguousarray(dates[valid].astype('datetime64[D]').astype(np.int64))
+    return close, ma, dates
+
+
+def price_arrays(df):
+    """
+    取出完整價格序列 (不計算均線)
+
+    Returns:
+    --------
+    tuple: (close, dates)，依日期排序並去除缺值
+    """
+    df = df.dropna(subset=['close']).sort_values('date')
+    close = np.ascontiguousarray(df['close'].to_numpy(dtype=np.float64))
+    dates = np.ascontiguousarray(df['date'].to_numpy().astype('datetime64[D]').astype(np.int64))
+    return close, dates
+
+
+def dates_to_months(dates):
+    """epoch 日數轉為月份 (1-12)"""
+    return dates.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64) % 12 + 1
+
+
+def dates_to_strings(dates):
+    """epoch 日數轉為 'YYYY-MM-DD' 字串列表"""
+    return np.datetime_as_string(dates.astype('datetime64[D]'), unit='D').tolist()
+
+
+def resolve_config(params):
+    """
+    解析回測參數
+
+    Parameters:
+    -----------
+    params : dict
+        回測參數 (欄位同 run_backtest)
+
+    Returns:
+    --------
+    dict: 回測核心使用的設定
+    """
+    trade_mode = params.get('tradeMode', 'long')  # 'long', 'short', 'both'
+    if trade_mode not in ('long', 'short', 'both'):
+        trade_mode = 'long'
+
+    lot_mode = params.get('lotMode', 'dynamic')  # 'fixed' or 'dynamic'
+
+    # 確定實際使用的槓桿
+    if lot_mode == 'fixed':
+        leverage = params.get('fixedLeverage', 1) if params.get('useFixedLeverage', True) else 1
+    else:
+        leverage = params.get('dynamicLeverage', 2) if params.get('useDynamicLeverage', False) else 1
+
+    return {
+        'ma_days': params.get('maDays', 13),
+        'trade_mode': trade_mode,
+        'initial_capital': params.get('initialCapital', 1000000),
+        'monthly_add': params.get('monthlyAdd', 0),
+        'leverage': leverage,
+        'enable_rebalance': params.get('enableRebalance', True),
+        'rebalance_period': params.get('rebalancePeriod', 1),  # 月
+        'point_value': params.get('pointValue', 50),  # 小台每點 50 元
+        'use_fee': params.get('useFee', True),
+        'buy_fee': params.get('buyFee', 35),
+        'sell_fee': params.get('sellFee', 35),
+        'fixed_lots': params.get('fixedLots', 1),
+        'lot_mode': lot_mode,
+        # 逆價差補償參數
+        'enable_backwardation': params.get('enableBackwardation', False),
+        'backwardation_rate': params.get('backwardationRate', 4),  # 年化百分比
+    }
+
+
+# 目前不影響回測結果的參數：原始迴圈的再平衡條件永遠不成立 (見 _simulate)，
+# 參數搜尋時以這些參數為維度只會產生完全相同的結果
+NO_EFFECT_PARAMS = ('enableRebalance', 'rebalancePeriod')
+
+# 提前終止原因代碼
+PRUNE_REASONS = ('maxDrawdown', 'minCapital')
+
+
+def resolve_constraints(params):
+    """
+    解析參數優化的提前終止條件
+
+    params['constraints'] 可包含:
+    - maxDrawdown: 最大回撤上限 (百分比，正負號皆可)，超過即停止模擬
+    - minCapital: 資金下限，低於即停止模擬
+
+    Returns:
+    --------
+    tuple: (max_drawdown, min_capital)，未設定者為 None；皆未設定時回傳 None
+    """
+    constraints = params.get('constraints') or {}
+    max_drawdown = constraints.get('maxDrawdown')
+    min_capital = constraints.get('minCapital')
+    if max_drawdown is None and min_capital is None:
+        return None
+    return (
+        abs(float(max_drawdown)) if max_drawdown is not None else None,
+        float(min_capital) if min_capital is not None else None
+    )
+
+
+class BacktestState:
+    """
+    可序列化的回測狀態
+
+    保存回測迴圈在最後一根 K 棒之後的所有變數、均線視窗與績效累計值，
+    讓既有結果可透過 advance() 只針對新增的 K 棒繼續推進。
+    """
+
+    FIELDS = (
+        'params', 'capital', 'position', 'entry_price', 'entry_date', 'current_lots',
+        'last_month', 'last_date', 'last_close', 'ma_window', 'first_date',
+        'peak_capital', 'max_drawdown', 'trade_count', 'win_count', 'bar_count'
+    )
+
+    def __init__(self, params, **values):
+        self.params = dict(params)
+        self.capital = values.get('capital', 0)
+        self.position = values.get('position', 0)  # 1 = 多, -1 = 空, 0 = 空手
+        self.entry_price = values.get('entry_price', 0.0)
+        self.entry_date = values.get('entry_date', 0)  # epoch 日數
+        self.current_lots = values.get('current_lots', 0)
+        self.last_month = values.get('last_month', 0)
+        self.last_date = values.get('last_date', 0)  # epoch 日數
+        self.last_close = values.get('last_close', 0.0)
+        self.ma_window = list(values.get('ma_window', []))  # 最近 maDays 根收盤價
+        self.first_date = values.get('first_date', 0)
+        self.peak_capital = values.get('peak_capital', 0)
+        self.max_drawdown = values.get('max_drawdown', 0.0)
+        self.trade_count = values.get('trade_count', 0)
+        self.win_count = values.get('win_count', 0)
+        self.bar_count = values.get('bar_count', 0)
+
+    def to_dict(self):
+        """轉為可 JSON 序列化的 dict"""
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        """由 to_dict() 的結果還原"""
+        values = {k: v for k, v in data.items() if k != 'params'}
+        return cls(data['params'], **values)
+
+
+# 交易帳本欄位：日期為 epoch 日數，方向 1 = 多 / -1 = 空，fee 與 profit 為整筆交易的手續費與毛損益
+TRADE_DTYPE = np.dtype([
+    ('entry_day', np.int64),
+    ('exit_day', np.int64),
+    ('direction', np.int8),
+    ('lots', np.int64),
+    ('entry_price', np.float64),
+    ('exit_price', np.float64),
+    ('fee', np.float64),
+    ('profit', np.float64),
+    ('capital', np.float64)
+])
+
+
+class TradeLedger:
+    """
+    交易帳本
+
+    以預先配置的結構化陣列保存交易紀錄，容量不足時加倍。
+    迴圈中只寫入原始數值，四捨五入與日期格式化留到輸出時以欄為單位處理。
+    """
+
+    __slots__ = ('_rows', '_size')
+
+    def __init__(self, capacity=64):
+        self._rows = np.empty(max(int(capacity), 1), dtype=TRADE_DTYPE)
+        self._size = 0
+
+    def append(self, entry_day, exit_day, direction, lots, entry_price, exit_price, fee, profit, capital):
+        """新增一筆交易"""
+        if self._size == len(self._rows):
+            rows = np.empty(len(self._rows) * 2, dtype=TRADE_DTYPE)
+            rows[:self._size] = self._rows
+            self._rows = rows
+        self._rows[self._size] = (entry_day, exit_day, direction, lots, entry_price,
+                                  exit_price, fee, profit, capital)
+        self._size += 1
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def rows(self):
+        """已寫入的交易 (結構化陣列視圖)"""
+        return self._rows[:self._size]
+
+    def pnl(self):
+        """每筆交易的淨損益 (毛損益 - 手續費)"""
+        rows = self.rows
+        return rows['profit'] - rows['fee']
+
+    def win_count(self):
+        """獲利筆數：與交易明細一致，以四捨五入至小數 2 位後的損益判斷"""
+        return int(np.count_nonzero(np.round(self.pnl(), 2) > 0))
+
+
+# 事件之間的 K 棒數達此值時改以 NumPy 累加，較短的區段逐根累加較快
+EVENT_VECTOR_MIN_BARS = 32
+
+
+def crossover_events(close, ma, trade_mode, position=0):
+    """
+    均線交叉事件索引
+
+    以 close - ma 的正負號 (與逐根判斷的 action 相同) 決定每根 K 棒收盤後的持倉：
+    持倉等於最近一個非 0 正負號依交易模式對應的方向 (long 只取多方、short 只取空方、
+    both 兩者皆取)，尚未出現非 0 正負號前維持起始持倉。
+    持倉改變的 K 棒即為進場、出場或換倉事件，與資金無關，可一次算出。
+
+    Parameters:
+    -----------
+    close, ma : ndarray
+        收盤價與均線 (第 0 根視為已處理的起點)
+    trade_mode : str
+        'long', 'short' 或 'both'
+    position : int
+        起始持倉
+
+    Returns:
+    --------
+    tuple: (events, signs)，事件 K 棒索引與該 K 棒的正負號 (list)
+    """
+    n = len(close)
+    if n < 2:
+        return [], []
+
+    diff = close - ma
+    sign = (diff > 0).astype(np.int8) - (diff < 0).astype(np.int8)
+    sign[0] = 0
+
+    # 最近一個非 0 正負號 (向前填補)，尚未出現者為 0
+    last = np.maximum.accumulate(np.where(sign != 0, np.arange(n), 0))
+    latest = sign[last]
+
+    if trade_mode == 'long':
+        held = np.where(latest > 0, 1, np.where(latest < 0, 0, position))
+    elif trade_mode == 'short':
+        held = np.where(latest < 0, -1, np.where(latest > 0, 0, position))
+    else:
+        held = np.where(latest != 0, latest, position)
+    held[0] = position
+
+    events = np.flatnonzero(held[1:] != held[:-1]) + 1
+    return events.tolist(), sign[events].tolist()
+
+
+@timed('simulate')
+def _simulate(close, ma, months, dates, cfg, state=None):
+    """
+    回測核心 (事件驅動)
+
+    進出場只發生在收盤價與均線的正負號改變處：先以 crossover_events 一次找出所有事件，
+    兩事件之間的資金只受每日損益、逆價差補償與每月定期投入影響，
+    以累加 (依原本逐日的加法順序，結果與逐根計算完全相同) 一次求出，
+    只在事件 K 棒執行進出場邏輯。
+    第 0 根 K 棒視為已處理完畢的起點；若提供 state，則由 state 的變數接續推進，
+    結束時將迴圈變數寫回 state。
+    注意：原始迴圈在再平衡判斷前就已更新 last_month，因此再平衡條件永遠不成立；
+    為維持結果一致，此處同樣不執行再平衡。
+    cfg 含 'constraints' (resolve_constraints 的結果) 時，違反條件的 K 棒即停止模擬，
+    資金曲線只到該 K 棒為止。
+
+    Returns:
+    --------
+    tuple: (capital_history, trades)
+        capital_history 為每日資金 list，trades 為 TradeLedger
+    """
+    closes = close.tolist()
+    days = dates.tolist()
+    n = len(closes)
+
+    trade_mode = cfg['trade_mode']
+    monthly_add = cfg['monthly_add']
+    leverage = cfg['leverage']
+    point_value = cfg['point_value']
+    use_fee = cfg['use_fee']
+    buy_fee = cfg['buy_fee']
+    sell_fee = cfg['sell_fee']
+    fixed_lots = cfg['fixed_lots']
+    dynamic_lots = cfg['lot_mode'] != 'fixed'
+    apply_backwardation = cfg['enable_backwardation'] and cfg['backwardation_rate'] > 0
+    # 年化收益率轉為每日收益率 (假設一年約 252 個交易日)
+    daily_backwardation_rate = cfg['backwardation_rate'] / 100 / 252
+
+    if state is None:
+        capital = cfg['initial_capital']
+        position = 0  # 1 = 多, -1 = 空, 0 = 空手
+        entry_price = 0.0
+        entry_date = days[0]
+        current_lots = 0
+    else:
+        capital = state.capital
+        position = state.position
+        entry_price = state.entry_price
+        entry_date = state.entry_date
+        current_lots = state.current_lots
+
+    capital_history = [capital] * n
+    trades = TradeLedger()
+
+    # 每月定期投入 (換月的 K 棒)
+    month_add = np.zeros(n)
+    if monthly_add > 0 and n > 1:
+        month_add[1:] = np.where(months[1:] != months[:-1], monthly_add, 0.0)
+    month_adds = month_add.tolist()
+    month_starts = np.flatnonzero(month_add).tolist()
+
+    events, event_signs = crossover_events(close, ma, trade_mode, position)
+
+    # 提前終止條件
+    constraints = cfg.get('constraints')
+    if constraints is not None:
+        stop_drawdown, stop_capital = constraints
+        if stop_drawdown is None:
+            stop_drawdown = float('inf')
+        if stop_capital is None:
+            stop_capital = float('-inf')
+        peak = capital
+    last = n - 1
+
+    i = 1
+    # 最後加上序列長度作為結尾區段 (無事件)
+    for event, event_sign in zip(events + [n], event_signs + [0]):
+        end = event if event < n else n - 1
+        if end < i:
+            break
+
+        # ========== 區段內 (含事件 K 棒) 的資金：定期投入 + 每日損益 + 逆價差補償 ==========
+        if position == 0 or current_lots <= 0:
+            # 無持倉損益：資金只在換月時改變
+            j = i
+            if month_starts:
+                for k in month_starts[bisect.bisect_left(month_starts, i):bisect.bisect_right(month_starts, end)]:
+                    capital_history[j:k] = [capital] * (k - j)
+                    capital += monthly_add
+                    j = k
+            if end > j:
+                capital_history[j:end + 1] = [capital] * (end + 1 - j)
+            else:
+                capital_history[j] = capital
+        elif end - i + 1 >= EVENT_VECTOR_MIN_BARS:
+            steps = [month_add[i:end + 1]]
+            if position == 1:
+                steps.append((close[i:end + 1] - close[i - 1:end]) * current_lots * point_value)
+            else:
+                steps.append((close[i - 1:end] - close[i:end + 1]) * current_lots * point_value)
+            if apply_backwardation:
+                steps.append(current_lots * close[i:end + 1] * point_value * daily_backwardation_rate)
+            # 依逐日的加法順序交錯排列後累加，與逐根相加的結果逐位元相同
+            width = len(steps)
+            flat = np.empty((end - i + 1) * width + 1)
+            flat[0] = capital
+            flat[1:] = np.column_stack(steps).ravel()
+            capital_history[i:end + 1] = np.add.accumulate(flat)[width::width].tolist()
+            capital = capital_history[end]
+        else:
+            for j in range(i, end + 1):
+                if month_adds[j]:
+                    capital += monthly_add
+                if position == 1:
+                    capital += (closes[j] - closes[j - 1]) * current_lots * point_value
+                else:
+                    capital += (closes[j - 1] - closes[j]) * current_lots * point_value
+                if apply_backwardation:
+                    capital += current_lots * closes[j] * point_value * daily_backwardation_rate
+                capital_history[j] = capital
+
+        if constraints is not None and event > i:
+            # 事件前的 K 棒
+            segment = np.asarray(capital_history[i:min(event, n)])
+            peaks = np.maximum.accumulate(np.concatenate(([peak], segment)))[1:]
+            violated = np.flatnonzero((segment < stop_capital) | ((peaks - segment) / peaks * 100 > stop_drawdown))
+            if len(violated):
+                last = i + int(violated[0])
+                capital = capital_history[last]
+                del capital_history[last + 1:]
+                break
+            peak = float(peaks[-1])
+
+        if event >= n:
+            break
+
+        # ========== 事件 K 棒：出場/換倉或進場 ==========
+        current_price = closes[event]
+        if position != 0:
+            exit_fee = sell_fee * current_lots if use_fee else 0
+            capital -= exit_fee
+
+            if position == 1:
+                total_profit = (current_price - entry_price) * current_lots * point_value
+            else:
+                total_profit = (entry_price - current_price) * current_lots * point_value
+
+            total_fee = exit_fee + (buy_fee * current_lots if use_fee else 0)
+            trades.append(entry_date, days[event], position, current_lots, entry_price,
+                          current_price, total_fee, total_profit, capital)
+
+            if trade_mode == 'both':
+                # 換倉
+                position = -position
+                entry_price = current_price
+                entry_date = days[event]
+
+                if dynamic_lots:
+                    current_lots = max(int((capital * leverage) / (current_price * point_value)), 1)
+                else:
+                    current_lots = fixed_lots
+
+                if use_fee:
+                    capital -= buy_fee * current_lots
+            else:
+                # 完全出場
+                position = 0
+                current_lots = 0
+        else:
+            position = event_sign
+            entry_price = current_price
+            entry_date = days[event]
+
+            # 計算進場口數
+            if dynamic_lots:
+                current_lots = max(int((capital * leverage) / (current_price * point_value)), 1)
+            else:
+                current_lots = fixed_lots
+
+            # 計入進場手續費
+            if use_fee:
+                capital -= buy_fee * current_lots
+
+        # 每日資金記錄
+        capital_history[event] = capital
+
+        if constraints is not None:
+            if capital > peak:
+                peak = capital
+            if capital < stop_capital or (peak - capital) / peak * 100 > stop_drawdown:
+                last = event
+                del capital_history[event + 1:]
+                break
+
+        i = event + 1
+
+    if state is not None:
+        state.capital = capital
+        state.position = position
+        state.entry_price = entry_price
+        state.entry_date = entry_date
+        state.current_lots = current_lots
+        state.last_month = int(months[last])
+        state.last_date = days[last]
+        state.last_close = closes[last]
+
+    return capital_history, trades
+
+
+@timed('format')
+def _summarize(capital_history, trades, initial_capital):
+    """由資金曲線與交易帳本計算績效指標"""
+    values = np.asarray(capital_history, dtype=np.float64)
+    final_capital = capital_history[-1] if len(capital_history) else initial_capital
+    total_return = (final_capital - initial_capital) / initial_capital * 100
+
+    if len(values) < 2:
+        mdd = 0
+    else:
+        cummax = np.maximum.accumulate(values)
+        mdd = float(np.max((cummax - values) / cummax * 100))
+
+    win_rate = trades.win_count() / len(trades) * 100 if len(trades) else 0
+
+    return {
+        'finalAssets': round(final_capital, 0),
+        'totalReturn': round(total_return, 2),
+        'maxDrawdown': round(-mdd, 2),
+        'winRate': round(win_rate, 1),
+        'tradeCount': len(trades)
+    }
+
+
+@timed('format')
+def _format_trades(trades, initial_capital, first_id=1):
+    """將交易帳本轉為 API 回傳格式"""
+    if not len(trades):
+        return []
+
+    rows = trades.rows
+    pnl = trades.pnl()
+    columns = zip(
+        dates_to_strings(rows['entry_day']),
+        dates_to_strings(rows['exit_day']),
+        rows['direction'].tolist(),
+        (rows['exit_day'] - rows['entry_day']).tolist(),
+        rows['entry_price'].tolist(),
+        rows['exit_price'].tolist(),
+        rows['lots'].tolist(),
+        rows['fee'].tolist(),
+        pnl.tolist(),
+        rows['capital'].tolist()
+    )
+
+    formatted = []
+    for idx, (entry_date, exit_date, position, hold_days, entry_price, exit_price,
+              lots, total_fee, trade_pnl, capital) in enumerate(columns):
+        formatted.append({
+            'id': first_id + idx,
+            'entryDate': entry_date,
+            'exitDate': exit_date,
+            'direction': 'long' if position == 1 else 'short',
+            'holdDays': hold_days,
+            'entryPrice': round(entry_price, 2),
+            'exitPrice': round(exit_price, 2),
+            'contracts': lots,
+            'fee': round(total_fee, 2),
+            'pnl': round(trade_pnl, 2),
+            'returnRate': round(trade_pnl / initial_capital * 100, 2),
+            'capitalAfter': round(capital, 2),
+            'entryReason': '突破MA上穿' if position == 1 else '跌破MA下穿',
+            'exitReason': '跌破MA下穿' if position == 1 else '突破MA上穿'
+        })
+    return formatted
+
+
+# ====================================
+# 欄式 (columnar) 回傳格式
+# ====================================
+
+# 欄式格式中的進出場原因代碼
+REASON_CODES = ('突破MA上穿', '跌破MA下穿')
+
+
+@timed('format')
+def _columnar_result(close, dates, capital_history, mdd_history, raw_trades, initial_capital, summary):
+    """
+    建立欄式回傳格式
+
+    日期以 baseDate 起算的日數 (整數) 表示，交易明細為平行陣列，
+    方向以 1 / -1、原因以 REASON_CODES 的索引表示；數值於此一次性向量化四捨五入。
+    """
+    base_day = int(dates[0])
+    first_date, last_date = dates_to_strings(np.array([dates[0], dates[-1]]))
+
+    if len(raw_trades):
+        rows = raw_trades.rows
+        pnl = raw_trades.pnl()
+        direction = rows['direction'].astype(np.int64)
+        entry_reason = np.where(direction == 1, 0, 1)
+        trades = {
+            'entryDate': (rows['entry_day'] - base_day).tolist(),
+            'exitDate': (rows['exit_day'] - base_day).tolist(),
+            'direction': direction.tolist(),
+            'holdDays': (rows['exit_day'] - rows['entry_day']).tolist(),
+            'entryPrice': np.round(rows['entry_price'], 2).tolist(),
+            'exitPrice': np.round(rows['exit_price'], 2).tolist(),
+            'contracts': rows['lots'].tolist(),
+            'fee': np.round(rows['fee'], 2).tolist(),
+            'pnl': np.round(pnl, 2).tolist(),
+            'returnRate': np.round(pnl / initial_capital * 100, 2).tolist(),
+            'capitalAfter': np.round(rows['capital'], 2).tolist(),
+            'entryReason': entry_reason.tolist(),
+            'exitReason': (1 - entry_reason).tolist()
+        }
+    else:
+        trades = {key: [] for key in (
+            'entryDate', 'exitDate', 'direction', 'holdDays', 'entryPrice', 'exitPrice', 'contracts',
+            'fee', 'pnl', 'returnRate', 'capitalAfter', 'entryReason', 'exitReason'
+        )}
+
+    return {
+        'success': True,
+        'format': 'columnar',
+        'results': {
+            'period': f"{first_date} ~ {last_date}",
+            **summary
+        },
+        'baseDate': first_date,
+        'dates': (dates - base_day).tolist(),
+        'capital': np.round(np.asarray(capital_history, dtype=np.float64), 2).tolist(),
+        'drawdown': np.round(np.asarray(mdd_history, dtype=np.float64), 4).tolist(),
+        'index': np.round(close, 2).tolist(),
+        'trades': trades,
+        'codes': {
+            'direction': {'1': 'long', '-1': 'short'},
+            'reason': list(REASON_CODES)
+        }
+    }
+
+
+def run_backtest_arrays(close, ma, dates, params, ma_window=None, result_format='records'):
+    """
+    以陣列執行回測
+
+    Parameters:
+    -----------
+    close : ndarray (float64)
+        收盤價
+    ma : ndarray (float64)
+        對應的均線值 (不可含 NaN)
+    dates : ndarray (int64)
+        epoch 日數
+    params : dict
+        回測參數 (同 run_backtest)
+    ma_window : list, optional
+        最後 maDays 根收盤價；提供時一併回傳 BacktestState
+    result_format : str
+        'records' (預設，交易為 dict 列表) 或 'columnar' (平行陣列、日數偏移)
+
+    Returns:
+    --------
+    dict: 與 run_backtest 相同格式的回測結果；
+          若提供 ma_window 則回傳 (result, state)
+    """
+    if len(close) < 2:
+        result = {
+            'success': False,
+            'error': '資料不足'
+        }
+        return result if ma_window is None else (result, None)
+
+    cfg = resolve_config(params)
+    initial_capital = cfg['initial_capital']
+
+    state = None
+    if ma_window is not None:
+        state = BacktestState(params, capital=initial_capital, entry_date=int(dates[0]),
+                              ma_window=ma_window, first_date=int(dates[0]))
+
+    capital_history, raw_trades = _simulate(close, ma, dates_to_months(dates), dates, cfg, state)
+
+    # 計算最大回撤
+    _, mdd_history = calculate_mdd(capital_history)
+    summary = _summarize(capital_history, raw_trades, initial_capital)
+
+    if state is not None:
+        state.peak_capital = max(capital_history)
+        state.max_drawdown = float(max(mdd_history)) if mdd_history else 0.0
+        state.trade_count = len(raw_trades)
+        state.win_count = raw_trades.win_count()
+        state.bar_count = len(capital_history)
+
+    if result_format == 'columnar':
+        result = _columnar_result(close, dates, capital_history, mdd_history, raw_trades,
+                                  initial_capital, summary)
+        if params.get('drawdownAnalysis'):
+            with span('drawdown'):
+                result['drawdownAnalysis'] = analyze_drawdowns(capital_history, dates)
+        return result if state is None else (result, state)
+
+    capital_dates = dates_to_strings(dates)
+    index_history = close.tolist()
+    trades = _format_trades(raw_trades, initial_capital)
+
+    result = {
+        'success': True,
+        'results': {
+            'period': f"{capital_dates[0]} ~ {capital_dates[-1]}",
+            **summary
+        },
+        'trades': trades,
+        'capitalHistory': {
+            'dates': capital_dates,
+            'values': capital_history
+        },
+        'mddHistory': {
+            'dates': capital_dates,
+            'values': mdd_history
+        },
+        'indexHistory': {
+            'dates': capital_dates,
+            'values': index_history
+        }
+    }
+    if params.get('drawdownAnalysis'):
+        with span('drawdown'):
+            result['drawdownAnalysis'] = analyze_drawdowns(capital_history, dates)
+    return result if state is None else (result, state)
+
+
+def run_backtest(df, params, return_state=False, result_format='records'):
+    """
+    執行回測
+    
+    Parameters:
+    -----------
+    df : DataFrame
+        包含 'date' 和 'close' 欄位的股價資料
+    params : dict
+        回測參數，包含:
+        - maDays: 均線天數
+        - tradeMode: 交易模式 ('long', 'short', 'both')
+        - initialCapital: 初始資金
+        - monthlyAdd: 每月加碼金額
+        - useFixedLeverage: 是否使用固定槓桿
+        - fixedLeverage: 固定槓桿倍數
+        - useDynamicLeverage: 是否使用動態槓桿
+        - dynamicLeverage: 動態槓桿倍數
+        - enableRebalance: 是否啟用再平衡
+        - rebalancePeriod: 再平衡週期（月）
+        - pointValue: 每點價值
+        - useFee: 是否計算手續費
+        - buyFee: 買進手續費
+        - sellFee: 賣出手續費
+        - fixedLots: 固定口數
+        - lotMode: 口數模式 ('fixed', 'dynamic')
+        - drawdownAnalysis: 是否附加回撤分析 (回撤期間、回復時間、前幾段回撤、各年/各月最大回撤)
+    return_state : bool
+        是否一併回傳 BacktestState，供 advance() 接續新資料
+    result_format : str
+        'records' (預設) 或 'columnar'
+    
+    Returns:
+    --------
+    dict: 包含回測結果的字典；return_state 為 True 時回傳 (result, state)
+    """
+    ma_days = params.get('maDays', 13)
+    close, ma, dates = prepare_arrays(df, ma_days)
+    if not return_state:
+        return run_backtest_arrays(close, ma, dates, params, result_format=result_format)
+
+    # 均線視窗取自未去除前段的收盤價：資料剛好足以形成均線時，回測用的 close 不足 maDays 根
+    ma_window = df['close'].to_numpy(dtype=np.float64)[-ma_days:].tolist()
+    return run_backtest_arrays(close, ma, dates, params, ma_window=ma_window, result_format=result_format)
+
+
+def advance(state, new_bars):
+    """
+    以既有回測狀態接續推進新的 K 棒
+
+    只模擬 state.last_date 之後的資料，計算量與新增 K 棒數成正比。
+
+    Parameters:
+    -----------
+    state : BacktestState
+        run_backtest(..., return_state=True) 或前一次 advance() 的狀態 (會被更新)
+    new_bars : DataFrame
+        包含 'date' 和 'close' 欄位的新資料；早於或等於 state.last_date 的資料會被忽略
+
+    Returns:
+    --------
+    dict: 更新後的績效摘要，以及新增部分的交易、資金、回撤與指數序列
+    """
+    cfg = resolve_config(state.params)
+    ma_days = cfg['ma_days']
+    initial_capital = cfg['initial_capital']
+
+    close, dates = price_arrays(new_bars)
+    keep = dates > state.last_date
+    close, dates = close[keep], dates[keep]
+
+    # 以保存的均線視窗接上新資料計算均線
+    window = np.array(state.ma_window, dtype=np.float64)
+    ma = ma_matrix(np.concatenate((window, close)), [ma_days])[0, len(window):]
+
+    # 第 0 根為上次處理到的 K 棒，作為迴圈起點
+    sim_close = np.concatenate(([state.last_close], close))
+    sim_ma = np.concatenate(([np.nan], ma))
+    sim_dates = np.concatenate(([state.last_date], dates))
+    sim_months = dates_to_months(sim_dates)
+    sim_months[0] = state.last_month
+
+    capital_history, raw_trades = _simulate(sim_close, sim_ma, sim_months, sim_dates, cfg, state)
+    capital_history = capital_history[1:]
+
+    trades = _format_trades(raw_trades, initial_capital, first_id=state.trade_count + 1)
+
+    # 延續先前的資金高點計算回撤
+    values = np.asarray(capital_history, dtype=np.float64)
+    peak = np.maximum.accumulate(np.concatenate(([state.peak_capital], values)))[1:]
+    drawdowns = (peak - values) / peak * 100 if len(values) else values
+
+    state.ma_window = np.concatenate((window, close))[-ma_days:].tolist()
+    state.trade_count += len(raw_trades)
+    state.win_count += raw_trades.win_count()
+    state.bar_count += len(values)
+    if len(values):
+        state.peak_capital = float(peak[-1])
+        state.max_drawdown = max(state.max_drawdown, float(drawdowns.max()))
+
+    total_return = (state.capital - initial_capital) / initial_capital * 100
+    win_rate = state.win_count / state.trade_count * 100 if state.trade_count else 0
+    capital_dates = dates_to_strings(dates)
+    first_date, last_date = dates_to_strings(np.array([state.first_date, state.last_date]))
+
+    return {
+        'success': True,
+        'results': {
+            'period': f"{first_date} ~ {last_date}",
+            'finalAssets': round(state.capital, 0),
+            'totalReturn': round(total_return, 2),
+            'maxDrawdown': round(-state.max_drawdown, 2),
+            'winRate': round(win_rate, 1),
+            'tradeCount': state.trade_count
+        },
+        'newBars': len(values),
+        'trades': trades,
+        'capitalHistory': {
+            'dates': capital_dates,
+            'values': capital_history
+        },
+        'mddHistory': {
+            'dates': capital_dates,
+            'values': drawdowns.tolist()
+        },
+        'indexHistory': {
+            'dates': capital_dates,
+            'values': close.tolist()
+        }
+    }
+
+
+def extend_result(result, update):
+    """
+    將 advance() 的新增部分接到既有的 run_backtest 結果之後
+
+    原結果含 drawdownAnalysis 時，以接續後的完整資金曲線重新分析。
+
+    Returns:
+    --------
+    dict: 新的完整回測結果 (不修改原本的 result)
+    """
+    dates = result['capitalHistory']['dates'] + update['capitalHistory']['dates']
+    extended = {
+        'success': True,
+        'results': update['results'],
+        'trades': result['trades'] + update['trades'],
+        'capitalHistory': {
+            'dates': dates,
+            'values': result['capitalHistory']['values'] + update['capitalHistory']['values']
+        },
+        'mddHistory': {
+            'dates': dates,
+            'values': result['mddHistory']['values'] + update['mddHistory']['values']
+        },
+        'indexHistory': {
+            'dates': dates,
+            'values': result['indexHistory']['values'] + update['indexHistory']['values']
+        }
+    }
+    if 'drawdownAnalysis' in result:
+        with span('drawdown'):
+            extended['drawdownAnalysis'] = analyze_drawdowns(
+                extended['capitalHistory']['values'], np.array(dates, dtype='datetime64[D]')
+            )
+    return extended
+
+
+# ====================================
+# 串流 (分塊) 回測
+# ====================================
+
+STREAM_CHUNK_BARS = 200_000
+
+
+def iter_bar_chunks(path, chunk_size=STREAM_CHUNK_BARS):
+    """
+    分塊讀取 K 棒檔案
+
+    支援 CSV (date, close 欄位，可為分鐘線時間戳) 與 .npy 結構化陣列
+    (date 為 datetime64、close 為浮點數；以 mmap 開啟，不整檔載入記憶體)。
+
+    Yields:
+    -------
+    tuple: (timestamps, close)，timestamps 為 datetime64[s]，close 為 float64
+    """
+    if path.endswith('.npy'):
+        bars = np.load(path, mmap_mode='r')
+        for start in range(0, len(bars), chunk_size):
+            chunk = bars[start:start + chunk_size]
+            yield (np.asarray(chunk['date']).astype('datetime64[s]'),
+                   np.asarray(chunk['close'], dtype=np.float64))
+        return
+
+    for chunk in pd.read_csv(path, usecols=['date', 'close'], parse_dates=['date'], chunksize=chunk_size):
+        chunk = chunk.dropna()
+        yield (chunk['date'].to_numpy().astype('datetime64[s]'),
+               chunk['close'].to_numpy(dtype=np.float64))
+
+
+def run_backtest_stream(source, params, chunk_size=STREAM_CHUNK_BARS):
+    """
+    串流回測：逐塊讀取 K 棒，記憶體用量與歷史長度無關
+
+    均線視窗 (最後 maDays 根收盤價) 與持倉狀態 (BacktestState) 跨塊延續，
+    與 advance() 相同以上一塊最後一根 K 棒作為下一塊的迴圈起點。
+    資金曲線只保留每日最後一根 K 棒的值 (分鐘線彙總為日線)，最大回撤則以每根 K 棒計算。
+    交易明細不保留，只累計筆數與勝率。
+
+    Parameters:
+    -----------
+    source : str 或 iterable
+        K 棒檔案路徑 (見 iter_bar_chunks)，或產生 (timestamps, close) 的可迭代物件；
+        資料須依時間排序
+    params : dict
+        回測參數 (同 run_backtest)
+    chunk_size : int
+        每塊 K 棒數
+
+    Returns:
+    --------
+    dict: 與 run_backtest 相同結構的績效摘要及日資金、回撤、指數序列 (不含交易明細)
+    """
+    cfg = resolve_config(params)
+    ma_days = cfg['ma_days']
+    initial_capital = cfg['initial_capital']
+    chunks = iter_bar_chunks(source, chunk_size) if isinstance(source, str) else source
+
+    state = None
+    window = np.zeros(0)
+    last_time = None
+    max_drawdown = 0.0
+    bar_count = 0
+
+    # 每日最後一根 K 棒的資金、回撤與收盤價 (最後一天可能延續到下一塊，於結束時才輸出)
+    daily_days, daily_capital, daily_drawdown, daily_close = [], [], [], []
+
+    for timestamps, close in chunks:
+        if len(close) == 0:
+            continue
+        times = timestamps.astype(np.int64)
+        if np.any(np.diff(times) < 0) or (last_time is not None and times[0] < last_time):
+            raise ValueError('K 棒資料未依時間排序')
+        last_time = int(times[-1])
+        days = timestamps.astype('datetime64[D]').astype(np.int64)
+
+        full = np.concatenate((window, close))
+        ma = ma_matrix(full, [ma_days])[0, len(window):]
+        window = full[-ma_days:]
+
+        if state is None:
+            # 均線成形的第一根 K 棒作為起點 (同 run_backtest 去除前段缺值)
+            formed = np.flatnonzero(~np.isnan(ma))
+            if len(formed) == 0:
+                continue
+            first = formed[0]
+            state = BacktestState(params, capital=initial_capital, entry_date=int(days[first]),
+                                  first_date=int(days[first]), peak_capital=initial_capital)
+            sim_close, sim_ma, sim_days = close[first:], ma[first:], days[first:]
+            sim_months = dates_to_months(sim_days)
+        else:
+            sim_close = np.concatenate(([state.last_close], close))
+            sim_ma = np.concatenate(([np.nan], ma))
+            sim_days = np.concatenate(([state.last_date], days))
+            sim_months = dates_to_months(sim_days)
+            sim_months[0] = state.last_month
+
+        capital_history, trades = _simulate(sim_close, sim_ma, sim_months, sim_days, cfg, state)
+        state.trade_count += len(trades)
+        state.win_count += trades.win_count()
+
+        # 續接的塊第 0 根為上一塊已輸出的 K 棒
+        offset = 0 if state.bar_count == 0 else 1
+        values = np.asarray(capital_history[offset:], dtype=np.float64)
+        bar_days = sim_days[offset:]
+        bar_close = sim_close[offset:]
+        state.bar_count += len(values)
+        bar_count += len(values)
+
+        peak = np.maximum.accumulate(np.concatenate(([state.peak_capital], values)))[1:]
+        drawdowns = (peak - values) / peak * 100
+        state.peak_capital = float(peak[-1])
+        max_drawdown = max(max_drawdown, float(drawdowns.max()))
+
+        # 每日最後一根 K 棒；與上一塊最後一天相同日期者覆蓋
+        last_of_day = np.flatnonzero(np.concatenate((bar_days[1:] != bar_days[:-1], [True])))
+        if daily_days and daily_days[-1] == bar_days[0]:
+            daily_days.pop()
+            daily_capital.pop()
+            daily_drawdown.pop()
+            daily_close.pop()
+        daily_days.extend(bar_days[last_of_day].tolist())
+        daily_capital.extend(values[last_of_day].tolist())
+        daily_drawdown.extend(drawdowns[last_of_day].tolist())
+        daily_close.extend(bar_close[last_of_day].tolist())
+
+    if state is None or bar_count < 2:
+        return {
+            'success': False,
+            'error': '資料不足'
+        }
+
+    total_return = (state.capital - initial_capital) / initial_capital * 100
+    win_rate = state.win_count / state.trade_count * 100 if state.trade_count else 0
+    capital_dates = dates_to_strings(np.array(daily_days, dtype=np.int64))
+
+    return {
+        'success': True,
+        'results': {
+            'period': f"{capital_dates[0]} ~ {capital_dates[-1]}",
+            'finalAssets': round(state.capital, 0),
+            'totalReturn': round(total_return, 2),
+            'maxDrawdown': round(-max_drawdown, 2),
+            'winRate': round(win_rate, 1),
+            'tradeCount': state.trade_count,
+            'bars': bar_count
+        },
+        'capitalHistory': {
+            'dates': capital_dates,
+            'values': daily_capital
+        },
+        'mddHistory': {
+            'dates': capital_dates,
+            'values': daily_drawdown
+        },
+        'indexHistory': {
+            'dates': capital_dates,
+            'values': daily_close
+        }
+    }
+
+
+# ====================================
+# 圖表降採樣
+# ====================================
+
+def lttb_indices(values, max_points):
+    """
+    Largest-Triangle-Three-Buckets 降採樣
+
+    保留首尾兩點，其餘每個區間挑選與前一選點、下一區間平均點構成最大三角形的點，
+    以少量點保留曲線的峰谷形狀。
+
+    Parameters:
+    -----------
+    values : array-like
+        等距序列的數值
+    max_points : int
+        最多保留的點數 (至少 3)
+
+    Returns:
+    --------
+    ndarray: 保留點的索引 (遞增)
+    """
+    y = np.nan_to_num(np.asarray(values, dtype=np.float64))
+    n = len(y)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+
+    bucket_size = (n - 2) / (max_points - 2)
+    edges = (np.arange(max_points - 1) * bucket_size).astype(np.int64) + 1
+    edges[-1] = n - 1
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+
+    for b in range(max_points - 2):
+        start, end = edges[b], edges[b + 1]
+
+        # 下一區間的平均點 (最後一個區間以終點代替)
+        if b + 2 < len(edges):
+            next_start, next_end = edges[b + 1], edges[b + 2]
+            avg_x = (next_start + next_end - 1) / 2
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = n - 1, y[-1]
+
+        xs = np.arange(start, end)
+        area = np.abs((a - avg_x) * (y[start:end] - y[a]) - (a - xs) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[b + 1] = a
+
+    return selected
+
+
+def _downsample_indices(series, max_points):
+    """
+    各序列 LTTB 選點 (含全域極值) 的聯集，總點數不超過 max_points
+
+    首尾與各序列的全域極值 (最高資金、最大回撤點) 優先保留，
+    剩餘點數平均分給各序列的 LTTB 內部點。
+    """
+    max_points = max(int(max_points), 1)
+    n = len(series[0])
+    if n <= max_points:
+        return list(range(n))
+
+    required = [0, n - 1]
+    for values in series:
+        values = np.asarray(values, dtype=np.float64)
+        required.extend((int(np.nanargmax(values)), int(np.nanargmin(values))))
+    # 依優先順序去除重複，點數不足時只保留前面的
+    required = list(dict.fromkeys(required))[:max_points]
+
+    picks = [np.array(required, dtype=np.int64)]
+    budget = (max_points - len(required)) // len(series)
+    if budget > 0:
+        for values in series:
+            # LTTB 的首尾點已在 required 中，內部點恰為 budget 個
+            picks.append(lttb_indices(values, budget + 2))
+    return np.unique(np.concatenate(picks)).tolist()
+
+
+def _downsample_columnar(result, max_points):
+    """欄式格式的降採樣 (dates 已為共用陣列)"""
+    series = ('capital', 'drawdown', 'index')
+    keep = _downsample_indices([result[name] for name in series], max_points)
+
+    downsampled = dict(result)
+    for name in series + ('dates',):
+        values = result[name]
+        downsampled[name] = [values[i] for i in keep]
+    downsampled['downsample'] = {
+        'originalPoints': len(result['dates']),
+        'points': len(keep)
+    }
+    return downsampled
+
+
+@timed('downsample')
+def downsample_result(result, max_points):
+    """
+    將回測結果的資金、回撤與指數曲線降採樣
+
+    保留首尾與三條曲線各自的最高/最低點，其餘點數平均分給三條曲線以 LTTB 挑選後取聯集 (總數不超過 max_points)，
+    因此所有曲線共用同一組日期，回傳格式改為頂層 historyDates 加上各曲線的 values。
+    欄式格式 (format='columnar') 則直接對共用的 dates 與各序列陣列取樣。
+
+    Parameters:
+    -----------
+    result : dict
+        run_backtest 的回傳值 (不會被修改)
+    max_points : int
+        最多保留的點數
+
+    Returns:
+    --------
+    dict: 降採樣後的回測結果
+    """
+    if not result.get('success'):
+        return result
+
+    if result.get('format') == 'columnar':
+        return _downsample_columnar(result, max_points)
+
+    series = ('capitalHistory', 'mddHistory', 'indexHistory')
+    dates = result['capitalHistory']['dates']
+    n = len(dates)
+    keep_list = _downsample_indices([result[name]['values'] for name in series], max_points)
+
+    downsampled = {k: v for k, v in result.items() if k not in series}
+    downsampled['historyDates'] = [dates[i] for i in keep_list]
+    for name in series:
+        values = result[name]['values']
+        downsampled[name] = {'values': [values[i] for i in keep_list]}
+    downsampled['downsample'] = {
+        'originalPoints': n,
+        'points': len(keep_list)
+    }
+    return downsampled
+
+
+def optimize_ma(df, params):
+    """
+    自動優化均線天數
+    
+    Parameters:
+    -----------
+    df : DataFrame
+        股價資料
+    params : dict
+        包含 maMin, maMax 和其他回測參數；可含 constraints (見 resolve_constraints)，
+        違反條件的均線天數提前終止並標示 pruned，不列入前三名
+    
+    Returns:
+    --------
+    dict: 包含優化結果，curve 為依均線天數排列的完整報酬/回撤/勝率曲線；
+          若 params 含 grid，則改以平行網格搜尋 (見 optimize_grid)；
+          若含 space，則改以自適應搜尋 (見 optimize_adaptive)
+    """
+    if params.get('grid'):
+        return optimize_grid(df, params)
+    if params.get('space'):
+        return optimize_adaptive(df, params)
+
+    ma_min = max(int(params.get('maMin', 5)), 1)
+    ma_max = int(params.get('maMax', 60))
+
+    close, dates = price_arrays(df)
+    months = dates_to_months(dates)
+
+    # 超過資料長度的均線永遠不會成形，不配置其均線矩陣
+    ma_max = min(ma_max, len(close) - 1)
+    windows = list(range(ma_min, ma_max + 1))
+    mas = ma_matrix(close, windows)
+
+    cfg = resolve_config(params)
+    initial_capital = cfg['initial_capital']
+    constraints = resolve_constraints(params)
+    cfg['constraints'] = constraints
+
+    results = []
+    curve = {'ma': [], 'totalReturn': [], 'maxDrawdown': [], 'winRate': [], 'tradeCount': []}
+    if constraints is not None:
+        curve['pruned'] = []
+        date_strings = dates_to_strings(dates)
+
+    # 所有視窗共用同一組價格陣列，只依均線成形位置切片
+    for row, ma in enumerate(windows):
+        first = ma - 1
+        if len(close) - first < 2:
+            continue
+
+        capital_history, trades = _simulate(close[first:], mas[row, first:], months[first:], dates[first:], cfg)
+        summary = _summarize(capital_history, trades, initial_capital)
+
+        results.append({
+            'ma': ma,
+            'totalReturn': summary['totalReturn'],
+            'maxDrawdown': summary['maxDrawdown'],
+            'winRate': summary['winRate'],
+            'tradeCount': summary['tradeCount']
+        })
+
+        if constraints is not None:
+            # 資金曲線提前結束表示被剪除
+            pruned = None
+            if len(capital_history) < len(close) - first:
+                cut = len(capital_history) - 1
+                low = constraints[1] is not None and capital_history[cut] < constraints[1]
+                pruned = {
+                    'date': date_strings[first + cut],
+                    'bar': cut,
+                    'reason': 'minCapital' if low else 'maxDrawdown'
+                }
+                results[-1]['pruned'] = pruned
+            curve['pruned'].append(pruned)
+
+        for key in curve:
+            if key != 'pruned':
+                curve[key].append(results[-1][key])
+
+    # 排序並取前三名 (被剪除者不列入)
+    results.sort(key=lambda x: x['totalReturn'], reverse=True)
+    
+    top3 = [r for r in results if 'pruned' not in r][:3]
+    for i, r in enumerate(top3):
+        r['rank'] = i + 1
+        r['avgReturn'] = r['totalReturn'] / max(r['tradeCount'], 1)
+    
+    result = {
+        'success': True,
+        'top3': top3,
+        'allResults': results,
+        'curve': curve
+    }
+    if constraints is not None:
+        result['prunedCount'] = sum(p is not None for p in curve['pruned'])
+    return result
+
+
+# ====================================
+# 批次回測 (多組參數 × 時間)
+# ====================================
+
+TRADE_MODE_CODES = {'long': 0, 'short': 1, 'both': 2}
+
+
+def expand_grid(base_params, grid):
+    """
+    將參數網格展開為參數組合列表
+
+    Parameters:
+    -----------
+    base_params : dict
+        共用的回測參數
+    grid : dict
+        參數名稱 -> 候選值列表，例如 {'maDays': [5, 10], 'tradeMode': ['long', 'both']}
+
+    Returns:
+    --------
+    list: 每個元素為完整的回測參數 dict
+    """
+    keys = list(grid.keys())
+    combos = itertools.product(*(grid[k] for k in keys))
+    return [{**base_params, **dict(zip(keys, values))} for values in combos]
+
+
+def _config_arrays(configs):
+    """將多組參數轉為以欄為單位的設定陣列"""
+    cfgs = [resolve_config(p) for p in configs]
+
+    def column(key, dtype=np.float64):
+        return np.array([c[key] for c in cfgs], dtype=dtype)
+
+    rates = column('backwardation_rate')
+    enabled = column('enable_backwardation', bool) & (rates > 0)
+    monthly_add = column('monthly_add')
+
+    return {
+        'ma_days': column('ma_days', np.int64),
+        'mode': np.array([TRADE_MODE_CODES[c['trade_mode']] for c in cfgs], dtype=np.int8),
+        'initial_capital': column('initial_capital'),
+        'monthly_add': np.where(monthly_add > 0, monthly_add, 0.0),
+        'leverage': column('leverage'),
+        'point_value': column('point_value'),
+        'use_fee': column('use_fee', bool),
+        'buy_fee': column('buy_fee'),
+        'sell_fee': column('sell_fee'),
+        'fixed_lots': column('fixed_lots', np.int64),
+        'dynamic': np.array([c['lot_mode'] != 'fixed' for c in cfgs], dtype=bool),
+        # 年化收益率轉為每日收益率 (假設一年約 252 個交易日)，未啟用者為 0
+        'backwardation': enabled,
+        'daily_backwardation_rate': rates / 100 / 252,
+    }
+
+
+@timed('simulate')
+def _simulate_batch(close, ma_rows, ma_index, months, starts, arr, include_history=False,
+                    constraints=None):
+    """
+    批次回測核心：所有參數組合以向量方式同步推進
+
+    每一根 K 棒只執行一次向量運算，處理邏輯與 _simulate 相同，
+    各組合自其均線成形的位置 (starts) 開始交易。
+    提供 constraints 時，違反條件的組合在該 K 棒結束後移出運算陣列，
+    其結果停在被剪除的位置，其餘組合的向量隨之縮小。
+
+    Parameters:
+    -----------
+    close : ndarray
+        收盤價
+    ma_rows : ndarray
+        ma_matrix 的結果 (每個不重複的均線天數一列)
+    ma_index : ndarray
+        每個組合對應的 ma_rows 列號
+    months : ndarray
+        每根 K 棒的月份
+    starts : ndarray
+        每個組合的起始索引
+    arr : dict
+        _config_arrays 的結果
+    include_history : bool
+        是否保留完整資金曲線 (被剪除的組合之後為 NaN)
+    constraints : tuple, optional
+        resolve_constraints 的結果 (max_drawdown, min_capital)
+
+    Returns:
+    --------
+    dict: 各組合的最終資金、最大回撤、交易次數、獲利次數 (以及資金曲線)，
+          prunedAt 為被剪除的 K 棒索引 (未剪除為 -1)，pruneReason 為 PRUNE_REASONS 的索引
+    """
+    n = len(close)
+    k = len(starts)
+
+    mode = arr['mode']
+    is_both = mode == 2
+    monthly_add = arr['monthly_add']
+    leverage = arr['leverage']
+    point_value = arr['point_value']
+    use_fee = arr['use_fee']
+    buy_fee = arr['buy_fee']
+    sell_fee = arr['sell_fee']
+    fixed_lots = arr['fixed_lots']
+    dynamic = arr['dynamic']
+    backwardation = arr['backwardation']
+    daily_rate = arr['daily_backwardation_rate']
+
+    capital = arr['initial_capital'].copy()
+    position = np.zeros(k, dtype=np.int8)
+    entry_price = np.zeros(k)
+    lots = np.zeros(k, dtype=np.int64)
+    peak = capital.copy()
+    mdd = np.zeros(k)
+    trade_count = np.zeros(k, dtype=np.int64)
+    win_count = np.zeros(k, dtype=np.int64)
+
+    history = None
+    if include_history:
+        history = np.full((k, n), np.nan)
+        history[:, 0] = capital
+
+    # 提前終止：live_ids 為仍在運算中的組合編號，結果陣列維持原始大小
+    pruned_at = np.full(k, -1, dtype=np.int64)
+    prune_reason = np.full(k, -1, dtype=np.int8)
+    rows = slice(None)
+    if constraints is not None:
+        stop_drawdown, stop_capital = constraints
+        live_ids = np.arange(k)
+        final_capital = capital.copy()
+        final_mdd = mdd.copy()
+        final_trades = trade_count.copy()
+        final_wins = win_count.copy()
+
+    def entry_lots(idx, price):
+        if not len(idx):
+            return np.zeros(0, dtype=np.int64)
+        raw = np.trunc((capital[idx] * leverage[idx]) / (price * point_value[idx])).astype(np.int64)
+        return np.where(dynamic[idx], np.maximum(raw, 1), fixed_lots[idx])
+
+    closes = close.tolist()
+    month_changed = np.concatenate(([False], months[1:] != months[:-1])).tolist()
+
+    for i in range(1, n):
+        current_price = closes[i]
+        prev_price = closes[i - 1]
+        active = starts < i
+
+        # 每月定期投入
+        if month_changed[i]:
+            capital += np.where(active, monthly_add, 0.0)
+
+        action = current_price - ma_rows[ma_index, i]
+
+        # ========== 持倉期間：計算每日未實現損益 ==========
+        holding = position != 0
+        marked = holding & (lots > 0)
+        if marked.any():
+            diff = np.where(position == 1, current_price - prev_price, prev_price - current_price)
+            capital += np.where(marked, diff * lots * point_value, 0.0)
+            bw = marked & backwardation
+            if bw.any():
+                capital += np.where(bw, lots * current_price * point_value * daily_rate, 0.0)
+
+        # ========== 出場/換倉判斷 ==========
+        exit_idx = np.flatnonzero(holding & (position * action < 0))
+        if len(exit_idx):
+            exit_lots = lots[exit_idx]
+            exit_fee = np.where(use_fee[exit_idx], sell_fee[exit_idx] * exit_lots, 0.0)
+            capital[exit_idx] -= exit_fee
+
+            entry = entry_price[exit_idx]
+            total_profit = np.where(position[exit_idx] == 1,
+                                    (current_price - entry) * exit_lots * point_value[exit_idx],
+                                    (entry - current_price) * exit_lots * point_value[exit_idx])
+            total_fee = exit_fee + np.where(use_fee[exit_idx], buy_fee[exit_idx] * exit_lots, 0.0)
+
+            trade_count[exit_idx] += 1
+            # 與交易明細一致：以四捨五入後的損益判斷是否獲利
+            win_count[exit_idx] += np.round(total_profit - total_fee, 2) > 0
+
+            switch_idx = exit_idx[is_both[exit_idx]]
+            close_idx = exit_idx[~is_both[exit_idx]]
+
+            # 完全出場
+            position[close_idx] = 0
+            lots[close_idx] = 0
+
+            # 換倉
+            if len(switch_idx):
+                position[switch_idx] = -position[switch_idx]
+                entry_price[switch_idx] = current_price
+                lots[switch_idx] = entry_lots(switch_idx, current_price)
+                capital[switch_idx] -= np.where(use_fee[switch_idx], buy_fee[switch_idx] * lots[switch_idx], 0.0)
+
+        # ========== 進場判斷 ==========
+        idle = active & ~holding
+        if idle.any():
+            sign = (action > 0).astype(np.int8) - (action < 0).astype(np.int8)
+            new_position = np.where(mode == 0, np.maximum(sign, 0),
+                                    np.where(mode == 1, np.minimum(sign, 0), sign))
+            enter_idx = np.flatnonzero(idle & (new_position != 0))
+            if len(enter_idx):
+                position[enter_idx] = new_position[enter_idx]
+                entry_price[enter_idx] = current_price
+                lots[enter_idx] = entry_lots(enter_idx, current_price)
+                capital[enter_idx] -= np.where(use_fee[enter_idx], buy_fee[enter_idx] * lots[enter_idx], 0.0)
+
+        # 最大回撤 (起始前資金不變，回撤為 0)
+        np.maximum(peak, capital, out=peak)
+        drawdown = (peak - capital) / peak * 100
+        np.maximum(mdd, drawdown, out=mdd)
+
+        if include_history:
+            history[rows, i] = capital
+
+        if constraints is None:
+            continue
+
+        low = capital < stop_capital if stop_capital is not None else np.zeros(len(capital), dtype=bool)
+        deep = drawdown > stop_drawdown if stop_drawdown is not None else np.zeros(len(capital), dtype=bool)
+        cut = low | deep
+        if not cut.any():
+            continue
+
+        ids = live_ids[cut]
+        pruned_at[ids] = i
+        prune_reason[ids] = np.where(low[cut], PRUNE_REASONS.index('minCapital'),
+                                     PRUNE_REASONS.index('maxDrawdown'))
+        final_capital[ids] = capital[cut]
+        final_mdd[ids] = mdd[cut]
+        final_trades[ids] = trade_count[cut]
+        final_wins[ids] = win_count[cut]
+
+        # 縮小運算陣列，只保留未被剪除的組合
+        keep = ~cut
+        live_ids = live_ids[keep]
+        rows = live_ids
+        ma_index, starts = ma_index[keep], starts[keep]
+        mode, is_both, monthly_add = mode[keep], is_both[keep], monthly_add[keep]
+        leverage, point_value, use_fee = leverage[keep], point_value[keep], use_fee[keep]
+        buy_fee, sell_fee, fixed_lots = buy_fee[keep], sell_fee[keep], fixed_lots[keep]
+        dynamic, backwardation, daily_rate = dynamic[keep], backwardation[keep], daily_rate[keep]
+        capital, position, entry_price, lots = capital[keep], position[keep], entry_price[keep], lots[keep]
+        peak, mdd = peak[keep], mdd[keep]
+        trade_count, win_count = trade_count[keep], win_count[keep]
+        if not len(live_ids):
+            break
+
+    if constraints is not None:
+        final_capital[live_ids] = capital
+        final_mdd[live_ids] = mdd
+        final_trades[live_ids] = trade_count
+        final_wins[live_ids] = win_count
+        capital, mdd, trade_count, win_count = final_capital, final_mdd, final_trades, final_wins
+
+    return {
+        'capital': capital,
+        'mdd': mdd,
+        'tradeCount': trade_count,
+        'winCount': win_count,
+        'history': history,
+        'prunedAt': pruned_at,
+        'pruneReason': prune_reason
+    }
+
+
+def _normalize_configs(configs, base_params=None):
+    """將參數列表或參數網格轉為完整的參數組合列表"""
+    if isinstance(configs, dict):
+        return expand_grid(base_params or {}, configs)
+    return [{**(base_params or {}), **p} for p in configs]
+
+
+def run_backtest_batch_arrays(close, dates, configs, include_history=False, constraints=None):
+    """
+    以陣列批次執行多組參數的回測
+
+    Parameters:
+    -----------
+    close : ndarray (float64)
+        完整收盤價序列 (尚未計算均線)
+    dates : ndarray (int64)
+        epoch 日數
+    configs : list
+        完整的回測參數 dict 列表
+    include_history : bool
+        是否回傳每組參數的完整資金曲線
+    constraints : tuple, optional
+        resolve_constraints 的結果；違反條件的組合提前終止，
+        績效計算到被剪除的 K 棒為止，並以 pruned 標示日期與原因
+
+    Returns:
+    --------
+    list: 每組參數的績效摘要
+    """
+    months = dates_to_months(dates)
+    arr = _config_arrays(configs)
+
+    windows, ma_index = np.unique(arr['ma_days'], return_inverse=True)
+    ma_rows = ma_matrix(close, windows)
+    starts = arr['ma_days'] - 1
+
+    sim = _simulate_batch(close, ma_rows, ma_index, months, starts, arr, include_history, constraints)
+
+    date_strings = dates_to_strings(dates)
+    initial_capital = arr['initial_capital']
+    total_return = (sim['capital'] - initial_capital) / initial_capital * 100
+    win_rate = np.where(sim['tradeCount'] > 0, sim['winCount'] / np.maximum(sim['tradeCount'], 1) * 100, 0.0)
+
+    results = []
+    for idx, params in enumerate(configs):
+        start = int(starts[idx])
+        if len(close) - start < 2:
+            results.append({
+                'params': params,
+                'success': False,
+                'error': '資料不足'
+            })
+            continue
+
+        cut = int(sim['prunedAt'][idx])
+        end = cut if cut >= 0 else len(close) - 1
+        entry = {
+            'params': params,
+            'success': True,
+            'period': f"{date_strings[start]} ~ {date_strings[end]}",
+            'finalAssets': round(float(sim['capital'][idx]), 0),
+            'totalReturn': round(float(total_return[idx]), 2),
+            'maxDrawdown': round(-float(sim['mdd'][idx]), 2),
+            'winRate': round(float(win_rate[idx]), 1),
+            'tradeCount': int(sim['tradeCount'][idx])
+        }
+        if cut >= 0:
+            entry['pruned'] = {
+                'date': date_strings[cut],
+                'bar': cut - start,
+                'reason': PRUNE_REASONS[sim['pruneReason'][idx]]
+            }
+        if include_history:
+            entry['capitalHistory'] = {
+                'dates': date_strings[start:end + 1],
+                'values': sim['history'][idx, start:end + 1].tolist()
+            }
+        results.append(entry)
+
+    return results
+
+
+def run_backtest_batch(df, configs, base_params=None, include_history=False):
+    """
+    批次執行多組參數的回測
+
+    所有組合共用同一份價格陣列、日期處理與均線矩陣，並在同一個時間迴圈中同步推進。
+    再平衡參數目前不影響結果 (與 run_backtest 一致)。
+    base_params 含 constraints 時，違反條件的組合提前終止 (見 resolve_constraints)。
+
+    Parameters:
+    -----------
+    df : DataFrame
+        包含 'date' 和 'close' 欄位的股價資料
+    configs : list or dict
+        參數 dict 的列表；或參數網格 (參數名稱 -> 候選值列表)，將與 base_params 展開為所有組合
+    base_params : dict, optional
+        網格模式下共用的回測參數
+    include_history : bool
+        是否回傳每組參數的完整資金曲線
+
+    Returns:
+    --------
+    dict: 每組參數的績效摘要
+    """
+    configs = _normalize_configs(configs, base_params)
+
+    if not configs:
+        return {
+            'success': False,
+            'error': '缺少參數組合'
+        }
+
+    close, dates = price_arrays(df)
+    constraints = resolve_constraints(base_params or {})
+    results = run_backtest_batch_arrays(close, dates, configs, include_history, constraints)
+
+    result = {
+        'success': True,
+        'count': len(results),
+        'results': results
+    }
+    if constraints is not None:
+        result['prunedCount'] = sum('pruned' in r for r in results)
+    return result
+
+
+# ====================================
+# 平行網格搜尋
+# ====================================
+
+GRID_SORT_METRICS = ('totalReturn', 'maxDrawdown', 'winRate', 'finalAssets', 'tradeCount')
+GRID_MAX_CONFIGS = 100000  # 單次網格搜尋的組合數上限
+
+# 子行程共用的陣列 (由 _init_pool_worker 於行程啟動時設定一次)
+_WORKER_ARRAYS = None
+
+
+def _init_pool_worker(*arrays):
+    """子行程初始化：價格等陣列只在行程啟動時傳送一次"""
+    global _WORKER_ARRAYS
+    _WORKER_ARRAYS = arrays
+
+
+def pool_workers(requested, tasks):
+    """行程數：預設為 CPU 核心數，且不超過核心數與任務數"""
+    cpus = os.cpu_count() or 1
+    return max(min(int(requested or cpus), cpus, tasks), 1)
+
+
+def grid_size(grid):
+    """參數網格展開後的組合數 (不影響結果的參數不展開)，不需實際展開網格"""
+    return math.prod(len(v) for k, v in grid.items() if k not in NO_EFFECT_PARAMS)
+
+
+def _run_grid_chunk(configs, constraints=None):
+    """子行程任務：以共用價格陣列批次回測一段參數組合"""
+    close, dates = _WORKER_ARRAYS
+    return run_backtest_batch_arrays(close, dates, configs, constraints=constraints)
+
+
+def optimize_grid(df, params):
+    """
+    平行網格搜尋
+
+    將參數空間切成多段，交由 concurrent.futures 行程池以批次引擎並行計算。
+
+    Parameters:
+    -----------
+    df : DataFrame
+        股價資料
+    params : dict
+        其他回測參數，另包含:
+        - grid: 參數網格 (參數名稱 -> 候選值列表)，例如
+          {"maDays": [5, 10, 20], "tradeMode": ["long", "both"], "dynamicLeverage": [1, 2, 3]}
+        - workers: 行程數 (預設為 CPU 核心數，不超過核心數)
+        - sortBy: 排序指標 (totalReturn, maxDrawdown, winRate, finalAssets, tradeCount)
+        - topN: 回傳前幾名 (預設 10)
+        - constraints: 提前終止條件，例如 {"maxDrawdown": 30, "minCapital": 500000}；
+          被剪除的組合不參與排名，另列於 pruned
+        網格中不影響結果的參數 (NO_EFFECT_PARAMS) 不展開，列於 ignoredParams；
+        組合數不可超過 GRID_MAX_CONFIGS
+
+    Returns:
+    --------
+    dict: 包含排序後的前 N 名組合
+    """
+    grid = params.get('grid') or {}
+    ignored = [k for k in grid if k in NO_EFFECT_PARAMS]
+    grid = {k: v for k, v in grid.items() if k not in NO_EFFECT_PARAMS}
+    sort_by = params.get('sortBy', 'totalReturn')
+    top_n = max(int(params.get('topN', 10)), 1)
+
+    if sort_by not in GRID_SORT_METRICS:
+        return {
+            'success': False,
+            'error': f'不支援的排序指標: {sort_by}'
+        }
+
+    # 展開前先檢查組合數，避免過大的網格耗盡記憶體
+    if grid_size(grid) > GRID_MAX_CONFIGS:
+        return {
+            'success': False,
+            'error': f'參數組合數不可超過 {GRID_MAX_CONFIGS}'
+        }
+
+    constraints = resolve_constraints(params)
+    base_params = {k: v for k, v in params.items()
+                   if k not in ('grid', 'sortBy', 'topN', 'workers', 'constraints')}
+    configs = expand_grid(base_params, grid)
+
+    if not configs:
+        return {
+            'success': False,
+            'error': '缺少參數組合'
+        }
+
+    close, dates = price_arrays(df)
+    workers = pool_workers(params.get('workers'), len(configs))
+
+    if workers == 1:
+        results = run_backtest_batch_arrays(close, dates, configs, constraints=constraints)
+    else:
+        # 每個行程切成數段以平衡負載；批次引擎在段落較大時效率較佳
+        chunk_size = -(-len(configs) // (workers * 2))
+        chunks = [configs[i:i + chunk_size] for i in range(0, len(configs), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_pool_worker,
+                                 initargs=(close, dates)) as pool:
+            results = [r for chunk in pool.map(_run_grid_chunk, chunks, itertools.repeat(constraints))
+                       for r in chunk]
+
+    results = [r for r in results if r['success']]
+    pruned = [{'params': {k: r['params'][k] for k in grid}, **r['pruned']}
+              for r in results if 'pruned' in r]
+    results = [r for r in results if 'pruned' not in r]
+    results.sort(key=lambda r: r[sort_by], reverse=True)
+
+    top = []
+    for i, r in enumerate(results[:top_n]):
+        top.append({
+            'rank': i + 1,
+            'params': {k: r['params'][k] for k in grid},
+            'period': r['period'],
+            'finalAssets': r['finalAssets'],
+            'totalReturn': r['totalReturn'],
+            'maxDrawdown': r['maxDrawdown'],
+            'winRate': r['winRate'],
+            'tradeCount': r['tradeCount']
+        })
+
+    result = {
+        'success': True,
+        'total': len(configs),
+        'evaluated': len(results) + len(pruned),
+        'workers': workers,
+        'sortBy': sort_by,
+        'top': top
+    }
+    if constraints is not None:
+        result['prunedCount'] = len(pruned)
+        result['pruned'] = pruned
+    if ignored:
+        result['ignoredParams'] = ignored
+    return result
+
+
+# ====================================
+# 自適應搜尋 (successive halving)
+# ====================================
+
+ADAPTIVE_ETA = 3
+ADAPTIVE_BUDGET = 1000
+ADAPTIVE_MAX_SPACE = 10 ** 15  # 參數空間大小上限 (抽樣索引須在 int64 範圍內)
+
+
+def _space_range(values):
+    """{"min", "max", "step"} 形式的整數範圍 (range 物件，不展開)"""
+    step = max(int(values.get('step', 1)), 1)
+    return range(int(values['min']), int(values['max']) + 1, step)
+
+
+def _space_size(values):
+    """
+    參數空間的候選值個數，不展開範圍
+
+    以整數運算計算，範圍極大時也不會配置記憶體或溢位
+    """
+    if isinstance(values, dict):
+        r = _space_range(values)
+        return max((r.stop - r.start + r.step - 1) // r.step, 0)
+    return len(values)
+
+
+def _space_values(values):
+    """
+    參數空間的候選值
+
+    可為列表，或 {"min": 2, "max": 500, "step": 1} 形式的整數範圍；
+    範圍須先以 _space_size 檢查大小再展開
+    """
+    if isinstance(values, dict):
+        return list(_space_range(values))
+    return list(values)
+
+
+def _space_candidates(values):
+    """參數空間的候選值序列：範圍保持為 range 物件，以索引取值而不展開"""
+    if isinstance(values, dict):
+        return _space_range(values)
+    return list(values)
+
+
+def _halving_cost(candidates, eta, rungs):
+    """以 candidates 個候選開始、每輪保留 1/eta 共 rungs 輪的總評估次數"""
+    cost = 0
+    for _ in range(rungs):
+        cost += candidates
+        candidates = -(-candidates // eta)
+    return cost
+
+
+def optimize_adaptive(df, params):
+    """
+    自適應參數搜尋 (successive halving)
+
+    從參數空間隨機抽出一批候選，先以最近的一小段歷史批次回測，
+    每一輪只保留前 1/eta 名並將回測長度放大 eta 倍，最後一輪以完整歷史排名。
+    輪數由完整長度與 minBars 的比例決定，初始候選數取預算內的最大值，
+    總評估次數 (候選 × 輪) 不超過 budget，適合窮舉網格過大的情況。
+
+    Parameters:
+    -----------
+    df : DataFrame
+        股價資料
+    params : dict
+        其他回測參數，另包含:
+        - space: 參數空間 (參數名稱 -> 候選值列表或 {"min", "max", "step"} 範圍)，例如
+          {"maDays": {"min": 2, "max": 500}, "dynamicLeverage": [1, 2, 3], "tradeMode": ["long", "both"]}
+        - budget: 評估次數上限 (預設 1000)
+        - eta: 每輪保留比例的倒數 (預設 3)
+        - minBars: 第一輪的最少 K 棒數 (預設為最大均線天數 + 252)
+        - seed: 抽樣亂數種子
+        - sortBy: 排序指標 (totalReturn, maxDrawdown, winRate, finalAssets, tradeCount)
+        - topN: 回傳前幾名 (預設 10)
+        - constraints: 提前終止條件 (見 resolve_constraints)，被剪除者不晉級
+        參數空間中不影響結果的參數 (NO_EFFECT_PARAMS) 不抽樣，列於 ignoredParams；
+        空間大小不可超過 ADAPTIVE_MAX_SPACE，範圍不會被展開
+
+    Returns:
+    --------
+    dict: 最終輪排序後的前 N 名、各輪摘要與完整評估紀錄 (trace)
+    """
+    space = params.get('space') or {}
+    ignored = [k for k in space if k in NO_EFFECT_PARAMS]
+    space = {k: v for k, v in space.items() if k not in NO_EFFECT_PARAMS}
+    sort_by = params.get('sortBy', 'totalReturn')
+    top_n = max(int(params.get('topN', 10)), 1)
+    budget = max(int(params.get('budget', ADAPTIVE_BUDGET)), 1)
+    eta = max(int(params.get('eta', ADAPTIVE_ETA)), 2)
+
+    if sort_by not in GRID_SORT_METRICS:
+        return {
+            'success': False,
+            'error': f'不支援的排序指標: {sort_by}'
+        }
+
+    # 以 Python 整數計算空間大小，不展開範圍也不會溢位
+    sizes = [_space_size(v) for v in space.values()]
+    if not space or 0 in sizes:
+        return {
+            'success': False,
+            'error': '缺少參數空間'
+        }
+    space_size = math.prod(sizes)
+    if space_size > ADAPTIVE_MAX_SPACE:
+        return {
+            'success': False,
+            'error': f'參數空間大小不可超過 {ADAPTIVE_MAX_SPACE}'
+        }
+    space = {k: _space_candidates(v) for k, v in space.items()}
+
+    constraints = resolve_constraints(params)
+    base_params = {k: v for k, v in params.items()
+                   if k not in ('space', 'budget', 'eta', 'minBars', 'seed', 'sortBy', 'topN', 'constraints')}
+
+    close, dates = price_arrays(df)
+    n = len(close)
+    ma_days = space.get('maDays', [resolve_config(base_params)['ma_days']])
+    max_ma = ma_days[-1] if isinstance(ma_days, range) else max(ma_days)
+    min_bars = int(params.get('minBars') or max_ma + 252)
+    min_bars = min(max(min_bars, 2), n)
+
+    # 每輪長度為下一輪的 1/eta，第一輪不短於 min_bars
+    rung_count = 1
+    while n // eta ** rung_count >= min_bars:
+        rung_count += 1
+
+    # 在預算內取最多的初始候選數
+    low, high = 1, min(space_size, budget)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if _halving_cost(mid, eta, rung_count) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    candidates = low
+
+    # 以混合進位索引抽樣，不需展開整個網格
+    rng = np.random.default_rng(params.get('seed'))
+    picks = rng.choice(space_size, size=candidates, replace=False)
+    keys = list(space)
+    coords = np.unravel_index(picks, sizes)
+    survivors = [
+        {**base_params, **{k: space[k][int(c[j])] for k, c in zip(keys, coords)}}
+        for j in range(candidates)
+    ]
+
+    date_strings = dates_to_strings(dates)
+    trace = []
+    rungs = []
+    bars_evaluated = 0
+    results, order = [], []
+
+    for rung in range(rung_count):
+        # 回測最近 bars 根 K 棒，最後一輪為完整歷史
+        bars = n // eta ** (rung_count - 1 - rung)
+        sl = slice(n - bars, n)
+        results = run_backtest_batch_arrays(close[sl], dates[sl], survivors, constraints=constraints)
+        bars_evaluated += bars * len(survivors)
+
+        # 資料不足或被剪除的候選不晉級
+        order = [i for i, r in enumerate(results) if r['success'] and 'pruned' not in r]
+        order.sort(key=lambda i: results[i][sort_by], reverse=True)
+        final = rung == rung_count - 1
+        promoted = set(order if final else order[:-(-len(survivors) // eta)])
+
+        for i, r in enumerate(results):
+            record = {
+                'rung': rung,
+                'bars': bars,
+                'params': {k: r['params'][k] for k in keys},
+                'success': r['success']
+            }
+            if r['success']:
+                record.update({metric: r[metric] for metric in GRID_SORT_METRICS})
+                if 'pruned' in r:
+                    record['pruned'] = r['pruned']
+            if not final:
+                record['promoted'] = i in promoted
+            trace.append(record)
+
+        rungs.append({
+            'rung': rung,
+            'bars': bars,
+            'period': f"{date_strings[sl.start]} ~ {date_strings[-1]}",
+            'candidates': len(survivors),
+            'promoted': 0 if final else len(promoted)
+        })
+        if final:
+            break
+        survivors = [results[i]['params'] for i in order if i in promoted]
+        if not survivors:
+            results, order = [], []
+            break
+
+    top = []
+    for i, r in enumerate(results[j] for j in order[:top_n]):
+        top.append({
+            'rank': i + 1,
+            'params': {k: r['params'][k] for k in keys},
+            'period': r['period'],
+            'finalAssets': r['finalAssets'],
+            'totalReturn': r['totalReturn'],
+            'maxDrawdown': r['maxDrawdown'],
+            'winRate': r['winRate'],
+            'tradeCount': r['tradeCount']
+        })
+
+    result = {
+        'success': True,
+        'method': 'successiveHalving',
+        'spaceSize': space_size,
+        'candidates': candidates,
+        'budget': budget,
+        'evaluations': len(trace),
+        'barsEvaluated': bars_evaluated,
+        'eta': eta,
+        'sortBy': sort_by,
+        'rungs': rungs,
+        'top': top,
+        'trace': trace
+    }
+    if ignored:
+        result['ignoredParams'] = ignored
+    return result
+
+
+# ====================================
+# 參數敏感度熱圖
+# ====================================
+
+HEATMAP_METRICS = ('totalReturn', 'maxDrawdown', 'tradeCount')
+HEATMAP_MAX_CELLS = 10000  # 單次熱圖的格子數上限
+
+
+def sensitivity_heatmap(df, params):
+    """
+    雙參數敏感度熱圖
+
+    將兩個參數軸展開為網格，以批次引擎一次計算所有格子，
+    回傳以 y 為列、x 為欄的績效矩陣，可直接交給前端繪製。
+
+    Parameters:
+    -----------
+    df : DataFrame
+        股價資料
+    params : dict
+        其他回測參數，另包含:
+        - xAxis: {"param": "maDays", "values": [5, 10, 20]} 或 {"param": ..., "min", "max", "step"}
+        - yAxis: 同上，例如 {"param": "dynamicLeverage", "values": [1, 2, 3]}
+        不影響結果的參數 (NO_EFFECT_PARAMS) 不可作為參數軸
+
+    Returns:
+    --------
+    dict: x / y 軸設定，totalReturn、maxDrawdown、tradeCount 矩陣 (資料不足的格子為 None)
+          與報酬最高的格子
+    """
+    axes = []
+    for key in ('xAxis', 'yAxis'):
+        axis = params.get(key) or {}
+        if 'values' in axis:
+            space = axis['values']
+        elif 'min' in axis and 'max' in axis:
+            space = axis
+        else:
+            space = []
+        if not axis.get('param') or _space_size(space) == 0:
+            return {
+                'success': False,
+                'error': f'缺少 {key} 參數軸'
+            }
+        if axis['param'] in NO_EFFECT_PARAMS:
+            return {
+                'success': False,
+                'error': f"{axis['param']} 目前不影響回測結果，不可作為參數軸"
+            }
+        axes.append((axis['param'], space))
+    (x_param, x_space), (y_param, y_space) = axes
+
+    if x_param == y_param:
+        return {
+            'success': False,
+            'error': 'xAxis 與 yAxis 不可為同一參數'
+        }
+
+    # 展開前先檢查格子數，避免過大的範圍耗盡記憶體
+    if _space_size(x_space) * _space_size(y_space) > HEATMAP_MAX_CELLS:
+        return {
+            'success': False,
+            'error': f'格子數不可超過 {HEATMAP_MAX_CELLS}'
+        }
+    x_values, y_values = _space_values(x_space), _space_values(y_space)
+
+    base_params = {k: v for k, v in params.items() if k not in ('xAxis', 'yAxis')}
+    configs = expand_grid(base_params, {y_param: y_values, x_param: x_values})
+
+    close, dates = price_arrays(df)
+    results = run_backtest_batch_arrays(close, dates, configs)
+
+    width = len(x_values)
+    matrices = {
+        metric: [
+            [r[metric] if r['success'] else None for r in results[row * width:(row + 1) * width]]
+            for row in range(len(y_values))
+        ]
+        for metric in HEATMAP_METRICS
+    }
+
+    best = None
+    for idx, r in enumerate(results):
+        if r['success'] and (best is None or r['totalReturn'] > best['totalReturn']):
+            best = {
+                'x': x_values[idx % width],
+                'y': y_values[idx // width],
+                'totalReturn': r['totalReturn'],
+                'maxDrawdown': r['maxDrawdown'],
+                'tradeCount': r['tradeCount']
+            }
+
+    return {
+        'success': True,
+        'x': {'param': x_param, 'values': x_values},
+        'y': {'param': y_param, 'values': y_values},
+        **matrices,
+        'best': best
+    }
+
+
+# ====================================
+# Walk-forward 優化
+# ====================================
+
+WALK_FORWARD_METRICS = ('totalReturn', 'maxDrawdown', 'winRate')
+WALK_FORWARD_MAX_FOLDS = 500  # 單次 walk-forward 的 fold 數上限
+
+
+def _fold_search(close, months, mas, windows, arr, train_start, train_end, sort_by):
+    """
+    單一 fold 的樣本內均線搜尋
+
+    所有候選均線以批次引擎同步推進，均線取自整段序列預先算好的矩陣，
+    因此樣本內起點之前的資料可作為均線暖身。
+
+    Returns:
+    --------
+    tuple: (最佳視窗索引, 樣本內績效 dict)
+    """
+    sl = slice(train_start, train_end)
+    starts = np.maximum(windows - 1 - train_start, 0)
+    sim = _simulate_batch(close[sl], mas[:, sl], np.arange(len(windows)), months[sl], starts, arr)
+
+    initial_capital = arr['initial_capital']
+    scores = {
+        'totalReturn': (sim['capital'] - initial_capital) / initial_capital * 100,
+        'maxDrawdown': -sim['mdd'],
+        'winRate': np.where(sim['tradeCount'] > 0, sim['winCount'] / np.maximum(sim['tradeCount'], 1) * 100, 0.0)
+    }
+
+    # 視窗長於樣本內長度者無法評估
+    score = np.where(starts < train_end - train_start - 1, scores[sort_by], -np.inf)
+    best = int(np.argmax(score))
+    return best, {key: round(float(values[best]), 2) for key, values in scores.items()}
+
+
+def _run_fold_chunk(tasks):
+    """子行程任務：以共用陣列執行多個 fold 的樣本內搜尋"""
+    close, months, mas, windows, arr = _WORKER_ARRAYS
+    return [_fold_search(close, months, mas, windows, arr, *task) for task in tasks]
+
+
+def walk_forward(df, params):
     """
-    執行回測
-    
+    Walk-forward 優化
+
+    以滾動的樣本內/樣本外區間切分資料：每個 fold 在樣本內尋找最佳均線，
+    再以該均線回測緊接的樣本外區間，最後將各樣本外資金曲線串接 (資金延續到下一段)。
+    均線矩陣對整段序列只計算一次，各 fold 的搜尋以行程池並行。
+
     Parameters:
     -----------
     df : DataFrame
-        包含 'date' 和 'close' 欄位的股價資料
+        股價資料
     params : dict
-        回測參數，包含:
-        - maDays: 均線天數
-        - tradeMode: 交易模式 ('long', 'short', 'both')
-        - initialCapital: 初始資金
-        - monthlyAdd: 每月加碼金額
-        - useFixedLeverage: 是否使用固定槓桿
-        - fixedLeverage: 固定槓桿倍數
-        - useDynamicLeverage: 是否使用動態槓桿
-        - dynamicLeverage: 動態槓桿倍數
-        - enableRebalance: 是否啟用再平衡
-        - rebalancePeriod: 再平衡週期（月）
-        - pointValue: 每點價值
-        - useFee: 是否計算手續費
-        - buyFee: 買進手續費
-        - sellFee: 賣出手續費
-        - fixedLots: 固定口數
-        - lotMode: 口數模式 ('fixed', 'dynamic')
-    
+        其他回測參數，另包含:
+        - maMin, maMax: 均線搜尋範圍
+        - trainBars: 樣本內 K 棒數 (預設 756，約 3 年)
+        - testBars: 樣本外 K 棒數 (預設 252，約 1 年)，同時為滾動步長；
+          fold 數不可超過 WALK_FORWARD_MAX_FOLDS
+        - sortBy: 樣本內選擇指標 (totalReturn, maxDrawdown, winRate)
+        - workers: 行程數 (預設為 CPU 核心數，不超過核心數)
+
     Returns:
     --------
-    dict: 包含回測結果的字典
+    dict: 每個 fold 的選擇參數與績效，以及串接後的樣本外資金曲線
     """
-    # 解析參數
-    ma_days = params.get('maDays', 13)
-    trade_mode = params.get('tradeMode', 'long')  # 'long', 'short', 'both'
-    initial_capital = params.get('initialCapital', 1000000)
-    monthly_add = params.get('monthlyAdd', 0)
-    use_fixed_leverage = params.get('useFixedLeverage', True)
-    fixed_leverage = params.get('fixedLeverage', 1)
-    use_dynamic_leverage = params.get('useDynamicLeverage', False)
-    dynamic_leverage = params.get('dynamicLeverage', 2)
-    enable_rebalance = params.get('enableRebalance', True)
-    rebalance_period = params.get('rebalancePeriod', 1)  # 月
-    point_value = params.get('pointValue', 50)  # 小台每點 50 元
-    use_fee = params.get('useFee', True)
-    buy_fee = params.get('buyFee', 35)
-    sell_fee = params.get('sellFee', 35)
-    fixed_lots = params.get('fixedLots', 1)
-    lot_mode = params.get('lotMode', 'dynamic')  # 'fixed' or 'dynamic'
-    
-    # 逆價差補償參數
-    enable_backwardation = params.get('enableBackwardation', False)
-    backwardation_rate = params.get('backwardationRate', 4)  # 年化百分比
-    
-    # 確定實際使用的槓桿
-    if lot_mode == 'fixed':
-        leverage = fixed_leverage if use_fixed_leverage else 1
-    else:
-        leverage = dynamic_leverage if use_dynamic_leverage else 1
-    
-    # 計算均線
-    df = calculate_ma(df, ma_days)
-    df = df.dropna().reset_index(drop=True)
-    
-    if len(df) < 2:
+    ma_min = max(int(params.get('maMin', 5)), 1)
+    ma_max = int(params.get('maMax', 60))
+    train_bars = int(params.get('trainBars', 756))
+    test_bars = int(params.get('testBars', 252))
+    sort_by = params.get('sortBy', 'totalReturn')
+
+    if sort_by not in WALK_FORWARD_METRICS:
+        return {
+            'success': False,
+            'error': f'不支援的排序指標: {sort_by}'
+        }
+
+    close, dates = price_arrays(df)
+    n = len(close)
+    # 超過資料長度的均線永遠不會成形，不配置其均線矩陣
+    windows = np.arange(ma_min, min(ma_max, n - 1) + 1)
+
+    if len(windows) == 0 or train_bars < 2 or test_bars < 1 or n < train_bars + test_bars:
         return {
             'success': False,
             'error': '資料不足'
         }
-    
-    # 轉換交易模式
-    strategy_mode_map = {
-        'long': '只做多',
-        'short': '只做空',
-        'both': '雙向：站上多、跌破空'
-    }
-    strategy_mode = strategy_mode_map.get(trade_mode, '只做多')
-    
-    # 初始化變數
-    trades = []
-    capital_history = []
-    capital_dates = []
-    index_history = []
-    
-    capital = initial_capital
-    holding = False
-    position = None
-    entry_price = None
-    entry_date = None
-    current_lots = 0
-    last_month = df.iloc[0]['date'].month
-    days_since_rebalance = 0
-    
-    # 初始資金紀錄
-    capital_history.append(capital)
-    capital_dates.append(df.iloc[0]['date'].strftime('%Y-%m-%d'))
-    index_history.append(float(df.iloc[0]['close']))
-    
-    ma_col = f'MA{ma_days}'
-    
-    for i in range(1, len(df)):
-        row = df.iloc[i]
-        prev_row = df.iloc[i - 1]
-        current_price = float(row['close'])
-        prev_price = float(prev_row['close'])
-        current_ma = float(row[ma_col])
-        date = row['date']
-        this_month = date.month
-        
-        # 每月定期投入
-        if monthly_add > 0 and this_month != last_month:
-            capital += monthly_add
-        last_month = this_month
-        
-        # 計算信號 (價格與均線的差距)
-        action = current_price - current_ma
-        
-        # ========== 持倉期間：計算每日未實現損益 ==========
-        if holding and current_lots > 0:
-            if position == '多':
-                daily_pnl = (current_price - prev_price) * current_lots * point_value
-            else:  # 空單
-                daily_pnl = (prev_price - current_price) * current_lots * point_value
-            capital += daily_pnl
-            
-            # ========== 逆價差補償：每日按年化比例增加損益 ==========
-            if enable_backwardation and backwardation_rate > 0:
-                # 年化收益率轉為每日收益率 (假設一年約 252 個交易日)
-                daily_backwardation_rate = backwardation_rate / 100 / 252
-                # 依據持倉市值計算每日逆價差補償
-                position_value = current_lots * current_price * point_value
-                backwardation_gain = position_value * daily_backwardation_rate
-                capital += backwardation_gain
-            
-            days_since_rebalance += 1
-            
-            # 定期再平衡（僅在動態口數模式下）
-            if lot_mode == 'dynamic' and enable_rebalance:
-                # 以月為單位的再平衡
-                if this_month != last_month:
-                    months_passed = 1  # 簡化計算
-                    if months_passed >= rebalance_period:
-                        new_lots = max(int((capital * leverage) / (current_price * point_value)), 0)
-                        lot_diff = new_lots - current_lots
-                        
-                        if lot_diff != 0:
-                            rebalance_fee = abs(lot_diff) * (buy_fee + sell_fee) if use_fee else 0
-                            capital -= rebalance_fee
-                            current_lots = new_lots
-                            days_since_rebalance = 0
-        
-        # ========== 進場判斷 ==========
-        if not holding:
-            should_enter = False
-            new_position = None
-            
-            if strategy_mode == '只做多' and action > 0:
-                should_enter = True
-                new_position = '多'
-            elif strategy_mode == '只做空' and action < 0:
-                should_enter = True
-                new_position = '空'
-            elif strategy_mode == '雙向：站上多、跌破空' and action != 0:
-                should_enter = True
-                new_position = '多' if action > 0 else '空'
-            
-            if should_enter:
-                holding = True
-                position = new_position
-                entry_price = current_price
-                entry_date = date
-                days_since_rebalance = 0
-                
-                # 計算進場口數
-                if lot_mode == 'fixed':
-                    current_lots = fixed_lots
-                else:
-                    current_lots = max(int((capital * leverage) / (current_price * point_value)), 1)
-                
-                # 計入進場手續費
-                if use_fee:
-                    entry_fee = buy_fee * current_lots
-                    capital -= entry_fee
-        
-        # ========== 出場/換倉判斷 ==========
-        elif holding:
-            should_exit = False
-            should_switch = False
-            new_position_after_switch = None
-            
-            if strategy_mode == '只做多' and action < 0 and position == '多':
-                should_exit = True
-            elif strategy_mode == '只做空' and action > 0 and position == '空':
-                should_exit = True
-            elif strategy_mode == '雙向：站上多、跌破空':
-                if position == '多' and action < 0:
-                    should_switch = True
-                    new_position_after_switch = '空'
-                elif position == '空' and action > 0:
-                    should_switch = True
-                    new_position_after_switch = '多'
-            
-            if should_exit or should_switch:
-                # 計算出場手續費
-                exit_fee = sell_fee * current_lots if use_fee else 0
-                capital -= exit_fee
-                
-                # 計算總損益
-                if position == '多':
-                    total_profit = (current_price - entry_price) * current_lots * point_value
-                else:
-                    total_profit = (entry_price - current_price) * current_lots * point_value
-                
-                total_fee = exit_fee + (buy_fee * current_lots if use_fee else 0)
-                
-                # 記錄交易
-                trades.append({
-                    'id': len(trades) + 1,
-                    'entryDate': entry_date.strftime('%Y-%m-%d'),
-                    'exitDate': date.strftime('%Y-%m-%d'),
-                    'direction': 'long' if position == '多' else 'short',
-                    'holdDays': (date - entry_date).days,
-                    'entryPrice': round(entry_price, 2),
-                    'exitPrice': round(current_price, 2),
-                    'contracts': current_lots,
-                    'fee': round(total_fee, 2),
-                    'pnl': round(total_profit - total_fee, 2),
-                    'returnRate': round((total_profit - total_fee) / initial_capital * 100, 2),
-                    'capitalAfter': round(capital, 2),
-                    'entryReason': '突破MA上穿' if position == '多' else '跌破MA下穿',
-                    'exitReason': '跌破MA下穿' if position == '多' else '突破MA上穿'
-                })
-                
-                if should_switch:
-                    # 換倉
-                    position = new_position_after_switch
-                    entry_price = current_price
-                    entry_date = date
-                    days_since_rebalance = 0
-                    
-                    if lot_mode == 'fixed':
-                        current_lots = fixed_lots
-                    else:
-                        current_lots = max(int((capital * leverage) / (current_price * point_value)), 1)
-                    
-                    if use_fee:
-                        new_entry_fee = buy_fee * current_lots
-                        capital -= new_entry_fee
-                else:
-                    # 完全出場
-                    holding = False
-                    position = None
-                    entry_price = None
-                    entry_date = None
-                    current_lots = 0
-        
-        # 每日資金記錄
-        capital_history.append(capital)
-        capital_dates.append(date.strftime('%Y-%m-%d'))
-        index_history.append(current_price)
-    
-    # 計算績效指標
-    final_capital = capital_history[-1] if capital_history else initial_capital
-    total_return = (final_capital - initial_capital) / initial_capital * 100
-    
-    # 計算最大回撤
-    mdd, mdd_history = calculate_mdd(capital_history)
-    
-    # 計算勝率
-    if trades:
-        winning_trades = sum(1 for t in trades if t['pnl'] > 0)
-        win_rate = winning_trades / len(trades) * 100
+
+    # fold: 樣本內 [s, s + train)，樣本外 [s + train, s + train + test)
+    fold_starts = range(0, n - train_bars - 1, test_bars)
+    if len(fold_starts) > WALK_FORWARD_MAX_FOLDS:
+        return {
+            'success': False,
+            'error': f'fold 數不可超過 {WALK_FORWARD_MAX_FOLDS}，請加大 testBars'
+        }
+
+    months = dates_to_months(dates)
+    mas = ma_matrix(close, windows)
+    base_params = {k: v for k, v in params.items()
+                   if k not in ('maMin', 'maMax', 'trainBars', 'testBars', 'sortBy', 'workers')}
+    arr = _config_arrays([{**base_params, 'maDays': int(w)} for w in windows])
+    tasks = [(s, s + train_bars, sort_by) for s in fold_starts]
+
+    workers = pool_workers(params.get('workers'), len(tasks))
+    if workers == 1:
+        searches = [_fold_search(close, months, mas, windows, arr, *task) for task in tasks]
     else:
-        win_rate = 0
-    
+        chunk_size = -(-len(tasks) // workers)
+        chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_pool_worker,
+                                 initargs=(close, months, mas, windows, arr)) as pool:
+            searches = [r for chunk in pool.map(_run_fold_chunk, chunks) for r in chunk]
+
+    # 依序串接樣本外區間，資金延續到下一個 fold
+    cfg = resolve_config(base_params)
+    initial_capital = cfg['initial_capital']
+    capital = initial_capital
+    stitched_values = []
+    stitched_index = []
+    folds = []
+    trade_count = 0
+
+    for fold, (s, (best, in_sample)) in enumerate(zip(fold_starts, searches)):
+        test_start = s + train_bars
+        test_end = min(test_start + test_bars, n)
+        ma_days = int(windows[best])
+
+        # 以樣本內最後一根 K 棒為起點，樣本外第一根起開始交易
+        sl = slice(test_start - 1, test_end)
+        fold_cfg = dict(cfg, ma_days=ma_days, initial_capital=capital)
+        history, trades = _simulate(close[sl], mas[best, sl], months[sl], dates[sl], fold_cfg)
+
+        start_capital = capital
+        capital = history[-1]
+        trade_count += len(trades)
+        stitched_values.extend(history[1:])
+        stitched_index.append((test_start, test_end))
+
+        fold_mdd, _ = calculate_mdd(history)
+        train_period = dates_to_strings(dates[[s, s + train_bars - 1]])
+        test_period = dates_to_strings(dates[[test_start, test_end - 1]])
+        folds.append({
+            'fold': fold + 1,
+            'trainPeriod': f"{train_period[0]} ~ {train_period[1]}",
+            'testPeriod': f"{test_period[0]} ~ {test_period[1]}",
+            'ma': ma_days,
+            'inSample': in_sample,
+            'outOfSample': {
+                'totalReturn': round((capital - start_capital) / start_capital * 100, 2),
+                'maxDrawdown': round(-float(fold_mdd), 2),
+                'tradeCount': len(trades)
+            }
+        })
+
+    oos_start = stitched_index[0][0]
+    oos_end = stitched_index[-1][1]
+    equity = [initial_capital] + stitched_values
+    mdd, _ = calculate_mdd(equity)
+    equity_dates = dates_to_strings(dates[oos_start - 1:oos_end])
+
     return {
         'success': True,
+        'folds': folds,
         'results': {
-            'period': f"{df.iloc[0]['date'].strftime('%Y-%m-%d')} ~ {df.iloc[-1]['date'].strftime('%Y-%m-%d')}",
-            'finalAssets': round(final_capital, 0),
-            'totalReturn': round(total_return, 2),
-            'maxDrawdown': round(-mdd, 2),
-            'winRate': round(win_rate, 1),
-            'tradeCount': len(trades)
+            'period': f"{equity_dates[1]} ~ {equity_dates[-1]}",
+            'finalAssets': round(capital, 0),
+            'totalReturn': round((capital - initial_capital) / initial_capital * 100, 2),
+            'maxDrawdown': round(-float(mdd), 2),
+            'tradeCount': trade_count
         },
-        'trades': trades,
-        'capitalHistory': {
-            'dates': capital_dates,
-            'values': capital_history
-        },
-        'mddHistory': {
-            'dates': capital_dates,
-            'values': mdd_history
-        },
-        'indexHistory': {
-            'dates': capital_dates,
-            'values': index_history
+        'equityCurve': {
+            'dates': equity_dates,
+            'values': equity
         }
     }
 
 
-def optimize_ma(df, params):
+# ====================================
+# Monte Carlo 模擬
+# ====================================
+
+MC_CHUNK_SIZE = 256
+MC_PERCENTILES = (5, 25, 50, 75, 95)
+MC_MAX_SAMPLE_PATHS = 200  # 回傳完整路徑數上限，避免回應過大
+MC_MAX_BINS = 100  # 最終資產分布箱數上限
+
+
+def daily_returns(capital_history):
+    """資金曲線的日報酬率 (資金為 0 時以 1 作分母，與 app6.py 相同)"""
+    capital = np.asarray(capital_history, dtype=np.float64)
+    base = capital[:-1].copy()
+    base[base == 0] = 1
+    return np.diff(capital) / base
+
+
+def monte_carlo_chunks(returns, rounds, start_capital=1.0, chunk_size=MC_CHUNK_SIZE,
+                       block_size=1, seed=None):
     """
-    自動優化均線天數
-    
+    分批產生 Monte Carlo 資產路徑
+
+    以 numpy.random.Generator 一次抽出一整批的重抽樣索引，
+    每批只保留 chunk_size 條路徑，記憶體用量與模擬次數無關。
+
     Parameters:
     -----------
-    df : DataFrame
-        股價資料
-    params : dict
-        包含 maMin, maMax 和其他回測參數
-    
+    returns : array-like
+        歷史日報酬率
+    rounds : int
+        模擬次數
+    start_capital : float
+        路徑起始資金
+    chunk_size : int
+        每批路徑數
+    block_size : int
+        區塊重抽樣長度；1 為逐日獨立抽樣，大於 1 時抽取連續區塊以保留報酬的序列相關
+    seed : int, optional
+        隨機種子
+
+    Yields:
+    -------
+    ndarray: 形狀 (批次路徑數, 報酬天數) 的資產路徑
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    n = len(returns)
+    if n == 0:
+        return
+
+    rng = np.random.default_rng(seed)
+    chunk_size = max(int(chunk_size), 1)
+    block_size = min(max(int(block_size), 1), n)
+    n_blocks = -(-n // block_size)
+    offsets = np.arange(block_size)
+
+    done = 0
+    while done < rounds:
+        size = min(chunk_size, rounds - done)
+        if block_size == 1:
+            idx = rng.integers(0, n, size=(size, n))
+        else:
+            starts = rng.integers(0, n - block_size + 1, size=(size, n_blocks))
+            idx = (starts[:, :, None] + offsets).reshape(size, -1)[:, :n]
+        yield start_capital * np.cumprod(1 + returns[idx], axis=1)
+        done += size
+
+
+def asset_histogram(final_assets, remove_low_pct=5, remove_high_pct=5, bins=10):
+    """
+    最終資產分布：去除前後百分位後分箱，箱界取整到萬元 (與 app6.py 相同)
+
     Returns:
     --------
-    dict: 包含優化結果
+    dict: lower / upper 過濾界線與 edges / counts
     """
-    ma_min = params.get('maMin', 5)
-    ma_max = params.get('maMax', 60)
-    
-    results = []
-    
-    # 使用固定的 MA 列表，確保快速執行
-    ma_list = [5, 10, 15, 20, 30, 60]
-    
-    for ma in ma_list:
-        test_params = params.copy()
-        test_params['maDays'] = ma
-        
-        result = run_backtest(df.copy(), test_params)
-        
-        if result['success']:
-            results.append({
-                'ma': ma,
-                'totalReturn': result['results']['totalReturn'],
-                'maxDrawdown': result['results']['maxDrawdown'],
-                'winRate': result['results']['winRate'],
-                'tradeCount': result['results']['tradeCount']
-            })
-    
-    # 排序並取前三名
-    results.sort(key=lambda x: x['totalReturn'], reverse=True)
-    
-    top3 = results[:3]
-    for i, r in enumerate(top3):
-        r['rank'] = i + 1
-        r['avgReturn'] = r['totalReturn'] / max(r['tradeCount'], 1)
-    
+    final_assets = np.asarray(final_assets, dtype=np.float64)
+    lower = np.percentile(final_assets, remove_low_pct)
+    upper = np.percentile(final_assets, 100 - remove_high_pct)
+    filtered = final_assets[(final_assets >= lower) & (final_assets <= upper)]
+    if len(filtered) == 0:
+        return {'lower': float(lower), 'upper': float(upper), 'edges': [], 'counts': []}
+
+    # 以浮點數計算箱界 (取整方式同 int 截斷)，資產極大時也不會超出 int64 範圍
+    min_asset = np.floor(filtered.min() / 10000) * 10000
+    max_asset = np.ceil(filtered.max() / 10000) * 10000
+    if max_asset > min_asset:
+        edges = np.floor(np.linspace(min_asset, max_asset, bins + 1))
+    else:
+        edges = np.array([min_asset, min_asset + 10000])
+    counts, edges = np.histogram(filtered, bins=edges)
     return {
+        'lower': round(float(lower), 0),
+        'upper': round(float(upper), 0),
+        'edges': edges.tolist(),
+        'counts': counts.tolist()
+    }
+
+
+@timed('montecarlo')
+def monte_carlo(capital_history, params, dates=None, progress=None):
+    """
+    Monte Carlo 模擬
+
+    由資金曲線的日報酬率重抽樣產生模擬路徑。路徑分批產生後立即彙總：
+    只保留每條路徑的最終資產、最大回撤與少數取樣時點的資產，
+    百分位帶與最終資產分布都由這些摘要計算，不保存完整路徑。
+
+    Parameters:
+    -----------
+    capital_history : array-like
+        回測資金曲線
+    params : dict
+        - rounds: 模擬次數 (預設 500)
+        - seed: 隨機種子 (預設 42)
+        - blockSize: 區塊重抽樣長度 (預設 1)
+        - chunkSize: 每批路徑數 (不超過 MC_CHUNK_SIZE，記憶體用量固定)
+        - percentiles: 百分位帶 (預設 5, 25, 50, 75, 95)
+        - maxPoints: 百分位帶的取樣時點數 (預設 200)
+        - samplePaths: 回傳的完整路徑數 (預設 0，上限 MC_MAX_SAMPLE_PATHS)
+        - removeLowPct, removeHighPct: 最終資產分布去除的前後百分比 (預設 5)
+        - bins: 分布箱數 (預設 10，上限 MC_MAX_BINS)
+    dates : list, optional
+        資金曲線對應日期
+    progress : callable, optional
+        每批完成後以 (已完成次數, 總次數) 呼叫
+
+    Returns:
+    --------
+    dict: 百分位帶、最終資產統計與分布、最大回撤統計
+    """
+    returns = daily_returns(capital_history)
+    if len(returns) == 0:
+        return {
+            'success': False,
+            'error': '資金數據不足'
+        }
+
+    rounds = max(int(params.get('rounds', 500)), 1)
+    seed = params.get('seed', 42)
+    block_size = int(params.get('blockSize', 1))
+    chunk_size = min(max(int(params.get('chunkSize', MC_CHUNK_SIZE)), 1), MC_CHUNK_SIZE)
+    percentiles = [float(p) for p in params.get('percentiles', MC_PERCENTILES)]
+    max_points = max(int(params.get('maxPoints', 200)), 2)
+    sample_paths = min(max(int(params.get('samplePaths', 0)), 0), MC_MAX_SAMPLE_PATHS)
+
+    start_capital = float(capital_history[0])
+    n = len(returns)
+
+    # 百分位帶的取樣時點 (路徑第 i 點對應資金曲線第 i + 1 點)
+    checkpoints = np.unique(np.linspace(0, n - 1, min(max_points, n)).round().astype(np.int64))
+
+    final_assets = np.empty(rounds)
+    max_drawdowns = np.empty(rounds)
+    checkpoint_values = np.empty((rounds, len(checkpoints)))
+    samples = []
+
+    done = 0
+    for paths in monte_carlo_chunks(returns, rounds, start_capital, chunk_size, block_size, seed):
+        size = len(paths)
+        final_assets[done:done + size] = paths[:, -1]
+        checkpoint_values[done:done + size] = paths[:, checkpoints]
+
+        peaks = np.maximum(np.maximum.accumulate(paths, axis=1), start_capital)
+        max_drawdowns[done:done + size] = ((peaks - paths) / peaks * 100).max(axis=1)
+
+        if len(samples) < sample_paths:
+            samples.extend(paths[:sample_paths - len(samples)].round(0).tolist())
+
+        done += size
+        if progress is not None:
+            progress(done, rounds)
+
+    bands = np.percentile(checkpoint_values, percentiles, axis=0)
+    point_index = (checkpoints + 1).tolist()
+    if dates is not None:
+        point_labels = [dates[i] for i in point_index]
+    else:
+        point_labels = point_index
+
+    result = {
         'success': True,
-        'top3': top3,
-        'allResults': results
+        'rounds': rounds,
+        'days': n,
+        'blockSize': max(min(block_size, n), 1),
+        'startCapital': round(start_capital, 0),
+        'bands': {
+            'points': point_labels,
+            'percentiles': {
+                f'p{p:g}': band.round(0).tolist() for p, band in zip(percentiles, bands)
+            }
+        },
+        'finalAssets': {
+            'mean': round(float(final_assets.mean()), 0),
+            'min': round(float(final_assets.min()), 0),
+            'max': round(float(final_assets.max()), 0),
+            'percentiles': {
+                f'p{p:g}': round(float(v), 0)
+                for p, v in zip(percentiles, np.percentile(final_assets, percentiles))
+            },
+            'lossProbability': round(float((final_assets < start_capital).mean() * 100), 2)
+        },
+        'maxDrawdown': {
+            'percentiles': {
+                f'p{p:g}': round(-float(v), 2)
+                for p, v in zip(percentiles, np.percentile(max_drawdowns, percentiles))
+            }
+        },
+        'histogram': asset_histogram(
+            final_assets,
+            params.get('removeLowPct', 5),
+            params.get('removeHighPct', 5),
+            min(max(int(params.get('bins', 10)), 1), MC_MAX_BINS)
+        )
+    }
+    if sample_paths:
+        result['samplePaths'] = samples
+    return result
+
+
+# ====================================
+# 多商品回測
+# ====================================
+
+def _symbol_backtest(dates, close, params):
+    """
+    單一商品的回測 (已對齊日期的陣列)
+
+    均線與 run_backtest 相同以 rolling mean 計算，結果與單獨回測該商品一致。
+
+    Returns:
+    --------
+    tuple: (績效 dict, 起始索引, 資金曲線)；資料不足時績效 dict 含 error
+    """
+    ma_days = int(params.get('maDays', 13))
+    ma = pd.Series(close).rolling(window=ma_days).mean().to_numpy()
+    first = ma_days - 1
+    if ma_days < 1 or len(close) - first < 2:
+        return {'success': False, 'error': '資料不足'}, 0, []
+
+    cfg = resolve_config(params)
+    sl = slice(first, None)
+    capital_history, trades = _simulate(close[sl], ma[sl], dates_to_months(dates[sl]), dates[sl], cfg)
+    summary = _summarize(capital_history, trades, cfg['initial_capital'])
+    return {'success': True, **summary}, first, capital_history
+
+
+def _run_symbol_chunk(tasks):
+    """子行程任務：以共用的日期與收盤價矩陣回測多個商品"""
+    dates, closes = _WORKER_ARRAYS
+    return [_symbol_backtest(dates, closes[row], params) for row, params in tasks]
+
+
+def run_backtest_symbols(dates, closes, symbols, params_list, workers=None):
+    """
+    多商品回測
+
+    所有商品已對齊到同一組交易日，各商品以各自的參數回測 (行程池並行)，
+    並以等權重組合 (起點平均分配資金、之後不再平衡) 計算合併資金曲線。
+
+    Parameters:
+    -----------
+    dates : ndarray (int64)
+        共同交易日 (epoch 日數)
+    closes : ndarray
+        形狀 (商品數, 日數) 的收盤價矩陣
+    symbols : list of str
+        商品代號，順序同 closes 的列
+    params_list : list of dict
+        各商品的回測參數
+    workers : int, optional
+        行程數 (預設為 CPU 核心數)
+
+    Returns:
+    --------
+    dict: 各商品績效與等權重合併資金曲線
+    """
+    if len(dates) < 2:
+        return {
+            'success': False,
+            'error': '共同交易日不足'
+        }
+
+    workers = min(max(int(workers or os.cpu_count() or 1), 1), len(symbols))
+    tasks = list(enumerate(params_list))
+
+    if workers == 1:
+        outputs = [_symbol_backtest(dates, closes[row], params) for row, params in tasks]
+    else:
+        chunk_size = -(-len(tasks) // workers)
+        chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_pool_worker,
+                                 initargs=(dates, closes)) as pool:
+            outputs = [r for chunk in pool.map(_run_symbol_chunk, chunks) for r in chunk]
+
+    period = dates_to_strings(dates[[0, -1]])
+    per_symbol = []
+    curves = []
+    for symbol, (summary, first, capital_history) in zip(symbols, outputs):
+        entry = {'symbol': symbol, **summary}
+        if summary['success']:
+            entry['period'] = ' ~ '.join(dates_to_strings(dates[[first, -1]]))
+            curves.append((first, np.asarray(capital_history, dtype=np.float64)))
+        per_symbol.append(entry)
+
+    result = {
+        'success': True,
+        'period': f"{period[0]} ~ {period[1]}",
+        'bars': len(dates),
+        'symbols': per_symbol,
+        'combined': None
+    }
+    if not curves:
+        return result
+
+    # 等權重合併：從所有商品均線都已成形的共同起點開始，各商品以起點資金正規化後平均
+    start = max(first for first, _ in curves)
+    growth = np.mean([curve[start - first:] / curve[start - first] for first, curve in curves], axis=0)
+    initial_capital = resolve_config(params_list[0])['initial_capital']
+    combined = initial_capital * growth
+    mdd, _ = calculate_mdd(combined)
+    combined_dates = dates_to_strings(dates[start:])
+
+    result['combined'] = {
+        'results': {
+            'period': f"{combined_dates[0]} ~ {combined_dates[-1]}",
+            'symbols': len(curves),
+            'finalAssets': round(float(combined[-1]), 0),
+            'totalReturn': round(float(growth[-1] - 1) * 100, 2),
+            'maxDrawdown': round(-float(mdd), 2)
+        },
+        'capitalHistory': {
+            'dates': combined_dates,
+            'values': combined.tolist()
+        }
     }
+    return result
+
+
+# ====================================
+# 串流市場信號
+# ====================================
+
+class MarketSignalTracker:
+    """
+    單一均線天數的串流市場信號
+
+    以環形緩衝區維護最近 maDays 根收盤價與其總和，每根新 K 棒 O(1) 更新均線；
+    近 100 根的多空信號同樣保存在固定長度的 NumPy 環形陣列中。
+    """
+
+    def __init__(self, ma_days, history=100):
+        self.ma_days = ma_days
+        self.history = history
+
+        self._window = np.zeros(ma_days)
+        self._window_pos = 0
+        self._window_count = 0
+        self._window_sum = 0.0
+        self._updates = 0
+
+        # 信號：1 = 做多, -1 = 做空, 0 = 均線尚未成形
+        self._signals = np.zeros(history, dtype=np.int8)
+        self._signal_dates = np.zeros(history, dtype=np.int64)
+        self._signal_pos = 0
+        self._signal_count = 0
+
+        self.last_date = None
+        self.last_close = None
+        self.last_ma = float('nan')
+
+        # 建立時資料集的 historyVersion (df.attrs)，既有 K 棒被修正時不再沿用
+        self.history_version = None
+
+    @classmethod
+    def from_arrays(cls, close, dates, ma_days, history=100):
+        """只取尾端 maDays + history 根資料建立追蹤器"""
+        tracker = cls(ma_days, history)
+        tail = ma_days + history - 1
+        for day, price in zip(dates[-tail:].tolist(), close[-tail:].tolist()):
+            tracker.update(day, price)
+        return tracker
+
+    def update(self, date, close):
+        """
+        加入一根新 K 棒
+
+        Parameters:
+        -----------
+        date : int
+            epoch 日數
+        close : float
+            收盤價
+        """
+        pos = self._window_pos
+        if self._window_count == self.ma_days:
+            self._window_sum -= self._window[pos]
+        else:
+            self._window_count += 1
+        self._window[pos] = close
+        self._window_sum += close
+        self._window_pos = (pos + 1) % self.ma_days
+
+        # 每輪重新加總一次，避免浮點誤差累積
+        self._updates += 1
+        if self._updates % self.ma_days == 0:
+            self._window_sum = float(self._window.sum())
+
+        if self._window_count == self.ma_days:
+            self.last_ma = self._window_sum / self.ma_days
+            signal = 1 if close > self.last_ma else -1
+        else:
+            self.last_ma = float('nan')
+            signal = 0
+
+        self._signals[self._signal_pos] = signal
+        self._signal_dates[self._signal_pos] = date
+        self._signal_pos = (self._signal_pos + 1) % self.history
+        self._signal_count = min(self._signal_count + 1, self.history)
+
+        self.last_date = date
+        self.last_close = close
+
+    def recent_signals(self):
+        """依時間順序回傳近 history 根中均線已成形的 (日期, 信號)"""
+        order = np.roll(np.arange(self.history), -self._signal_pos)[self.history - self._signal_count:]
+        signals = self._signals[order]
+        valid = signals != 0
+        return self._signal_dates[order][valid], signals[valid]
+
+    def status(self):
+        """由已計算的狀態回傳市場狀態 (格式同 get_market_status)"""
+        latest_price = float(self.last_close)
+        latest_ma = float(self.last_ma)
+        diff = latest_price - latest_ma
+        signal = 'long' if diff > 0 else 'short'
+        dates, signals = self.recent_signals()
+
+        return {
+            'latestDate': dates_to_strings(np.array([self.last_date]))[0],
+            'latestPrice': round(latest_price, 2),
+            'maValue': round(latest_ma, 2),
+            'priceDiff': round(diff, 2),
+            'signal': signal,
+            'signalText': '做多' if signal == 'long' else '做空',
+            'recent100': {
+                'dates': dates_to_strings(dates),
+                'signals': signals.tolist()
+            }
+        }
+
+
+# 每個均線天數一個追蹤器，跨請求共用；超過上限時淘汰最久未使用者
+MARKET_TRACKERS_SIZE = 16
+_market_trackers = OrderedDict()
+_market_trackers_lock = threading.Lock()
 
 
 def get_market_status(df, ma_days):
     """
     獲取最新市場狀態
     
+    沿用該均線天數的 MarketSignalTracker；資料只新增 K 棒時逐根更新，
+    若資料集的 historyVersion (df.attrs) 改變或最後已知 K 棒的收盤價改變
+    (資料被替換或修正) 才重新建立。
+    
     Parameters:
     -----------
     df : DataFrame
-        股價資料
+        股價資料 (依日期排序)
     ma_days : int
         均線天數
     
@@ -396,36 +3016,35 @@ def get_market_status(df, ma_days):
     --------
     dict: 市場狀態
     """
-    df = calculate_ma(df, ma_days)
-    
-    latest = df.iloc[-1]
-    latest_price = float(latest['close'])
-    latest_ma = float(latest[f'MA{ma_days}'])
-    latest_date = latest['date'].strftime('%Y-%m-%d')
-    
-    diff = latest_price - latest_ma
-    signal = 'long' if diff > 0 else 'short'
-    
-    # 計算近100天信號
-    recent_100 = df.tail(100).copy()
-    signals = []
-    dates = []
+    ma_days = int(ma_days)
+    if ma_days < 1:
+        raise ValueError(f'均線天數必須至少為 1: {ma_days}')
+    date_col = df['date']
+    history_version = df.attrs.get('historyVersion')
     
-    for _, row in recent_100.iterrows():
-        if pd.notna(row[f'MA{ma_days}']):
-            sig = 1 if row['close'] > row[f'MA{ma_days}'] else -1
-            signals.append(sig)
-            dates.append(row['date'].strftime('%Y-%m-%d'))
-    
-    return {
-        'latestDate': latest_date,
-        'latestPrice': round(latest_price, 2),
-        'maValue': round(latest_ma, 2),
-        'priceDiff': round(diff, 2),
-        'signal': signal,
-        'signalText': '做多' if signal == 'long' else '做空',
-        'recent100': {
-            'dates': dates,
-            'signals': signals
-        }
-    }
+    with _market_trackers_lock:
+        tracker = _market_trackers.get(ma_days)
+        
+        if tracker is not None:
+            _market_trackers.move_to_end(ma_days)
+            last_date = pd.Timestamp(tracker.last_date, unit='D')
+            pos = int(date_col.searchsorted(last_date, side='right'))
+            known = tracker.history_version == history_version and \
+                pos > 0 and date_col.iloc[pos - 1] == last_date and \
+                float(df['close'].iloc[pos - 1]) == tracker.last_close
+            
+            if known:
+                if pos < len(df):
+                    close, dates = price_arrays(df.iloc[pos:])
+                    for day, price in zip(dates.tolist(), close.tolist()):
+                        tracker.update(day, price)
+                return tracker.status()
+        
+        close, dates = price_arrays(df)
+        tracker = MarketSignalTracker.from_arrays(close, dates, ma_days)
+        tracker.history_version = history_version
+        _market_trackers[ma_days] = tracker
+        _market_trackers.move_to_end(ma_days)
+        while len(_market_trackers) > MARKET_TRACKERS_SIZE:
+            _market_trackers.popitem(last=False)
+        return tracker.status()
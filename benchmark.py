@@ -0,0 +1,311 @@
+"""
+Benchmark Suite
+效能基準測試 - 以快取資料與合成長序列量測回測引擎、API 端點與 JSON 序列化的耗時
+
+用法:
+    python benchmark.py                                  # 快取資料 + 5k / 50k 合成序列
+    python benchmark.py --sizes 5k 50k 1m --full         # 含 1M 根 K 棒與重量級項目
+    python benchmark.py --output baseline.json           # 儲存結果作為基準
+    python benchmark.py --compare baseline.json          # 與基準比較，變慢超過門檻時回傳非 0
+    python benchmark.py --no-formats                     # 不量測各快取格式的載入時間
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import backtest_engine as engine
+from binary_cache import export_table, read_cache, write_cache
+
+
+# 合成序列的長度
+SYNTHETIC_SIZES = {'5k': 5_000, '50k': 50_000, '1m': 1_000_000}
+
+# 超過此長度的資料集預設略過重量級項目 (均線優化、網格、Monte Carlo 與 API)
+HEAVY_LIMIT = 100_000
+
+# XLSX 寫入很慢，超過此長度的資料集不量測 XLSX 載入
+XLSX_LIMIT = 100_000
+
+# 比較模式預設門檻：中位數變慢超過 25% 視為退步
+REGRESSION_THRESHOLD = 0.25
+
+BACKTEST_PARAMS = {
+    'maDays': 20,
+    'tradeMode': 'both',
+    'initialCapital': 1000000,
+    'pointValue': 50,
+    'lotMode': 'dynamic',
+    'useFee': True,
+    'buyFee': 35,
+    'sellFee': 35
+}
+
+
+def synthetic_data(n, seed=0):
+    """
+    產生合成股價序列 (幾何隨機漫步，每日一根 K 棒)
+
+    日期自 1900-01-01 起逐日遞增，以秒為單位儲存，1M 根 K 棒也不會超出日期範圍。
+    """
+    rng = np.random.default_rng(seed)
+    log_returns = rng.normal(0.0, 0.01, n)
+    close = np.round(10000 * np.exp(np.cumsum(log_returns)), 2)
+    dates = (np.datetime64('1900-01-01', 'D') + np.arange(n)).astype('datetime64[s]')
+    return pd.DataFrame({'date': dates, 'close': close})
+
+
+def cache_data():
+    """讀取 stock_data_cache.csv"""
+    return pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stock_data_cache.csv'),
+                       parse_dates=['date'])
+
+
+def measure(fn, repeat, setup=None):
+    """
+    執行 fn 共 repeat 次並回傳耗時統計 (毫秒)
+
+    setup 於每次計時前呼叫，不計入耗時。
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'min_ms': round(min(timings), 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'runs': repeat
+    }
+
+
+def cold_cache():
+    """清除指標快取，量測完整計算"""
+    engine.indicator_cache.invalidate()
+
+
+def engine_cases(df, heavy):
+    """回測引擎的量測項目：(名稱, 函式, setup)"""
+    n = len(df)
+    close = df['close'].to_numpy(dtype=np.float64)
+    result = engine.run_backtest(df, BACKTEST_PARAMS)
+    columnar = engine.run_backtest(df, BACKTEST_PARAMS, result_format='columnar')
+    capital = result['capitalHistory']['values']
+
+    cases = [
+        ('engine.run_backtest[long]', lambda: engine.run_backtest(df, dict(BACKTEST_PARAMS, tradeMode='long')), cold_cache),
+        ('engine.run_backtest[both]', lambda: engine.run_backtest(df, BACKTEST_PARAMS), cold_cache),
+        ('engine.run_backtest[both,warm]', lambda: engine.run_backtest(df, BACKTEST_PARAMS), None),
+        ('engine.run_backtest[columnar]', lambda: engine.run_backtest(df, BACKTEST_PARAMS, result_format='columnar'), cold_cache),
+        ('engine.ma_matrix[5-60]', lambda: engine.ma_matrix(close, np.arange(5, 61)), None),
+        ('engine.calculate_mdd', lambda: engine.calculate_mdd(capital), None),
+        ('engine.analyze_drawdowns', lambda: engine.analyze_drawdowns(capital), None),
+        ('engine.downsample_result[1000]', lambda: engine.downsample_result(result, 1000), None),
+        ('json.dumps[records]', lambda: json.dumps(result), None),
+        ('json.dumps[columnar]', lambda: json.dumps(columnar), None),
+    ]
+
+    if heavy:
+        grid = {'maDays': [10, 20, 60], 'tradeMode': ['long', 'both'], 'dynamicLeverage': [1, 2]}
+        configs = engine.expand_grid(dict(BACKTEST_PARAMS, useDynamicLeverage=True), grid)
+        mc_params = {'rounds': 500, 'seed': 42, 'chunkSize': max(4_000_000 // n, 1)}
+        cases += [
+            ('engine.optimize_ma[5-60]', lambda: engine.optimize_ma(df, dict(BACKTEST_PARAMS, maMin=5, maMax=60)), cold_cache),
+            ('engine.run_backtest_batch[12]', lambda: engine.run_backtest_batch(df, configs), None),
+            ('engine.monte_carlo[500]', lambda: engine.monte_carlo(capital, mc_params), None),
+        ]
+    return cases
+
+
+def format_cases(df, tmp):
+    """
+    各快取格式的冷載入量測項目：由檔案讀成 date/close DataFrame，不使用行程內快取
+
+    作業系統的磁碟快取在寫入後已是熱的，量測的是解析與轉換成本。
+    """
+    dates = df['date'].to_numpy()
+    close = df['close'].to_numpy(dtype=np.float64)
+    paths = {
+        'csv': os.path.join(tmp, 'bars.csv'),
+        'xlsx': os.path.join(tmp, 'bars.xlsx'),
+        'npy': os.path.join(tmp, 'bars.npy')
+    }
+    export_table(paths['csv'], dates, close)
+    write_cache(paths['npy'], dates, close)
+
+    def npy_frame(mmap):
+        def run():
+            npy_dates, npy_close = read_cache(paths['npy'], mmap=mmap)
+            return pd.DataFrame({'date': npy_dates, 'close': npy_close})
+        return run
+
+    cases = [
+        ('load.csv', paths['csv'], lambda: pd.read_csv(paths['csv'], parse_dates=['date'])),
+        ('load.npy', paths['npy'], npy_frame(False)),
+        ('load.npy[mmap]', paths['npy'], npy_frame(True)),
+    ]
+
+    if len(df) <= XLSX_LIMIT:
+        try:
+            export_table(paths['xlsx'], dates, close)
+            cases.append(('load.xlsx', paths['xlsx'], lambda: pd.read_excel(paths['xlsx'], parse_dates=['date'])))
+        except ImportError as e:
+            print(f"[WARN] 略過 XLSX 格式: {e}")
+    return cases
+
+
+def api_cases(client):
+    """Flask 端點的量測項目 (透過 test client，含 JSON 序列化)"""
+    backtest_body = dict(BACKTEST_PARAMS, startDate='1900-01-01', endDate='9999-12-31')
+
+    def call(method, url, body=None):
+        def run():
+            response = client.open(url, method=method, json=body)
+            assert response.status_code == 200, f'{url}: HTTP {response.status_code}'
+            response.get_data()
+        return run
+
+    return [
+        ('api.GET /api/data', call('GET', '/api/data?startDate=1900-01-01'), None),
+        ('api.GET /api/data[columnar]', call('GET', '/api/data?startDate=1900-01-01&format=columnar'), None),
+        ('api.GET /api/market', call('GET', '/api/market'), None),
+        ('api.POST /api/backtest', call('POST', '/api/backtest', backtest_body), cold_cache),
+        ('api.POST /api/backtest[state cache]', call('POST', '/api/backtest', dict(backtest_body, endDate=None)), None),
+        ('api.POST /api/backtest[maxPoints]', call('POST', '/api/backtest', dict(backtest_body, maxPoints=1000)), None),
+        ('api.POST /api/backtest[columnar]', call('POST', '/api/backtest?format=columnar', backtest_body), None),
+        ('api.POST /api/optimize', call('POST', '/api/optimize', dict(backtest_body, maMin=5, maMax=60)), cold_cache),
+    ]
+
+
+def run_dataset(label, df, repeat, heavy, with_api, with_formats, results):
+    """量測單一資料集，結果以 '資料集/項目' 為鍵寫入 results"""
+    print(f"[INFO] 資料集 {label}: {len(df)} 筆 (重量級項目: {'是' if heavy else '否'})")
+
+    for name, fn, setup in engine_cases(df, heavy):
+        results[f'{label}/{name}'] = dict(measure(fn, repeat, setup), bars=len(df))
+        print(f"  {name:<40} {results[f'{label}/{name}']['median_ms']:>12.2f} ms")
+
+    if with_formats:
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, path, fn in format_cases(df, tmp):
+                results[f'{label}/{name}'] = dict(measure(fn, repeat), bars=len(df), bytes=os.path.getsize(path))
+                print(f"  {name:<40} {results[f'{label}/{name}']['median_ms']:>12.2f} ms"
+                      f"  ({os.path.getsize(path) / 1024:.0f} KB)")
+
+    if not with_api:
+        return
+
+    import api
+
+    # 以暫存 .npy 作為 API 的快取檔，並延長有效期限，整個量測過程不連線
+    original = (api.CACHE_FILE, api.CACHE_EXPIRY_HOURS)
+    with tempfile.TemporaryDirectory() as tmp:
+        api.CACHE_FILE = os.path.join(tmp, 'stock_data_cache.npy')
+        api.CACHE_EXPIRY_HOURS = 24 * 365
+        write_cache(api.CACHE_FILE, df['date'].to_numpy(), df['close'].to_numpy())
+        try:
+            cases = [('api.load_stock_data', lambda: api.load_stock_data('1900-01-01'), None)]
+            if heavy:
+                cases += api_cases(api.app.test_client())
+            for name, fn, setup in cases:
+                results[f'{label}/{name}'] = dict(measure(fn, repeat, setup), bars=len(df))
+                print(f"  {name:<40} {results[f'{label}/{name}']['median_ms']:>12.2f} ms")
+        finally:
+            api.CACHE_FILE, api.CACHE_EXPIRY_HOURS = original
+
+
+def compare(results, baseline, threshold):
+    """
+    與基準結果比較中位數耗時
+
+    Returns:
+    --------
+    list: 變慢超過門檻的項目名稱
+    """
+    regressions = []
+    print(f"\n{'項目':<60} {'基準 ms':>12} {'目前 ms':>12} {'比例':>8}")
+    for key in sorted(set(results) & set(baseline)):
+        base = baseline[key]['median_ms']
+        current = results[key]['median_ms']
+        ratio = current / base if base > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  << 退步'
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            flag = '  (加速)'
+        print(f"{key:<60} {base:>12.2f} {current:>12.2f} {ratio:>7.2f}x{flag}")
+
+    missing = sorted(set(baseline) - set(results))
+    if missing:
+        print(f"[WARN] 基準中有 {len(missing)} 個項目本次未量測")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='回測引擎與 API 效能基準測試')
+    parser.add_argument('--sizes', nargs='*', default=['5k', '50k'], choices=sorted(SYNTHETIC_SIZES),
+                        help='合成序列長度 (預設 5k 50k)')
+    parser.add_argument('--no-cache-data', action='store_true', help='不量測 stock_data_cache.csv')
+    parser.add_argument('--no-api', action='store_true', help='不量測 Flask 端點')
+    parser.add_argument('--no-formats', action='store_true', help='不量測各快取格式 (CSV / XLSX / .npy) 的載入時間')
+    parser.add_argument('--full', action='store_true', help=f'超過 {HEAVY_LIMIT} 筆的資料集也執行重量級項目')
+    parser.add_argument('--repeat', type=int, default=5, help='每個項目的執行次數 (預設 5)')
+    parser.add_argument('--output', default='benchmark_results.json', help='結果輸出檔 (JSON)')
+    parser.add_argument('--compare', metavar='BASELINE', help='與此基準檔比較並標示退步')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help=f'退步門檻 (中位數變慢比例，預設 {REGRESSION_THRESHOLD})')
+    args = parser.parse_args(argv)
+
+    datasets = []
+    if not args.no_cache_data:
+        datasets.append(('cache', cache_data()))
+    for size in args.sizes:
+        datasets.append((size, synthetic_data(SYNTHETIC_SIZES[size])))
+
+    results = {}
+    for label, df in datasets:
+        heavy = args.full or len(df) <= HEAVY_LIMIT
+        run_dataset(label, df, args.repeat, heavy, not args.no_api, not args.no_formats, results)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpuCount': os.cpu_count(),
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[INFO] 結果已寫入 {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"[ERROR] {len(regressions)} 個項目變慢超過 {args.threshold:.0%}")
+            return 1
+        print("[INFO] 未發現退步")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
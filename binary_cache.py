@@ -0,0 +1,283 @@
+"""
+Binary Bar Cache
+二進位 K 棒快取 - 以 .npy 結構化陣列 (date, close) 儲存收盤價，可用 mmap 直接開啟
+
+CSV / XLSX 仍可作為匯入與匯出格式；舊的文字快取在第一次載入時自動轉為 .npy。
+更新時只下載最後快取日之後的資料 (見 refresh_start / update_cache)，修正的收盤價就地覆寫、新 K 棒附加到檔尾。
+只依賴 NumPy 與 pandas，Flask API 與 Streamlit 版 (appV8-main/app6.py) 共用。
+"""
+
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# 快取檔格式：日期 (秒) 與收盤價，依日期排序
+CACHE_DTYPE = np.dtype([('date', 'datetime64[s]'), ('close', '<f8')])
+
+# 可匯入 / 匯出的文字格式
+TABLE_FORMATS = ('.csv', '.xlsx')
+
+# 預設是否以 mmap 開啟：Windows 上仍有對應檢視的檔案無法被取代或截斷，
+# 常駐的 mmap 會讓之後的快取更新失敗，因此改為讀入記憶體
+MMAP_DEFAULT = os.name != 'nt'
+
+# 增量更新時往前重疊的日曆天數，用來取得被修正的收盤價
+REFRESH_OVERLAP_DAYS = 7
+
+
+def to_records(dates, close):
+    """
+    將日期與收盤價轉為依日期排序的快取陣列 (去除日期缺值，同一天保留最後一筆)
+
+    Returns:
+    --------
+    ndarray: CACHE_DTYPE 結構化陣列
+    """
+    dates = np.asarray(dates).astype('datetime64[s]')
+    close = np.asarray(close, dtype=np.float64)
+    valid = ~np.isnat(dates)
+    dates, close = dates[valid], close[valid]
+
+    # 反轉後 unique 取第一次出現 = 原順序中的最後一筆
+    dates, last = np.unique(dates[::-1], return_index=True)
+    records = np.empty(len(dates), dtype=CACHE_DTYPE)
+    records['date'] = dates
+    records['close'] = close[::-1][last]
+    return records
+
+
+def write_cache(path, dates, close):
+    """
+    寫入 .npy 快取
+
+    先寫入暫存檔再以 os.replace 取代，其他行程不會讀到寫到一半的檔案。
+    """
+    records = to_records(dates, close)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        np.save(f, records)
+    os.replace(tmp, path)
+    return len(records)
+
+
+def read_cache(path, mmap=None):
+    """
+    讀取 .npy 快取
+
+    Parameters:
+    -----------
+    path : str
+        快取檔路徑
+    mmap : bool, optional
+        是否以唯讀 mmap 開啟 (不複製到記憶體)；預設為 MMAP_DEFAULT
+
+    Returns:
+    --------
+    tuple: (dates, close)，dates 為 datetime64[s]，close 為 float64 (mmap 時為唯讀檢視)
+    """
+    if mmap is None:
+        mmap = MMAP_DEFAULT
+    records = np.load(path, mmap_mode='r' if mmap else None)
+    if records.dtype != CACHE_DTYPE:
+        raise ValueError(f'快取檔格式不符: {records.dtype}')
+    return records['date'], records['close']
+
+
+def import_table(path):
+    """
+    讀取 CSV / XLSX 收盤價表
+
+    第一欄為日期、第二欄為收盤價 (欄名不拘，例如 date/close 或 日期/收盤價)。
+
+    Returns:
+    --------
+    tuple: (dates, close)
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        df = pd.read_csv(path)
+    elif extension == '.xlsx':
+        df = pd.read_excel(path)
+    else:
+        raise ValueError(f'不支援的匯入格式: {extension}')
+    dates = pd.to_datetime(df.iloc[:, 0]).to_numpy()
+    return dates, df.iloc[:, 1].to_numpy(dtype=np.float64)
+
+
+def export_table(path, dates, close, columns=('date', 'close')):
+    """將收盤價匯出為 CSV / XLSX (依副檔名決定)"""
+    df = pd.DataFrame({columns[0]: np.asarray(dates), columns[1]: np.asarray(close)})
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        df.to_csv(path, index=False)
+    elif extension == '.xlsx':
+        df.to_excel(path, index=False)
+    else:
+        raise ValueError(f'不支援的匯出格式: {extension}')
+
+
+def migrate_cache(path, legacy_paths=None):
+    """
+    舊快取轉換：.npy 不存在而同名的 CSV / XLSX 存在時，轉為 .npy
+
+    轉換後沿用舊檔的修改時間，快取有效期限的判斷不受影響。
+
+    Parameters:
+    -----------
+    path : str
+        .npy 快取檔路徑
+    legacy_paths : list, optional
+        舊快取檔路徑 (預設為同名的 .csv 與 .xlsx)
+
+    Returns:
+    --------
+    str: 被轉換的舊檔路徑；未轉換時為 None
+    """
+    if os.path.exists(path):
+        return None
+
+    if legacy_paths is None:
+        stem = os.path.splitext(path)[0]
+        legacy_paths = [stem + extension for extension in TABLE_FORMATS]
+
+    for legacy in legacy_paths:
+        if not os.path.exists(legacy):
+            continue
+        try:
+            count = write_cache(path, *import_table(legacy))
+        except Exception as e:
+            print(f"[WARN] 轉換舊快取 {legacy} 失敗: {e}")
+            continue
+        mtime = os.path.getmtime(legacy)
+        os.utime(path, (mtime, mtime))
+        print(f"[INFO] 已將舊快取 {legacy} 轉為 {path}，共 {count} 筆")
+        return legacy
+    return None
+
+
+def refresh_start(path, overlap_days=REFRESH_OVERLAP_DAYS):
+    """
+    增量更新的下載起始日：最後快取日往前 overlap_days 天
+
+    Returns:
+    --------
+    str: 'YYYY-MM-DD'；快取不存在、無法讀取或為空時為 None (需完整下載)
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        dates, _ = read_cache(path)
+    except Exception as e:
+        print(f"[WARN] 讀取快取 {path} 失敗，改為完整下載: {e}")
+        return None
+    if len(dates) == 0:
+        return None
+    start = pd.Timestamp(dates[-1]) - pd.Timedelta(days=overlap_days)
+    return start.strftime('%Y-%m-%d')
+
+
+def _write_tail(path, length, start, records):
+    """
+    從第 start 筆起改寫快取檔並更新標頭的筆數
+
+    start 之前的記錄不變：修正的收盤價就地覆寫，新 K 棒附加到檔尾。
+    np.save 的標頭保留了筆數成長的空間，標頭長度不變時只寫入這些記錄；
+    其他行程已開啟的 mmap 只對應原本的範圍，不會被截斷。
+    檔案筆數已被其他行程改變或標頭長度改變時回傳 False (由呼叫端整檔重寫)。
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            return False
+        offset = f.tell()
+        if shape != (length,) or fortran_order or dtype != CACHE_DTYPE:
+            return False
+
+        header = io.BytesIO()
+        header_data = {
+            'descr': np.lib.format.dtype_to_descr(CACHE_DTYPE),
+            'fortran_order': False,
+            'shape': (start + len(records),)
+        }
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, header_data)
+        else:
+            np.lib.format.write_array_header_2_0(header, header_data)
+        if header.tell() != offset:
+            return False
+
+        # 先寫資料再更新標頭：中途失敗時檔尾多出的位元組不會被讀到
+        f.seek(offset + start * CACHE_DTYPE.itemsize)
+        f.write(records.tobytes())
+        f.truncate()
+        f.flush()
+        f.seek(0)
+        f.write(header.getvalue())
+    return True
+
+
+def update_cache(path, dates, close):
+    """
+    將新下載的資料合併進快取
+
+    新資料的日期與重疊區間的快取日期完全相同時，只就地覆寫收盤價被修正的記錄並附加新 K 棒
+    (成本與新資料量成正比，盤中每次更新當日 K 棒也是如此)；
+    重疊區間的日期缺漏或不一致時，以新資料為準整檔重寫。
+
+    Parameters:
+    -----------
+    path : str
+        .npy 快取檔路徑
+    dates, close : array-like
+        新下載的日期與收盤價 (通常自 refresh_start 起)
+
+    Returns:
+    --------
+    tuple: (總筆數, 新增筆數, 是否整檔重寫)
+    """
+    new = to_records(dates, close)
+    if not os.path.exists(path):
+        return write_cache(path, new['date'], new['close']), len(new), True
+
+    old = np.load(path, mmap_mode='r' if MMAP_DEFAULT else None)
+    if old.dtype != CACHE_DTYPE:
+        raise ValueError(f'快取檔格式不符: {old.dtype}')
+    length = len(old)
+    if len(new) == 0:
+        return length, 0, False
+
+    # 新資料需完整涵蓋重疊區間且日期一致，才能只改寫尾端
+    pos = int(np.searchsorted(old['date'], new['date'][0], side='left'))
+    overlap = length - pos
+    if overlap <= len(new) and np.array_equal(old['date'][pos:], new['date'][:overlap]):
+        same = old['close'][pos:] == new['close'][:overlap]
+        same |= np.isnan(old['close'][pos:]) & np.isnan(new['close'][:overlap])
+        # 第一筆被修正的收盤價 (皆未修正時為 overlap)
+        first = int(np.argmin(same)) if not same.all() else overlap
+        del old, same
+        added = len(new) - overlap
+        if first == overlap and added == 0:
+            return length, 0, False
+        if _write_tail(path, length, pos + first, new[first:]):
+            return length + added, added, False
+        old = np.load(path, mmap_mode='r' if MMAP_DEFAULT else None)
+        length = len(old)
+
+    # 新資料放在後面，同一天以新資料為準
+    merged = to_records(
+        np.concatenate([old['date'], new['date']]),
+        np.concatenate([old['close'], new['close']])
+    )
+    del old
+    total = write_cache(path, merged['date'], merged['close'])
+    return total, total - length, True
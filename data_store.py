@@ -0,0 +1,361 @@
+"""
+Multi-Symbol Data Store
+多商品資料存取 - 依商品分檔快取 Yahoo Finance 收盤價，並將多個商品對齊到共同交易日
+
+快取檔為 .npy 結構化陣列 (見 binary_cache)，以 mmap 開啟 (Windows 上讀入記憶體)
+後以 Dataset 常駐於行程記憶體，檔案未改變時各請求直接切片使用。舊的 CSV 快取在第一次載入時自動轉換。
+快取過期時只下載最後快取日之後的資料 (含少量重疊) 並附加到快取檔。
+"""
+
+import hashlib
+import itertools
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+import metrics
+from binary_cache import migrate_cache, read_cache, refresh_start, update_cache
+from profiling import span, timed
+
+
+# 預設商品 (加權指數) 沿用原本的快取檔，其餘商品各自一個檔案
+DEFAULT_SYMBOL = '^TWII'
+DEFAULT_CACHE_FILE = 'stock_data_cache.npy'
+SYMBOL_CACHE_DIR = 'data_cache'
+CACHE_EXPIRY_HOURS = 0.08  # 約 5 分鐘，與 api.py 相同
+
+# Yahoo 代號：英數字與 ^ . - = 符號，例如 ^TWII、^TWOII、2330.TW
+SYMBOL_PATTERN = re.compile(r'^[A-Za-z0-9^.\-=]{1,20}$')
+
+# 同時下載的商品數上限
+DOWNLOAD_THREADS = 4
+
+
+def validate_symbol(symbol):
+    """檢查商品代號格式，避免以代號組出任意檔案路徑"""
+    if not isinstance(symbol, str) or not SYMBOL_PATTERN.match(symbol):
+        raise ValueError(f'無效的商品代號: {symbol}')
+    return symbol
+
+
+def symbol_cache_file(symbol):
+    """商品對應的快取檔路徑"""
+    if symbol == DEFAULT_SYMBOL:
+        return DEFAULT_CACHE_FILE
+    validate_symbol(symbol)
+    return os.path.join(SYMBOL_CACHE_DIR, symbol.replace('^', '_') + '.npy')
+
+
+def download_symbol(symbol, period='20y', start=None):
+    """
+    從 Yahoo Finance 下載收盤價
+
+    Parameters:
+    -----------
+    symbol : str
+        Yahoo Finance 代號
+    period : str
+        下載區間 (未指定 start 時使用)
+    start : str, optional
+        起始日 'YYYY-MM-DD'，指定時只下載該日之後的資料
+
+    Returns:
+    --------
+    DataFrame: 依日期排序的 date 和 close 欄位
+
+    Raises:
+    -------
+    Exception: 下載失敗或回傳空資料
+    """
+    download_start = time.perf_counter()
+    with span('yahoo'):
+        if start:
+            df_yahoo = yf.download(symbol, start=start, progress=False)
+        else:
+            df_yahoo = yf.download(symbol, period=period, progress=False)
+    metrics.YAHOO_DOWNLOAD_SECONDS.observe(time.perf_counter() - download_start)
+
+    if df_yahoo.empty:
+        raise Exception("Yahoo Finance 回傳空資料")
+
+    df_yahoo = df_yahoo.reset_index()
+
+    # 處理 MultiIndex 欄位
+    if isinstance(df_yahoo.columns, pd.MultiIndex):
+        df_yahoo.columns = df_yahoo.columns.get_level_values(0)
+
+    # 重命名欄位
+    df = df_yahoo[['Date', 'Close']].copy()
+    df.columns = ['date', 'close']
+    df['date'] = pd.to_datetime(df['date'])
+    return df.sort_values('date').reset_index(drop=True)
+
+
+def refresh_symbol(symbol, cache_file):
+    """
+    增量更新快取檔
+
+    有可用快取時只下載最後快取日往前 REFRESH_OVERLAP_DAYS 天之後的資料並合併
+    (重疊區間以新資料為準)；沒有快取時下載完整區間。
+
+    Returns:
+    --------
+    tuple: (總筆數, 新增筆數, 是否整檔重寫)
+
+    Raises:
+    -------
+    Exception: 下載失敗或回傳空資料
+    """
+    start = refresh_start(cache_file)
+    if start:
+        print(f"[INFO] 從 Yahoo Finance 下載 {symbol} {start} 之後的資料...")
+    else:
+        print(f"[INFO] 從 Yahoo Finance 下載 {symbol} 資料...")
+    df = download_symbol(symbol, start=start)
+
+    total, added, rewritten = update_cache(cache_file, df['date'].to_numpy(), df['close'].to_numpy())
+    # 沒有新 K 棒時檔案不會被寫入，更新修改時間以重新起算有效期限
+    os.utime(cache_file)
+    return total, added, rewritten
+
+
+def load_symbol(symbol=DEFAULT_SYMBOL, cache_file=None, expiry_hours=CACHE_EXPIRY_HOURS):
+    """
+    載入單一商品的完整收盤價，優先使用快取 (見 get_dataset)
+
+    Returns:
+    --------
+    DataFrame: 包含 date 和 close 欄位；無資料時為 None
+    """
+    dataset = get_dataset(symbol, cache_file, expiry_hours)
+    return dataset.frame() if dataset is not None else None
+
+
+# 行程內的資料集 (以快取檔路徑為鍵) 與單調遞增的資料版本
+_datasets = {}
+_datasets_lock = threading.Lock()
+_versions = itertools.count(1)
+
+
+class Dataset:
+    """
+    常駐記憶體的單一商品資料集
+
+    日期與收盤價為依日期排序的唯讀 NumPy 陣列：日期為 .npy 快取的 mmap 檢視 (Windows 上為記憶體複本)，
+    收盤價一律為行程內的複本 (增量更新可能就地覆寫快取檔中被修正的收盤價)。
+    version 在內容改變而重新載入時遞增，可作為下游快取 (指標、回測) 的鍵。
+    history_version 只在既有 K 棒的內容改變 (例如收盤價被修正) 時才更新，
+    只在尾端新增 K 棒時沿用，供可接續推進的快取 (回測狀態、市場信號) 判斷是否需要重算。
+    """
+
+    __slots__ = ('symbol', 'dates', 'close', 'version', 'history_version', 'signature', 'digest')
+
+    def __init__(self, symbol, dates, close, version, signature, digest, history_version=None):
+        if len(dates) > 1 and not (dates[1:] >= dates[:-1]).all():
+            order = np.argsort(dates, kind='stable')
+            dates, close = dates[order], close[order]
+        self.symbol = symbol
+        self.dates = dates
+        self.close = close
+        self.dates.setflags(write=False)
+        self.close.setflags(write=False)
+        self.version = version
+        self.history_version = version if history_version is None else history_version
+        self.signature = signature
+        self.digest = digest
+
+    def __len__(self):
+        return len(self.dates)
+
+    def extends(self, other):
+        """是否為 other 在尾端新增 K 棒的結果 (other 的所有 K 棒都未改變)"""
+        n = len(other)
+        return (len(self) >= n
+                and np.array_equal(self.dates[:n], other.dates)
+                and np.array_equal(self.close[:n], other.close, equal_nan=True))
+
+    def frame(self, start_date=None, end_date=None):
+        """
+        依日期範圍切出 DataFrame (與 filter_dates 相同的包含邊界)
+
+        Returns:
+        --------
+        DataFrame: date 和 close 欄位，attrs['dataVersion'] 與 attrs['historyVersion'] 為資料版本
+        """
+        lo, hi = 0, len(self.dates)
+        if start_date:
+            lo = np.searchsorted(self.dates, np.datetime64(pd.to_datetime(start_date)), side='left')
+        if end_date:
+            hi = np.searchsorted(self.dates, np.datetime64(pd.to_datetime(end_date)), side='right')
+        hi = max(hi, lo)
+        df = pd.DataFrame({'date': self.dates[lo:hi], 'close': self.close[lo:hi]})
+        df.attrs['dataVersion'] = self.version
+        df.attrs['historyVersion'] = self.history_version
+        return df
+
+
+def _file_signature(path):
+    """快取檔的 (修改時間, 大小)"""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _read_dataset(symbol, cache_file):
+    """
+    取得快取檔對應的 Dataset
+
+    檔案的修改時間與大小未變時直接回傳記憶體中的資料集；
+    改變時比對內容雜湊，內容相同 (例如只被 touch) 則沿用，否則重新解析並遞增版本。
+    新內容只是在尾端新增 K 棒時沿用 history_version。
+    """
+    signature = _file_signature(cache_file)
+    with _datasets_lock:
+        dataset = _datasets.get(cache_file)
+        if dataset is not None and dataset.signature == signature:
+            return dataset
+
+        with open(cache_file, 'rb') as f:
+            content = f.read()
+        digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+        if dataset is not None and dataset.digest == digest:
+            dataset.signature = signature
+            return dataset
+
+        with span('npy'):
+            dates, close = read_cache(cache_file)
+            # 增量更新會就地覆寫被修正的收盤價，收盤價複製一份，避免常駐資料在使用中被改變
+            close = np.array(close)
+        previous = dataset
+        dataset = Dataset(symbol, dates, close, next(_versions), signature, digest)
+        if previous is not None and dataset.extends(previous):
+            dataset.history_version = previous.history_version
+        _datasets[cache_file] = dataset
+        print(f"[INFO] 從快取載入 {symbol} 資料，共 {len(dataset)} 筆 (版本 {dataset.version})")
+        metrics.record_cache_event('data', 'reload')
+        return dataset
+
+
+def get_dataset(symbol=DEFAULT_SYMBOL, cache_file=None, expiry_hours=CACHE_EXPIRY_HOURS):
+    """
+    取得單一商品的常駐資料集
+
+    快取過期時以 refresh_symbol 增量更新快取檔；下載失敗則退回使用舊快取。
+    快取檔內容未改變時不重新解析。
+
+    Parameters:
+    -----------
+    symbol : str
+        Yahoo Finance 代號
+    cache_file : str, optional
+        快取檔路徑 (預設依 symbol_cache_file 決定)
+    expiry_hours : float
+        快取有效時數
+
+    Returns:
+    --------
+    Dataset: 無資料時為 None
+    """
+    if cache_file is None:
+        cache_file = symbol_cache_file(symbol)
+    migrate_cache(cache_file)
+
+    # 檢查快取是否存在且有效
+    if os.path.exists(cache_file):
+        cache_mtime = datetime.fromtimestamp(os.path.getmtime(cache_file))
+        if datetime.now() - cache_mtime < timedelta(hours=expiry_hours):
+            try:
+                dataset = _read_dataset(symbol, cache_file)
+                metrics.record_cache_event('data', 'hit')
+                return dataset
+            except Exception as e:
+                print(f"[WARN] 讀取 {symbol} 快取失敗: {e}")
+
+    try:
+        total, added, rewritten = refresh_symbol(symbol, cache_file)
+        print(f"[INFO] {symbol} 資料已快取，共 {total} 筆 (新增 {added} 筆{'，整檔重寫' if rewritten else ''})")
+        metrics.record_cache_event('data', 'refresh')
+        return _read_dataset(symbol, cache_file)
+
+    except Exception as e:
+        print(f"[ERROR] Yahoo Finance 下載 {symbol} 失敗: {e}")
+        metrics.YAHOO_DOWNLOAD_FAILURES.inc()
+
+        # 嘗試讀取舊快取
+        if os.path.exists(cache_file):
+            dataset = _read_dataset(symbol, cache_file)
+            print(f"[INFO] 使用 {symbol} 舊快取資料，共 {len(dataset)} 筆")
+            metrics.record_cache_event('data', 'stale')
+            return dataset
+        return None
+
+
+def filter_dates(df, start_date=None, end_date=None):
+    """依日期範圍過濾"""
+    if start_date:
+        df = df[df['date'] >= pd.to_datetime(start_date)]
+    if end_date:
+        df = df[df['date'] <= pd.to_datetime(end_date)]
+    return df.reset_index(drop=True)
+
+
+@timed('load')
+def load_symbols(symbols, start_date=None, end_date=None):
+    """
+    載入多個商品
+
+    各商品的快取檔互相獨立，需要下載的商品以執行緒並行下載。
+
+    Returns:
+    --------
+    dict: {代號: DataFrame}，無法載入的商品為 None
+    """
+    for symbol in symbols:
+        validate_symbol(symbol)
+
+    threads = min(DOWNLOAD_THREADS, len(symbols)) or 1
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        frames = list(pool.map(load_symbol, symbols))
+
+    return {
+        symbol: (filter_dates(df, start_date, end_date) if df is not None else None)
+        for symbol, df in zip(symbols, frames)
+    }
+
+
+def align_symbols(frames):
+    """
+    將多個商品對齊到共同交易日 (交集)
+
+    Parameters:
+    -----------
+    frames : dict
+        {代號: DataFrame}
+
+    Returns:
+    --------
+    tuple: (dates, closes)
+        dates 為 int64 epoch 日數，closes 為形狀 (商品數, 日數) 的 float64 矩陣，列順序同 frames
+    """
+    series = []
+    for df in frames.values():
+        df = df.dropna(subset=['close'])
+        days = df['date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+        # 同一天重複時保留最後一筆
+        days, last = np.unique(days[::-1], return_index=True)
+        series.append((days, df['close'].to_numpy(dtype=np.float64)[::-1][last]))
+
+    dates = series[0][0]
+    for days, _ in series[1:]:
+        dates = np.intersect1d(dates, days, assume_unique=True)
+
+    closes = np.empty((len(series), len(dates)))
+    for row, (days, close) in enumerate(series):
+        closes[row] = close[np.searchsorted(days, dates)]
+    return dates, closes
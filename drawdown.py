@@ -0,0 +1,202 @@
+"""
+Drawdown Analytics
+回撤分析 - 以 NumPy 一次計算水下曲線、最大回撤、回撤期間與各年/各月最大回撤
+"""
+
+import numpy as np
+
+
+def underwater_curve(values):
+    """
+    計算水下曲線 (回撤百分比)
+
+    Parameters:
+    -----------
+    values : array-like
+        資金曲線
+
+    Returns:
+    --------
+    tuple: (drawdowns, peaks)，drawdowns 為 (高點 - 資金) / 高點 * 100
+    """
+    values = np.asarray(values, dtype=np.float64)
+    peaks = np.maximum.accumulate(values)
+    drawdowns = (peaks - values) / peaks * 100
+    return drawdowns, peaks
+
+
+def _period_starts(labels):
+    """連續相同標籤的區段起點"""
+    labels = np.asarray(labels)
+    if len(labels) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], labels[1:] != labels[:-1])))
+
+
+def period_max_drawdown(values, labels):
+    """
+    各期間 (年/月) 內的最大回撤
+
+    每個期間的高點自期間起點重新累計，不需逐組迴圈：
+    將各區段平移到互不重疊的數值範圍後做一次 maximum.accumulate，
+    再以 maximum.reduceat 取得各區段最大值。
+
+    Parameters:
+    -----------
+    values : array-like
+        資金曲線 (依時間排序)
+    labels : array-like
+        每個點所屬的期間標籤，相同期間須相鄰，例如年份
+
+    Returns:
+    --------
+    tuple: (period_labels, mdd)，mdd 為百分比
+    """
+    values = np.asarray(values, dtype=np.float64)
+    labels = np.asarray(labels)
+    starts = _period_starts(labels)
+    if len(starts) == 0:
+        return labels[:0], np.zeros(0)
+
+    segment = np.zeros(len(values))
+    segment[starts[1:]] = 1
+    segment = np.cumsum(segment)
+
+    # 平移後各區段的最小值都大於前一區段的最大值，因此累積最大值會在區段起點重設
+    low = np.nanmin(values)
+    span = np.nanmax(values) - low + 1.0
+    shifted = (values - low) + segment * span
+    peaks = np.maximum.accumulate(shifted) - segment * span + low
+
+    drawdowns = (peaks - values) / peaks * 100
+    mdd = np.maximum.reduceat(drawdowns, starts)
+    return labels[starts], mdd
+
+
+def drawdown_episodes(drawdowns):
+    """
+    找出所有回撤期間
+
+    Parameters:
+    -----------
+    drawdowns : ndarray
+        underwater_curve 的回撤百分比
+
+    Returns:
+    --------
+    dict of ndarray: peak / trough / recovery 索引 (未回復者 recovery 為 -1) 與深度
+    """
+    underwater = drawdowns > 0
+    if not underwater.any():
+        empty = np.zeros(0, dtype=np.int64)
+        return {'peak': empty, 'trough': empty, 'recovery': empty, 'depth': np.zeros(0)}
+
+    edges = np.diff(np.concatenate(([False], underwater, [False])).astype(np.int8))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)  # 回撤結束後第一個回到高點的索引
+
+    depth = np.maximum.reduceat(drawdowns, run_starts)
+
+    # 每段內回撤最深的位置：依 (區段, -回撤) 排序後取各區段第一筆
+    run_id = np.cumsum(edges[:-1] == 1) - 1
+    inside = np.flatnonzero(underwater)
+    order = inside[np.lexsort((-drawdowns[inside], run_id[inside]))]
+    first = np.concatenate(([True], run_id[order][1:] != run_id[order][:-1]))
+    trough = order[first]
+
+    recovery = np.where(run_ends < len(drawdowns), run_ends, -1)
+    return {
+        'peak': run_starts - 1,
+        'trough': trough,
+        'recovery': recovery,
+        'depth': depth
+    }
+
+
+def analyze_drawdowns(values, dates=None, top_n=5):
+    """
+    回撤完整分析
+
+    Parameters:
+    -----------
+    values : array-like
+        資金曲線
+    dates : array-like, optional
+        對應日期 (datetime64 或 epoch 日數)；提供時期間以日曆日計算，並回傳各年/各月最大回撤
+    top_n : int
+        回傳最深的前幾段回撤
+
+    Returns:
+    --------
+    dict: 最大回撤、最長回撤期間、最大回撤的回復時間、前 N 段回撤與各年/各月最大回撤
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if n < 2:
+        return {
+            'maxDrawdown': 0,
+            'maxDuration': 0,
+            'recoveryTime': None,
+            'episodes': [],
+            'yearly': [],
+            'monthly': []
+        }
+
+    drawdowns, _ = underwater_curve(values)
+    episodes = drawdown_episodes(drawdowns)
+
+    if dates is not None:
+        days = np.asarray(dates)
+        if np.issubdtype(days.dtype, np.datetime64):
+            days = days.astype('datetime64[D]').astype(np.int64)
+        days = days.astype(np.int64)
+        labels = np.datetime_as_string(days.astype('datetime64[D]'), unit='D').tolist()
+    else:
+        days = np.arange(n, dtype=np.int64)
+        labels = None
+
+    # 未回復的回撤以最後一筆資料計算期間
+    end = np.where(episodes['recovery'] >= 0, episodes['recovery'], n - 1)
+    duration = days[end] - days[episodes['peak']]
+    recovery_time = np.where(episodes['recovery'] >= 0, days[end] - days[episodes['trough']], -1)
+
+    top = np.argsort(-episodes['depth'], kind='stable')[:top_n]
+    episode_list = []
+    for i in top.tolist():
+        peak, trough, rec = int(episodes['peak'][i]), int(episodes['trough'][i]), int(episodes['recovery'][i])
+        episode_list.append({
+            'depth': round(float(-episodes['depth'][i]), 2),
+            'peak': labels[peak] if labels is not None else peak,
+            'trough': labels[trough] if labels is not None else trough,
+            'recovery': (labels[rec] if labels is not None else rec) if rec >= 0 else None,
+            'duration': int(duration[i]),
+            'recoveryTime': int(recovery_time[i]) if rec >= 0 else None
+        })
+
+    result = {
+        'maxDrawdown': round(float(-drawdowns.max()), 2),
+        'maxDuration': int(duration.max()) if len(duration) else 0,
+        'recoveryTime': episode_list[0]['recoveryTime'] if episode_list else None,
+        'episodes': episode_list,
+        'yearly': [],
+        'monthly': []
+    }
+
+    if dates is not None:
+        months = days.astype('datetime64[D]').astype('datetime64[M]')
+        years = months.astype('datetime64[Y]').astype(np.int64) + 1970
+
+        year_labels, year_mdd = period_max_drawdown(values, years)
+        result['yearly'] = [
+            {'year': int(y), 'maxDrawdown': round(float(-m), 2)}
+            for y, m in zip(year_labels.tolist(), year_mdd.tolist())
+        ]
+
+        month_labels, month_mdd = period_max_drawdown(values, months.astype(np.int64))
+        month_strings = np.datetime_as_string(month_labels.astype('datetime64[M]'), unit='M').tolist()
+        result['monthly'] = [
+            {'month': s, 'maxDrawdown': round(float(-m), 2)}
+            for s, m in zip(month_strings, month_mdd.tolist())
+        ]
+
+    return result
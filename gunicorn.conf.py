@@ -0,0 +1,27 @@
+"""
+Gunicorn 設定
+
+多個 worker 的 Prometheus 指標透過 PROMETHEUS_MULTIPROC_DIR 共用目錄彙總，
+/metrics 由任一 worker 回應時都會合併所有 worker 的數值。
+"""
+
+import os
+import shutil
+import tempfile
+
+# 必須在匯入 prometheus_client 前設定，worker 會繼承此環境變數
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'twstock_metrics'))
+
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def on_starting(server):
+    """啟動時清除上次執行留下的指標檔"""
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """worker 結束時移除其 livesum 類型 (處理中請求數) 的數值"""
+    multiprocess.mark_process_dead(worker.pid)
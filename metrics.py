@@ -0,0 +1,87 @@
+"""
+Prometheus Metrics
+監控指標 - 請求延遲、處理中請求數、快取事件、Yahoo 下載與回測處理量
+
+在 gunicorn 下以 PROMETHEUS_MULTIPROC_DIR 共用目錄彙總所有 worker 的指標
+(由 gunicorn.conf.py 設定)；直接執行 api.py 時使用單一行程的 registry。
+"""
+
+import os
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+)
+from prometheus_client import multiprocess
+
+
+# 請求延遲分箱 (秒)：涵蓋快取命中的毫秒級回應到大範圍優化的數十秒
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_LATENCY = Histogram(
+    'twstock_request_duration_seconds',
+    'API 請求耗時 (秒)',
+    ['method', 'route', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+
+REQUESTS_IN_FLIGHT = Gauge(
+    'twstock_requests_in_flight',
+    '處理中的請求數',
+    ['route'],
+    multiprocess_mode='livesum'
+)
+
+CACHE_EVENTS = Counter(
+    'twstock_cache_events_total',
+    '快取事件 (cache: data / indicator / backtest；event: hit / miss / reload / refresh / stale / eviction / invalidation)',
+    ['cache', 'event']
+)
+
+YAHOO_DOWNLOAD_SECONDS = Histogram(
+    'twstock_yahoo_download_duration_seconds',
+    'Yahoo Finance 下載耗時 (秒)',
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+
+YAHOO_DOWNLOAD_FAILURES = Counter(
+    'twstock_yahoo_download_failures_total',
+    'Yahoo Finance 下載失敗次數'
+)
+
+BACKTEST_BARS = Counter(
+    'twstock_backtest_bars_total',
+    '回測處理的 K 棒數 (mode: full / incremental / optimize / grid / adaptive)',
+    ['mode']
+)
+
+
+def record_cache_event(cache, event, count=1):
+    """記錄快取事件"""
+    CACHE_EVENTS.labels(cache=cache, event=event).inc(count)
+
+
+def record_bars(mode, bars):
+    """記錄回測處理的 K 棒數"""
+    if bars > 0:
+        BACKTEST_BARS.labels(mode=mode).inc(bars)
+
+
+def observe_request(method, route, status, seconds):
+    """記錄一次請求的耗時"""
+    REQUEST_LATENCY.labels(method=method, route=route, status=str(status)).observe(seconds)
+
+
+def render():
+    """
+    產生 Prometheus 文字格式的指標
+
+    Returns:
+    --------
+    tuple: (內容, Content-Type)
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
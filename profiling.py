@@ -0,0 +1,197 @@
+"""
+Request Profiling
+效能量測 - 以具名區段 (span) 記錄各階段耗時，輸出 Server-Timing 標頭、結構化日誌與 cProfile 摘要
+"""
+
+import cProfile
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# 目前請求的區段紀錄；未啟用時為 None，span() 不做任何事
+_timings = ContextVar('timings', default=None)
+
+# cProfile 摘要預設列出的函式數
+PROFILE_LIMIT = 30
+
+# 同一時間只允許一個 cProfile (Python 3.12 起同時啟用第二個會拋出例外)
+_profiler_lock = threading.Lock()
+
+
+class Timings:
+    """
+    單一請求的區段耗時
+
+    同名區段累加耗時與次數 (例如均線優化中多次執行的 simulate)，依第一次出現的順序輸出。
+    """
+
+    __slots__ = ('started', 'spans')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = {}
+
+    def add(self, name, seconds):
+        """累加一個區段的耗時"""
+        entry = self.spans.get(name)
+        if entry is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def elapsed(self):
+        """自請求開始的耗時 (秒)"""
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        """{區段: {'ms': 毫秒, 'count': 次數}}"""
+        return {
+            name: {'ms': round(seconds * 1000, 3), 'count': count}
+            for name, (seconds, count) in self.spans.items()
+        }
+
+
+def start_timing():
+    """開始記錄目前請求 (或執行緒) 的區段，回傳用於 stop_timing 的 token"""
+    return _timings.set(Timings())
+
+
+def stop_timing(token):
+    """結束記錄並回傳 Timings"""
+    timings = _timings.get()
+    _timings.reset(token)
+    return timings
+
+
+def current_timings():
+    """目前的 Timings；未啟用時為 None"""
+    return _timings.get()
+
+
+@contextmanager
+def span(name):
+    """
+    量測一個具名區段
+
+    未呼叫 start_timing() 時 (例如直接在腳本中使用回測引擎) 只多一次 ContextVar 讀取。
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def server_timing_header(timings, total=None):
+    """
+    產生 Server-Timing 標頭值
+
+    例如: load;dur=12.1, ma;dur=0.4, simulate;dur=8.2, serialize;dur=3.0, total;dur=25.3
+    同名區段執行多次時以 desc 註明次數。
+    """
+    parts = []
+    for name, (seconds, count) in timings.spans.items():
+        part = f"{name};dur={seconds * 1000:.2f}"
+        if count > 1:
+            part += f';desc="{count}x"'
+        parts.append(part)
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.2f}")
+    return ', '.join(parts)
+
+
+def log_timing(method, path, status, timings, total):
+    """輸出一行結構化 (JSON) 的請求耗時日誌"""
+    record = {
+        'method': method,
+        'path': path,
+        'status': status,
+        'totalMs': round(total * 1000, 3),
+        'spans': timings.as_dict()
+    }
+    print(f"[TIMING] {json.dumps(record, ensure_ascii=False)}", flush=True)
+
+
+def profile_summary(profiler, limit=PROFILE_LIMIT, sort_by='cumulative'):
+    """
+    將 cProfile 結果整理為可 JSON 序列化的摘要
+
+    Returns:
+    --------
+    dict: 依 sort_by 排序的前 limit 個函式，以及 pstats 的文字報表
+    """
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(sort_by).print_stats(limit)
+
+    functions = []
+    for (filename, line, func), (cc, nc, tt, ct, _) in stats.stats.items():
+        functions.append({
+            'function': f"{filename}:{line}({func})",
+            'calls': nc,
+            'primitiveCalls': cc,
+            'totalMs': round(tt * 1000, 3),
+            'cumulativeMs': round(ct * 1000, 3)
+        })
+    key = 'cumulativeMs' if sort_by == 'cumulative' else 'totalMs'
+    functions.sort(key=lambda f: f[key], reverse=True)
+
+    return {
+        'sortBy': sort_by,
+        'totalCalls': stats.total_calls,
+        'totalMs': round(stats.total_tt * 1000, 3),
+        'functions': functions[:limit],
+        'text': stream.getvalue()
+    }
+
+
+def new_profiler():
+    """
+    建立並啟用 cProfile
+
+    已有其他請求正在剖析 (或其他剖析工具已啟用) 時回傳 None；
+    回傳的 profiler 須以 stop_profiler() 停用。
+    """
+    if not _profiler_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        _profiler_lock.release()
+        return None
+    return profiler
+
+
+def stop_profiler(profiler):
+    """停用 new_profiler() 建立的 cProfile，讓下一個請求可以剖析"""
+    profiler.disable()
+    _profiler_lock.release()
+
+
+def timed(name):
+    """以具名區段量測整個函式的裝飾器"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = _timings.get()
+            if timings is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -0,0 +1,139 @@
+"""
+回測核心一致性測試
+
+以凍結的原始逐列迴圈 (reference_engine) 為基準，檢驗 run_backtest 在所有交易模式、
+口數模式、手續費、逆價差組合下的輸出逐位元相同，並檢驗批次回測、advance() 接續
+與串流回測的結果與 run_backtest 一致。
+"""
+
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backtest_engine as engine
+import reference_engine
+
+
+CACHE_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stock_data_cache.csv')
+
+# 三年資料涵蓋多次月份切換與進出場，原始迴圈仍可在數秒內跑完
+START_DATE, END_DATE = '2019-01-01', '2021-12-31'
+
+TRADE_MODES = ('long', 'short', 'both')
+LOT_MODES = ('fixed', 'dynamic')
+FLAGS = (True, False)
+MA_DAYS = (5, 13, 60)
+MONTHLY_ADDS = (0, 10000)
+
+SUMMARY_KEYS = ('period', 'finalAssets', 'totalReturn', 'maxDrawdown', 'winRate', 'tradeCount')
+
+
+@pytest.fixture(scope='module')
+def prices():
+    df = pd.read_csv(CACHE_CSV, parse_dates=['date'])
+    df = df[(df['date'] >= START_DATE) & (df['date'] <= END_DATE)]
+    return df.reset_index(drop=True)
+
+
+def make_params(trade_mode, lot_mode, use_fee, backwardation, ma_days, monthly_add, leverage):
+    return {
+        'tradeMode': trade_mode,
+        'lotMode': lot_mode,
+        'useFee': use_fee,
+        'enableBackwardation': backwardation,
+        'maDays': ma_days,
+        'monthlyAdd': monthly_add,
+        'useFixedLeverage': leverage,
+        'useDynamicLeverage': leverage,
+        'fixedLeverage': 3,
+        'fixedLots': 2
+    }
+
+
+ALL_PARAMS = [
+    make_params(*combo)
+    for combo in itertools.product(TRADE_MODES, LOT_MODES, FLAGS, FLAGS, MA_DAYS, MONTHLY_ADDS, FLAGS)
+]
+
+
+def param_id(params):
+    return '-'.join(str(params[k]) for k in (
+        'tradeMode', 'lotMode', 'useFee', 'enableBackwardation', 'maDays', 'monthlyAdd', 'useFixedLeverage'
+    ))
+
+
+def assert_same(actual, expected, path='result'):
+    """逐欄位比較，浮點數須完全相等"""
+    if isinstance(expected, dict):
+        assert actual.keys() == expected.keys(), path
+        for key in expected:
+            assert_same(actual[key], expected[key], f'{path}.{key}')
+    elif isinstance(expected, list):
+        assert len(actual) == len(expected), path
+        for i, (a, e) in enumerate(zip(actual, expected)):
+            assert_same(a, e, f'{path}[{i}]')
+    else:
+        assert actual == expected, f'{path}: {actual!r} != {expected!r}'
+
+
+@pytest.mark.parametrize('params', ALL_PARAMS, ids=param_id)
+def test_run_backtest_matches_reference(prices, params):
+    assert_same(engine.run_backtest(prices, params), reference_engine.run_backtest(prices, params))
+
+
+BATCH_PARAMS = [p for p in ALL_PARAMS if p['monthlyAdd'] and p['useFixedLeverage']]
+
+
+def test_batch_matches_run_backtest(prices):
+    assert len(BATCH_PARAMS) == 72
+    batch = engine.run_backtest_batch(prices, BATCH_PARAMS, include_history=True)
+    assert batch['success'] and batch['count'] == len(BATCH_PARAMS)
+
+    for entry, params in zip(batch['results'], BATCH_PARAMS):
+        single = engine.run_backtest(prices, params)
+        for key in SUMMARY_KEYS:
+            assert entry[key] == single['results'][key], (param_id(params), key)
+        assert entry['capitalHistory']['dates'] == single['capitalHistory']['dates']
+        assert np.array_equal(entry['capitalHistory']['values'], single['capitalHistory']['values']), param_id(params)
+
+
+ADVANCE_PARAMS = [
+    make_params('long', 'dynamic', True, True, 13, 10000, True),
+    make_params('short', 'fixed', True, False, 5, 0, False),
+    make_params('both', 'dynamic', False, True, 60, 10000, False)
+]
+
+
+@pytest.mark.parametrize('params', ADVANCE_PARAMS, ids=param_id)
+@pytest.mark.parametrize('cut', (100, 400, 700))
+def test_advance_matches_run_backtest(prices, params, cut):
+    result, state = engine.run_backtest(prices.iloc[:cut], params, return_state=True)
+    update = engine.advance(state, prices.iloc[cut:])
+    assert update['newBars'] == len(prices) - cut
+    assert_same(engine.extend_result(result, update), engine.run_backtest(prices, params))
+
+
+def test_extend_result_keeps_drawdown_analysis(prices):
+    params = {**ADVANCE_PARAMS[0], 'drawdownAnalysis': True}
+    result, state = engine.run_backtest(prices.iloc[:400], params, return_state=True)
+    extended = engine.extend_result(result, engine.advance(state, prices.iloc[400:]))
+    assert_same(extended, engine.run_backtest(prices, params))
+
+
+@pytest.mark.parametrize('params', ADVANCE_PARAMS, ids=param_id)
+def test_stream_matches_run_backtest(prices, params):
+    chunks = [
+        (prices['date'].to_numpy()[i:i + 333].astype('datetime64[s]'), prices['close'].to_numpy()[i:i + 333])
+        for i in range(0, len(prices), 333)
+    ]
+    stream = engine.run_backtest_stream(chunks, params, chunk_size=333)
+    single = engine.run_backtest(prices, params)
+
+    for key in SUMMARY_KEYS:
+        assert stream['results'][key] == single['results'][key], key
+    assert stream['results']['bars'] == len(single['capitalHistory']['values'])
+    for series in ('capitalHistory', 'mddHistory', 'indexHistory'):
+        assert_same(stream[series], single[series], series)
@@ -0,0 +1,41 @@
+"""降採樣點數上限測試"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backtest_engine as engine
+from test_backtest_parity import CACHE_CSV
+
+
+PARAMS = {'maDays': 13, 'tradeMode': 'both'}
+
+
+@pytest.fixture(scope='module')
+def prices():
+    return pd.read_csv(CACHE_CSV, parse_dates=['date'])
+
+
+@pytest.fixture(scope='module')
+def result(prices):
+    return engine.run_backtest(prices, PARAMS)
+
+
+@pytest.mark.parametrize('result_format', ('records', 'columnar'))
+@pytest.mark.parametrize('max_points', (1, 2, 5, 7, 50, 1000))
+def test_downsample_respects_max_points(prices, result_format, max_points):
+    result = engine.run_backtest(prices, PARAMS, result_format=result_format)
+    downsampled = engine.downsample_result(result, max_points)
+    assert downsampled['downsample']['points'] <= max_points
+
+
+def test_downsample_keeps_extremes(result):
+    downsampled = engine.downsample_result(result, 50)
+    capital = result['capitalHistory']['values']
+    drawdown = result['mddHistory']['values']
+    assert max(downsampled['capitalHistory']['values']) == max(capital)
+    assert min(downsampled['capitalHistory']['values']) == min(capital)
+    assert max(downsampled['mddHistory']['values']) == max(drawdown)
+    assert downsampled['historyDates'][0] == result['capitalHistory']['dates'][0]
+    assert downsampled['historyDates'][-1] == result['capitalHistory']['dates'][-1]
+    assert np.all(np.diff(pd.to_datetime(downsampled['historyDates']).to_numpy()) > np.timedelta64(0))
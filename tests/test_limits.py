@@ -0,0 +1,92 @@
+"""請求參數上限測試：過大的參數須在展開或配置之前被拒絕"""
+
+import os
+
+import pandas as pd
+import pytest
+
+import backtest_engine as engine
+from test_backtest_parity import CACHE_CSV
+
+
+@pytest.fixture(scope='module')
+def prices():
+    df = pd.read_csv(CACHE_CSV, parse_dates=['date'])
+    return df[df['date'] >= '2020-01-01'].reset_index(drop=True)
+
+
+def test_grid_rejects_oversized_grid(prices):
+    grid = {'maDays': list(range(2, 1002)), 'fixedLots': list(range(1, 1001))}
+    result = engine.optimize_grid(prices, {'grid': grid})
+    assert not result['success']
+    assert str(engine.GRID_MAX_CONFIGS) in result['error']
+
+
+def test_grid_caps_workers(prices):
+    result = engine.optimize_grid(prices, {'grid': {'maDays': [5, 10, 20]}, 'workers': 1000})
+    assert result['success']
+    assert result['workers'] <= min(os.cpu_count() or 1, 3)
+
+
+def test_monte_carlo_clamps_chunk_size_and_bins(prices, monkeypatch):
+    sizes = []
+    chunks = engine.monte_carlo_chunks
+
+    def spy(returns, rounds, start_capital, chunk_size, *args):
+        sizes.append(chunk_size)
+        return chunks(returns, rounds, start_capital, chunk_size, *args)
+
+    monkeypatch.setattr(engine, 'monte_carlo_chunks', spy)
+    history = engine.run_backtest(prices, {'maDays': 13})['capitalHistory']['values']
+    result = engine.monte_carlo(history, {'rounds': 600, 'chunkSize': 20000, 'bins': 10 ** 6})
+    assert sizes == [engine.MC_CHUNK_SIZE]
+    assert len(result['histogram']['counts']) <= engine.MC_MAX_BINS
+
+
+def test_walk_forward_rejects_too_many_folds(prices):
+    result = engine.walk_forward(prices, {'trainBars': 100, 'testBars': 1, 'maMax': 20})
+    assert not result['success']
+    assert str(engine.WALK_FORWARD_MAX_FOLDS) in result['error']
+
+
+def test_pool_workers_capped_by_cpu_count(monkeypatch):
+    monkeypatch.setattr(engine.os, 'cpu_count', lambda: 4)
+    assert engine.pool_workers(1000, 5000) == 4
+    assert engine.pool_workers(None, 5000) == 4
+    assert engine.pool_workers(1000, 2) == 2
+    assert engine.pool_workers(0, 0) == 1
+
+
+def test_heatmap_rejects_oversized_range_before_expanding(prices):
+    params = {
+        'xAxis': {'param': 'maDays', 'min': 2, 'max': 10 ** 12},
+        'yAxis': {'param': 'fixedLots', 'values': [1, 2]}
+    }
+    result = engine.sensitivity_heatmap(prices, params)
+    assert not result['success']
+    assert str(engine.HEATMAP_MAX_CELLS) in result['error']
+
+
+def test_heatmap_range_axis(prices):
+    params = {
+        'xAxis': {'param': 'maDays', 'min': 5, 'max': 30, 'step': 5},
+        'yAxis': {'param': 'fixedLots', 'values': [1, 2]}
+    }
+    result = engine.sensitivity_heatmap(prices, params)
+    assert result['x']['values'] == [5, 10, 15, 20, 25, 30]
+    assert len(result['totalReturn']) == 2 and len(result['totalReturn'][0]) == 6
+
+
+def test_adaptive_rejects_oversized_space(prices):
+    # 各軸 10^10 個候選，int64 乘積會溢位；須以整數運算拒絕
+    space = {'maDays': {'min': 1, 'max': 10 ** 10}, 'fixedLots': {'min': 1, 'max': 10 ** 10}}
+    result = engine.optimize_adaptive(prices, {'space': space})
+    assert not result['success']
+    assert str(engine.ADAPTIVE_MAX_SPACE) in result['error']
+
+
+def test_adaptive_samples_large_range_without_expanding(prices):
+    space = {'maDays': {'min': 2, 'max': 200}, 'fixedLots': {'min': 1, 'max': 10 ** 9}}
+    result = engine.optimize_adaptive(prices, {'space': space, 'budget': 30, 'seed': 1, 'minBars': 300})
+    assert result['success']
+    assert result['spaceSize'] == 199 * 10 ** 9